@@ -0,0 +1,89 @@
+""" Micro-benchmark of the HTML-to-text backends used by services/htmlText.py
+
+Usage:
+    python benchmarks/html_extractor_benchmark.py <corpus_dir> [--repeat N]
+
+<corpus_dir> holds raw email bodies saved as .html/.htm files, e.g. newsletters and
+marketing mail exported from Outlook ("Save as" -> HTML) or the body.content of Graph
+messages fetched with Prefer: outlook.body-content-type="html".
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dags"))
+
+from services.htmlText import EXTRACTORS, extract_text_and_links
+
+# Function to load every HTML document of the corpus
+def load_corpus(corpus_dir):
+    documents = {}
+
+    for root, _, files in os.walk(corpus_dir):
+        for file in sorted(files):
+            if file.lower().endswith((".html", ".htm")):
+                file_path = os.path.join(root, file)
+
+                with open(file_path, "r", encoding="utf-8", errors="replace") as html_file:
+                    documents[os.path.relpath(file_path, corpus_dir)] = html_file.read()
+
+    return documents
+
+# Function to time one backend over the corpus, returning per-document timings and outputs
+def run_backend(backend, documents, repeat):
+    timings = []
+    outputs = {}
+
+    for name, html_content in documents.items():
+        best = None
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outputs[name] = extract_text_and_links(html_content, backend=backend)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        timings.append(best)
+
+    return timings, outputs
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare HTML-to-text extractor backends")
+    parser.add_argument("corpus_dir", help="Directory of .html/.htm email bodies")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per document, the fastest one is kept")
+    args = parser.parse_args()
+
+    documents = load_corpus(args.corpus_dir)
+    if not documents:
+        sys.exit(f"No .html/.htm files found in {args.corpus_dir}")
+
+    total_mb = sum(len(html_content.encode("utf-8")) for html_content in documents.values()) / (1024 * 1024)
+    print(f"Corpus: {len(documents)} documents, {total_mb:.2f} MB\n")
+
+    results = {}
+    for backend in EXTRACTORS:
+        timings, outputs = run_backend(backend, documents, args.repeat)
+        results[backend] = (timings, outputs)
+
+        total = sum(timings)
+        p95 = sorted(timings)[max(0, int(len(timings) * 0.95) - 1)]
+        print(f"{backend:>5}: total {total * 1000:9.1f} ms | mean {statistics.mean(timings) * 1000:7.2f} ms/doc | "
+              f"p95 {p95 * 1000:7.2f} ms/doc | {total_mb / total:6.1f} MB/s")
+
+    baseline_timings, baseline_outputs = results["bs4"]
+    for backend, (timings, outputs) in results.items():
+        if backend == "bs4":
+            continue
+
+        mismatches = [name for name in documents if outputs[name] != baseline_outputs[name]]
+        print(f"\n{backend} vs bs4: {sum(baseline_timings) / sum(timings):.1f}x faster, "
+              f"identical output for {len(documents) - len(mismatches)}/{len(documents)} documents")
+
+        for name in mismatches[:10]:
+            print(f"  differs: {name}")
+
+if __name__ == "__main__":
+    main()
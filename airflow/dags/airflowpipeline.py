@@ -1,63 +1,77 @@
 from airflow import DAG
 from datetime import datetime, timedelta
 from airflow.operators.python import PythonOperator
+from airflow.decorators import task_group
 
 import os
 from dotenv import load_dotenv
 from services.logger import start_logger
 from auth.accessToken import get_token_response, format_token_response
 from database.setupTables import create_tables_in_db
-from database.loadtoDB import load_users_tokendata_to_db, fetch_new_job, update_job_timestamp
+from database.connectDB import log_pool_stats
+from database.loadtoDB import load_users_tokendata_to_db, fetch_due_jobs, update_job_timestamp
 from services.processEmails import process_emails
 from services.processEmailAttachments import process_emails_with_attachments
-from services.extractAttachments import extract_contents_from_attachments
 from services.processEmailFolders import get_email_folders
+from services.vectors import flush_vector_writes
+from database.embeddingCache import trim_embedding_cache, log_embedding_cache_stats
 
 # Initialize logger
 logger = start_logger()
 
 load_dotenv()
 
-def get_and_format_token(**context):
-    """Get and format authentication token"""
-    
+def get_due_jobs(**context):
+    """Collect the users to sync in this run, one mapped user_pipeline per user"""
+
     try:
         received_token_dict = None
-        tokens_present = False
 
         # Check if dag_run was passed to our Airflow logic
         if context.get("dag_run", None):
-            logger.info("Task: get_and_format_token - Attempting to fetch tokens from context")
-            
+            logger.info("Task: get_due_jobs - Attempting to fetch tokens from context")
+
             # Safety check: The '.conf' value can be missing
             try:
                 received_token_dict = context['dag_run'].conf if context['dag_run'].conf else None
-            
+
             except Exception as e:
-                logger.error("Task: get_and_format_token - Context '.conf' is missing (See exception below)")
+                logger.error("Task: get_due_jobs - Context '.conf' is missing (See exception below)")
                 logger.error(e)
 
-        # If the above logic successfully fetched non-null values
-        if received_token_dict:
+        # Sometimes, context['dag_run'].conf may be available, but does not
+        # contain the data we are looking for
+        if received_token_dict and received_token_dict.get("access_token", None):
+            logger.info(f"Task: get_due_jobs - Received tokens for {received_token_dict.get('email')} from the triggered run")
+            return [{"email": received_token_dict.get("email"), "token_response": received_token_dict}]
 
-            # Sometimes, context['dag_run'].conf may be available, but does not 
-            # contain the data we are looking for
+        max_users = int(os.getenv("MAX_USERS_PER_RUN", "50"))
+        sync_interval_minutes = int(os.getenv("USER_SYNC_INTERVAL_MINUTES", "60"))
 
-            try:
-                if received_token_dict.get("access_token", None):
-                    tokens_present = True
-            
-            except Exception as e:
-                logger.error("Task: get_and_format_token - Token dictionary is non-null, but still an exception occured (See exception below)")
-                logger.error(e)
+        logger.info("Task: get_due_jobs - Fetching jobs due for a sync from database")
+        due_jobs = fetch_due_jobs(logger, max_users, sync_interval_minutes)
+
+        # No user pipeline is started (the mapped tasks are skipped) when nobody is due
+        if not due_jobs:
+            logger.warning("Task: get_due_jobs - No users are due for a sync")
+
+        return due_jobs
+
+    except Exception as e:
+        logger.error(f"Task: get_due_jobs - Error in get_due_jobs: {e}")
+        raise
 
-        # If we actually found the data we are looking for
-        if tokens_present:
+def get_and_format_token(job, **context):
+    """Get and format authentication token of the user handled by this mapped instance"""
+    
+    try:
+        # Triggered runs hand over the user's tokens, scheduled runs only have the refresh token
+        if job.get("token_response", None):
             token_response = {
-                "message" : received_token_dict
+                "message" : job["token_response"]
             }
-            
-            logger.info(f"RECEIVED DATA {context['dag_run'].conf}")
+
+            logger.info(f"Task: get_and_format_token - Using tokens received for {job.get('email')}")
 
         else:
             logger.info("Task: get_and_format_token - Fetching endpoint from environment variable")
@@ -67,15 +81,12 @@ def get_and_format_token(**context):
             if not endpoint:
                 raise ValueError("Endpoint environment variable seems to be missing")
             
-            logger.info("Task: get_and_format_token - Fetching refresh tokens from database")
-            refresh_token = fetch_new_job(logger)
-
-            if refresh_token is None:
-                raise ValueError("No refresh tokens found from the database")
+            if not job.get("refresh_token", None):
+                raise ValueError(f"No refresh token found for {job.get('email')}")
         
             # Get token response
-            token_response = get_token_response(logger, endpoint, refresh_token)
-            logger.info(f"Task: get_and_format_token - Token Response received")
+            token_response = get_token_response(logger, endpoint, job["refresh_token"])
+            logger.info(f"Task: get_and_format_token - Token Response received for {job.get('email')}")
         
         # Format token response
         formatted_token = format_token_response(logger, token_response)
@@ -127,8 +138,8 @@ def process_user_token(**context):
     try:
         logger.info("Task: process_user_token - Processing user token")
         
-        # Get formatted token from previous task
-        formatted_token = context['task_instance'].xcom_pull(task_ids='get_token_task', key='formatted_token')
+        # Get formatted token from previous task, pulled from the same mapped instance (i.e. the same user)
+        formatted_token = context['task_instance'].xcom_pull(task_ids='user_pipeline.get_token_task', key='formatted_token', map_indexes=context['task_instance'].map_index)
 
         if formatted_token is None:
             raise ValueError("formatted_token contains None instead of a dictionary in process_user_token")
@@ -152,33 +163,18 @@ def process_email_folders(**context):
     try:
         logger.info("Task: process_email_folders - Processing email folders")
         
-        # Get the task instance
-        task_instance = context['task_instance']
-        
-        # Try to get the FOLDERS_PROCESSED state from XCom
-        folders_processed = task_instance.xcom_pull(key='FOLDERS_PROCESSED', include_prior_dates=True)
-        
-        if not folders_processed:
-            # Get access token from previous task
-            formatted_token = context['task_instance'].xcom_pull(task_ids='get_token_task', key='formatted_token')
+        # Folders are refreshed on every run, since the delta sync of each user is driven by their folders
+        formatted_token = context['task_instance'].xcom_pull(task_ids='user_pipeline.get_token_task', key='formatted_token', map_indexes=context['task_instance'].map_index)
 
-            if formatted_token is None:
-                raise ValueError("formatted_token contains None instead of a dictionary in process_email_folders")
+        if formatted_token is None:
+            raise ValueError("formatted_token contains None instead of a dictionary in process_email_folders")
 
-            # Process email folders
-            get_email_folders(logger, formatted_token['access_token'])
-            logger.info("Task: process_email_folders - Email folders processed successfully")
-            
-            # Set FOLDERS_PROCESSED to True in XCom
-            task_instance.xcom_push(key='FOLDERS_PROCESSED', value=True)
-            logger.info("Task: process_email_folders - FOLDERS_PROCESSED set to True")
-        else:
-            logger.info("Task: process_email_folders - Email folders already processed, skipping folder creation")
+        # Process email folders
+        get_email_folders(logger, formatted_token['access_token'], formatted_token['id'])
+        logger.info("Task: process_email_folders - Email folders processed successfully")
     
     except Exception as e:
         logger.error(f"Task: process_email_folders - Error in process_email_folders: {e}")
-        # Make sure to set FOLDERS_PROCESSED to False if there's an error
-        context['task_instance'].xcom_push(key='FOLDERS_PROCESSED', value=False)
         raise
 
 
@@ -189,8 +185,8 @@ def process_email_data(**context):
         logger.info("Task: process_email_data - Processing emails")
         
         # Get necessary data from previous tasks
-        formatted_token = context['task_instance'].xcom_pull(task_ids='get_token_task', key='formatted_token')
-        user_email = context['task_instance'].xcom_pull(task_ids='process_token_task', key='user_email')
+        formatted_token = context['task_instance'].xcom_pull(task_ids='user_pipeline.get_token_task', key='formatted_token', map_indexes=context['task_instance'].map_index)
+        user_email = context['task_instance'].xcom_pull(task_ids='user_pipeline.process_token_task', key='user_email', map_indexes=context['task_instance'].map_index)
 
         # Using the checking condition "if formatted_token and user_email"
         # will make it difficult to identify which value was None
@@ -210,6 +206,10 @@ def process_email_data(**context):
             formatted_token['email'],
             formatted_token['id']
         )
+
+        # Write the vectors still buffered and trim the embedding cache before the task ends
+        flush_vector_writes()
+        trim_embedding_cache()
         logger.info("Task: process_email_data - Emails processed successfully")
     
     except Exception as e:
@@ -223,7 +223,7 @@ def process_attachments(**context):
         logger.info("Task: process_attachments - Processing email attachments")
         
         # Get necessary data from previous tasks
-        formatted_token = context['task_instance'].xcom_pull(task_ids='get_token_task', key='formatted_token')
+        formatted_token = context['task_instance'].xcom_pull(task_ids='user_pipeline.get_token_task', key='formatted_token', map_indexes=context['task_instance'].map_index)
 
         if formatted_token is None:
             raise ValueError("formatted_token contains None instead of a dictionary in process_attachments")
@@ -234,27 +234,19 @@ def process_attachments(**context):
         process_emails_with_attachments(
             logger,
             formatted_token['access_token'],
+            formatted_token['email'],
             s3_bucket_name
         )
+
+        # Write the vectors still buffered and trim the embedding cache before the task ends
+        flush_vector_writes()
+        trim_embedding_cache()
         logger.info("Task: process_attachments - Email attachments processed successfully")
     
     except Exception as e:
         logger.error(f"Task: process_attachments - Error in process_attachments: {e}")
         raise
 
-def extract_attachment_contents(**context):
-    """Extract contents from email attachments"""
-    
-    try:
-        logger.info("Task: extract_attachment_contents - Extracting contents from attachments")
-        
-        extract_contents_from_attachments(logger)
-        logger.info("Task: extract_attachment_contents - Attachment contents extracted successfully")
-    
-    except Exception as e:
-        logger.error(f"Task: extract_attachment_contents - Error in extract_attachment_contents: {e}")
-        raise
-
 def update_job(**context):
     """ Update the job's updated_at time in the database """
 
@@ -262,7 +254,7 @@ def update_job(**context):
         logger.info("Task: update_job - Updating job's updated_at timestamp")
         
         # Get necessary data from previous tasks
-        formatted_token = context['task_instance'].xcom_pull(task_ids='get_token_task', key='formatted_token')
+        formatted_token = context['task_instance'].xcom_pull(task_ids='user_pipeline.get_token_task', key='formatted_token', map_indexes=context['task_instance'].map_index)
 
         if formatted_token is None:
             raise ValueError("formatted_token contains None instead of a dictionary in update_job")
@@ -276,6 +268,14 @@ def update_job(**context):
         raise
 
 
+def log_database_pool_stats(context):
+    """ Log the database connection pool and embedding cache usage of the task that just finished """
+
+    logger.info(f"Task: {context['task_instance'].task_id} - Database connection pool usage")
+    log_pool_stats(logger)
+    log_embedding_cache_stats(logger)
+
+
 # Default arguments for our DAG
 default_args = {
     'owner'            : 'airflow',
@@ -285,6 +285,10 @@ default_args = {
     'retries'          : 1,
     'retry_delay'      : timedelta(minutes=5),
     'start_date'       : datetime(2024, 1, 1),
+
+    # Callbacks run in the task's own process, so they see the pool that the task used
+    'on_success_callback' : log_database_pool_stats,
+    'on_failure_callback' : log_database_pool_stats,
 }
 
 # Create the DAG
@@ -305,55 +309,72 @@ with DAG(
         dag=dag,
     )
 
-    get_token_task = PythonOperator(
-        task_id='get_token_task',
-        python_callable=get_and_format_token,
+    get_jobs_task = PythonOperator(
+        task_id='get_jobs_task',
+        python_callable=get_due_jobs,
         provide_context=True,
         dag=dag,
     )
 
-    process_token_task = PythonOperator(
-        task_id='process_token_task',
-        python_callable=process_user_token,
-        provide_context=True,
-        dag=dag,
-    )
+    # Number of users synced at the same time; applies to each step of the user pipeline
+    max_parallel_users = int(os.getenv("MAX_PARALLEL_USERS", "4"))
+
+    # One pipeline per user due for a sync, each mapped instance carrying its own token
+    @task_group(group_id='user_pipeline')
+    def user_pipeline(job):
+        get_token_task = PythonOperator(
+            task_id='get_token_task',
+            python_callable=get_and_format_token,
+            op_kwargs={'job': job},
+            provide_context=True,
+            max_active_tis_per_dagrun=max_parallel_users,
+            dag=dag,
+        )
 
-    process_folders_task = PythonOperator(
-        task_id='process_folders_task',
-        python_callable=process_email_folders,
-        provide_context=True,
-        trigger_rule='all_success',
-        dag=dag,
-    )
+        process_token_task = PythonOperator(
+            task_id='process_token_task',
+            python_callable=process_user_token,
+            provide_context=True,
+            max_active_tis_per_dagrun=max_parallel_users,
+            dag=dag,
+        )
 
-    process_emails_task = PythonOperator(
-        task_id='process_emails_task',
-        python_callable=process_email_data,
-        provide_context=True,
-        dag=dag,
-    )
+        process_folders_task = PythonOperator(
+            task_id='process_folders_task',
+            python_callable=process_email_folders,
+            provide_context=True,
+            trigger_rule='all_success',
+            max_active_tis_per_dagrun=max_parallel_users,
+            dag=dag,
+        )
 
-    process_attachments_task = PythonOperator(
-        task_id='process_attachments_task',
-        python_callable=process_attachments,
-        provide_context=True,
-        dag=dag,
-    )
+        process_emails_task = PythonOperator(
+            task_id='process_emails_task',
+            python_callable=process_email_data,
+            provide_context=True,
+            max_active_tis_per_dagrun=max_parallel_users,
+            dag=dag,
+        )
 
-    extract_contents_task = PythonOperator(
-        task_id='extract_contents_task',
-        python_callable=extract_attachment_contents,
-        provide_context=True,
-        dag=dag,
-    )
+        process_attachments_task = PythonOperator(
+            task_id='process_attachments_task',
+            python_callable=process_attachments,
+            provide_context=True,
+            max_active_tis_per_dagrun=max_parallel_users,
+            dag=dag,
+        )
 
-    update_job_task = PythonOperator(
-        task_id='update_job_task',
-        python_callable=update_job,
-        provide_context=True,
-        dag=dag,
-    )
+        update_job_task = PythonOperator(
+            task_id='update_job_task',
+            python_callable=update_job,
+            provide_context=True,
+            max_active_tis_per_dagrun=max_parallel_users,
+            dag=dag,
+        )
+
+        get_token_task >> process_token_task >> process_folders_task >> process_emails_task >> process_attachments_task >> update_job_task
+
+    user_pipelines = user_pipeline.expand(job=get_jobs_task.output)
 
     # Task dependencies
-    setup_db_task >> get_token_task >> process_token_task >> process_folders_task >> process_emails_task >> process_attachments_task >> extract_contents_task >> update_job_task
\ No newline at end of file
+    setup_db_task >> get_jobs_task >> user_pipelines
@@ -1,18 +1,39 @@
 import os
 import time
+import threading
 import psycopg2
+from contextlib import contextmanager
 from psycopg2 import sql, Error
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 
 from services.logger import start_logger
 
 logger = start_logger()
 
-# Function to create connection to PostgreSQL
-def create_connection_to_postgresql(attempts=3, delay=2):
-    logger.info("Airflow - POSTGRESQL - database/connectDB.py - create_connection() - Creating connection to PostgreSQL database")
+# Process-wide connection pool, created on first use
+connection_pool = None
+pool_slots = None
+pool_lock = threading.Lock()
+pool_stats = {
+    "checkouts"         : 0,
+    "waits"             : 0,
+    "wait_time"         : 0.0,
+    "max_wait_time"     : 0.0,
+    "checked_out"       : 0,
+    "max_checked_out"   : 0,
+    "discarded"         : 0,
+    "closed"            : 0,
+}
 
-    # Fetch connection parameters from environment variables
-    db_params = {
+# When each pooled connection was last returned; connections idle for longer than
+# DB_POOL_HEALTHCHECK_INTERVAL seconds are checked with "SELECT 1" before being handed out
+last_used_at = {}
+
+
+# Function to fetch connection parameters from environment variables
+def get_connection_params():
+    return {
         "dbname": os.getenv("DB_NAME"),
         "user": os.getenv("DB_USERNAME"),
         "password": os.getenv("DB_PASSWORD"),
@@ -20,6 +41,14 @@ def create_connection_to_postgresql(attempts=3, delay=2):
         "port": int(os.getenv("DB_PORT"))
     }
 
+
+# Function to create connection to PostgreSQL
+def create_connection_to_postgresql(attempts=3, delay=2):
+    logger.info("Airflow - POSTGRESQL - database/connectDB.py - create_connection() - Creating connection to PostgreSQL database")
+
+    # Fetch connection parameters from environment variables
+    db_params = get_connection_params()
+
     attempt = 1
     while attempt <= attempts:
         try:
@@ -38,6 +67,136 @@ def create_connection_to_postgresql(attempts=3, delay=2):
     return None
 
 
+# Function to create the connection pool on first use
+def get_connection_pool(attempts=3, delay=2):
+    global connection_pool, pool_slots
+
+    with pool_lock:
+        if connection_pool is not None:
+            return connection_pool
+
+        # The pool closes any connection returned while it already keeps min_size idle ones, so a min size
+        # below the max size reconnects after every concurrent burst; it defaults to the max size
+        max_size = int(os.getenv("DB_POOL_MAX_SIZE", "8"))
+        min_size = min(int(os.getenv("DB_POOL_MIN_SIZE", str(max_size))), max_size)
+        logger.info(f"Airflow - POSTGRESQL - database/connectDB.py - get_connection_pool() - Creating connection pool (min {min_size}, max {max_size})")
+
+        attempt = 1
+        while True:
+            try:
+                connection_pool = ThreadedConnectionPool(min_size, max_size, **get_connection_params())
+                break
+            except (Error, IOError) as e:
+                if attempt == attempts:
+                    logger.error(f"Airflow - POSTGRESQL - database/connectDB.py - get_connection_pool() - Failed to connect to PostgreSQL database: {e}")
+                    raise
+                logger.warning(f"Airflow - POSTGRESQL - database/connectDB.py - get_connection_pool() - Connection Failed: {e} - Retrying {attempt}/{attempts}")
+                time.sleep(delay ** attempt)
+                attempt += 1
+
+        # ThreadedConnectionPool raises when exhausted; the semaphore makes callers wait for a free connection instead
+        pool_slots = threading.BoundedSemaphore(max_size)
+        return connection_pool
+
+
+# Function to check that a pooled connection is still usable
+def is_connection_healthy(conn):
+    if conn.closed:
+        return False
+
+    healthcheck_interval = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30"))
+    if time.monotonic() - last_used_at.get(id(conn), 0) < healthcheck_interval:
+        return True
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except Error:
+        return False
+
+
+# Function to return a connection to the pool, counting the connections the pool closes
+def return_connection(pool, conn, close=False):
+    pool.putconn(conn, close=close)
+
+    if conn.closed:
+        last_used_at.pop(id(conn), None)
+        with pool_lock:
+            pool_stats["closed"] += 1
+
+
+# Context manager to borrow a connection from the pool. Callers commit their own work;
+# anything left uncommitted is rolled back before the connection goes back to the pool
+@contextmanager
+def db_connection():
+    pool = get_connection_pool()
+
+    wait_start = time.perf_counter()
+    if not pool_slots.acquire(blocking=False):
+        pool_slots.acquire()
+        wait_time = time.perf_counter() - wait_start
+
+        with pool_lock:
+            pool_stats["waits"] += 1
+            pool_stats["wait_time"] += wait_time
+            pool_stats["max_wait_time"] = max(pool_stats["max_wait_time"], wait_time)
+
+    conn = None
+    try:
+        conn = pool.getconn()
+
+        # Replace connections dropped by the server (restarts, idle timeouts)
+        while not is_connection_healthy(conn):
+            with pool_lock:
+                pool_stats["discarded"] += 1
+            return_connection(pool, conn, close=True)
+
+            # Already returned; the cleanup below must not return it again if getconn() fails
+            conn = None
+            conn = pool.getconn()
+
+        with pool_lock:
+            pool_stats["checkouts"] += 1
+            pool_stats["checked_out"] += 1
+            pool_stats["max_checked_out"] = max(pool_stats["max_checked_out"], pool_stats["checked_out"])
+
+        try:
+            yield conn
+        finally:
+            with pool_lock:
+                pool_stats["checked_out"] -= 1
+
+            if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+
+            last_used_at[id(conn)] = time.monotonic()
+            return_connection(pool, conn, close=bool(conn.closed))
+            conn = None
+
+    finally:
+        if conn is not None:
+            return_connection(pool, conn, close=True)
+        pool_slots.release()
+
+
+# Function to log the connection pool statistics, called at the end of each task
+def log_pool_stats(logger):
+    if connection_pool is None:
+        logger.info("Airflow - POSTGRESQL - database/connectDB.py - log_pool_stats() - Connection pool was not used")
+        return
+
+    with pool_lock:
+        stats = dict(pool_stats)
+
+    logger.info(
+        "Airflow - POSTGRESQL - database/connectDB.py - log_pool_stats() - "
+        f"Checkouts: {stats['checkouts']}, checked out now: {stats['checked_out']}, peak checked out: {stats['max_checked_out']}, "
+        f"waits: {stats['waits']}, total wait: {stats['wait_time']:.3f}s, max wait: {stats['max_wait_time']:.3f}s, "
+        f"discarded connections: {stats['discarded']}, closed connections: {stats['closed']}"
+    )
+
 
 # Function to close connection to PostgreSQL
 def close_connection(dbconn, cursor=None):
@@ -0,0 +1,123 @@
+import os
+import hashlib
+import threading
+from psycopg2.extras import execute_values
+
+from database.connectDB import db_connection
+from services.logger import start_logger
+
+logger = start_logger()
+
+# Cache lookups of this process, logged at the end of each task
+cache_lock = threading.Lock()
+cache_stats = {
+    "lookups"   : 0,
+    "hits"      : 0,
+    "stored"    : 0,
+    "evicted"   : 0,
+}
+
+
+# Function to compute the cache key of a text; the model name is stored next to it
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Function to fetch the cached embeddings of the given text hashes, returned as {text_hash: embedding}
+def fetch_cached_embeddings(model, text_hashes):
+    cached = {}
+    text_hashes = list(text_hashes)
+
+    if not text_hashes:
+        return cached
+
+    # Hits are marked as used, so that eviction drops the least recently used embeddings
+    fetch_query = """
+        UPDATE embedding_cache
+        SET last_used_at = CURRENT_TIMESTAMP
+        WHERE model = %s AND text_hash = ANY(%s)
+        RETURNING text_hash, embedding
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(fetch_query, (model, text_hashes))
+            cached = dict(cursor.fetchall())
+            conn.commit()
+
+    except Exception as e:
+        logger.error(f"Airflow - POSTGRESQL - database/embeddingCache.py - fetch_cached_embeddings() - Error fetching cached embeddings: {e}")
+
+    with cache_lock:
+        cache_stats["lookups"] += len(text_hashes)
+        cache_stats["hits"] += len(cached)
+
+    return cached
+
+
+# Function to cache embeddings, given as {text_hash: embedding}
+def save_cached_embeddings(model, embeddings):
+    if not embeddings:
+        return
+
+    insert_query = """
+        INSERT INTO embedding_cache (model, text_hash, embedding)
+        VALUES %s
+        ON CONFLICT (model, text_hash) DO UPDATE SET last_used_at = CURRENT_TIMESTAMP
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            # Sorted, so that concurrent writers lock shared rows in the same order; embeddings are large,
+            # so rows are sent in statements of execute_values' default page size rather than all at once
+            execute_values(cursor, insert_query, [(model, text_hash, embeddings[text_hash]) for text_hash in sorted(embeddings)])
+            conn.commit()
+
+        with cache_lock:
+            cache_stats["stored"] += len(embeddings)
+
+    except Exception as e:
+        logger.error(f"Airflow - POSTGRESQL - database/embeddingCache.py - save_cached_embeddings() - Error caching embeddings: {e}")
+
+
+# Function to keep the EMBEDDING_CACHE_MAX_ROWS most recently used embeddings and drop the others
+def trim_embedding_cache():
+    max_rows = int(os.getenv("EMBEDDING_CACHE_MAX_ROWS", "100000"))
+
+    trim_query = """
+        DELETE FROM embedding_cache
+        WHERE last_used_at < (
+            SELECT last_used_at
+            FROM embedding_cache
+            ORDER BY last_used_at DESC
+            OFFSET %s LIMIT 1
+        )
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(trim_query, (max_rows,))
+            evicted = cursor.rowcount
+            conn.commit()
+
+        with cache_lock:
+            cache_stats["evicted"] += evicted
+
+        if evicted:
+            logger.info(f"Airflow - POSTGRESQL - database/embeddingCache.py - trim_embedding_cache() - Evicted {evicted} embeddings to keep the cache under {max_rows} rows")
+
+    except Exception as e:
+        logger.error(f"Airflow - POSTGRESQL - database/embeddingCache.py - trim_embedding_cache() - Error trimming the embedding cache: {e}")
+
+
+# Function to log the embedding cache statistics, called at the end of each task
+def log_embedding_cache_stats(logger):
+    with cache_lock:
+        stats = dict(cache_stats)
+
+    hit_rate = stats["hits"] / stats["lookups"] * 100 if stats["lookups"] else 0
+    logger.info(
+        "Airflow - POSTGRESQL - database/embeddingCache.py - log_embedding_cache_stats() - "
+        f"Lookups: {stats['lookups']}, hits: {stats['hits']} ({hit_rate:.1f}%), "
+        f"stored: {stats['stored']}, evicted: {stats['evicted']}"
+    )
@@ -1,9 +1,10 @@
-import ast
+import time
 import uuid
 import json
+from psycopg2.extras import execute_values
 
-from database.connectDB import create_connection_to_postgresql, close_connection
-from services.vectors import create_embeddings_and_index
+from database.connectDB import db_connection
+from services.vectors import build_email_chunks, create_embeddings_and_index, delete_vectors, embed_texts, get_collection_name, vector_write_buffer
 from services.labeling import label_email
 
 # Function to store token response with respect to user in Users table
@@ -11,12 +12,10 @@ def load_users_tokendata_to_db(logger, formatted_token_response):
     logger.info("Airflow - database/loadtoDB.py - load_users_tokendata_to_db() - Loading token data into USERS table")
     logger.info("Airflow - database/loadtoDB.py -  load_users_tokendata_to_db() - Creating database connection")
 
-    conn = create_connection_to_postgresql()
     user_email = None
 
-    if conn:
-        try:
-            cursor = conn.cursor()
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
             insert_query = f"""
                 INSERT INTO users (
                     id, tenant_id, name, email, token_type, 
@@ -47,11 +46,10 @@ def load_users_tokendata_to_db(logger, formatted_token_response):
             user_email = formatted_token_response['email']
             logger.info("Airflow - database/loadtoDB.py - load_users_tokendata_to_db() - Token data inserted successfully in USERS table")
 
-        except Exception as e:
-            logger.error(f"Airflow - database/loadtoDB.py - load_users_tokendata_to_db() - Error inserting token data into the users table = {e}")
-        finally:
-            close_connection(conn, cursor)
-            return user_email
+    except Exception as e:
+        logger.error(f"Airflow - database/loadtoDB.py - load_users_tokendata_to_db() - Error inserting token data into the users table = {e}")
+
+    return user_email
 
 
 # Fuction to load email link data into EMAIL_LINKS table
@@ -59,280 +57,346 @@ def insert_or_update_email_links(logger, email_link_data):
     logger.info("Airflow - database/loadtoDB.py - insert_or_update_email_links() - Inserting or updating email links data in EMAIL_LINKS table")
     logger.info("Airflow - database/loadtoDB.py - insert_or_update_email_links() - Creating database connection")
 
-    conn = create_connection_to_postgresql()
-
-    if conn:
-        try:
-            cursor = conn.cursor()
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
             email_links_query = f"""
                 INSERT INTO email_links (
-                    id, email, current_link, next_link, is_current_link_processed
+                    id, email, folder_id, current_link, next_link, delta_link, is_current_link_processed
                 ) VALUES (
-                    %(id)s, %(email)s, %(current_link)s, %(next_link)s, %(is_current_link_processed)s
+                    %(id)s, %(email)s, %(folder_id)s, %(current_link)s, %(next_link)s, %(delta_link)s, %(is_current_link_processed)s
                 )
                 ON CONFLICT (id) 
                 DO UPDATE SET
                     current_link = EXCLUDED.current_link,
                     next_link = EXCLUDED.next_link,
+                    delta_link = EXCLUDED.delta_link,
                     is_current_link_processed = EXCLUDED.is_current_link_processed,
                     updated_at = CURRENT_TIMESTAMP
             """
 
+            # Cursors of the full mailbox scan are not tied to a folder and have no delta link
+            email_link_data = {"folder_id": None, "delta_link": None, **email_link_data}
+
             cursor.execute(email_links_query, email_link_data)
             conn.commit()
             logger.info("Airflow - database/loadtoDB.py - insert_or_update_email_links() - Email links data inserted or updated successfully in EMAIL_LINKS table")
 
-        except Exception as e:
-            logger.error(f"Airflow - database/loadtoDB.py - insert_or_update_email_links() - Error inserting or updating email links data: {e}")
-        finally:
-            close_connection(conn, cursor)
+    except Exception as e:
+        logger.error(f"Airflow - database/loadtoDB.py - insert_or_update_email_links() - Error inserting or updating email links data: {e}")
 
 # Function to insert email folders
 def insert_email_folders(logger, email_folder):
     logger.info("Airflow - database/loadtoDB.py - insert_email_folders() - Loading email folders into EMAIL_FOLDERS table")
     logger.info("Airflow - database/loadtoDB.py - insert_email_folders() - Creating database connection")
 
-    conn = create_connection_to_postgresql()
-
-    if conn:
-        try:
-            cursor = conn.cursor()
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
             emailfolder_insert_query = f"""
                         INSERT INTO email_folders (
-                            id, display_name, parent_folder_id, child_folder_count, unread_item_count,
+                            id, user_id, display_name, parent_folder_id, child_folder_count, unread_item_count,
                             total_item_count, size_in_bytes, is_hidden, created_at
                         )
                         VALUES (
-                            %(id)s, %(display_name)s, %(parent_folder_id)s, %(child_folder_count)s,
+                            %(id)s, %(user_id)s, %(display_name)s, %(parent_folder_id)s, %(child_folder_count)s,
                             %(unread_item_count)s, %(total_item_count)s, %(size_in_bytes)s,
                             %(is_hidden)s, CURRENT_TIMESTAMP
                         )
-                        ON CONFLICT (id) DO NOTHING;
+                        ON CONFLICT (id)
+                        DO UPDATE SET
+                            user_id = EXCLUDED.user_id,
+                            display_name = EXCLUDED.display_name,
+                            child_folder_count = EXCLUDED.child_folder_count,
+                            unread_item_count = EXCLUDED.unread_item_count,
+                            total_item_count = EXCLUDED.total_item_count,
+                            size_in_bytes = EXCLUDED.size_in_bytes,
+                            is_hidden = EXCLUDED.is_hidden;
                     """
             cursor.execute(emailfolder_insert_query, email_folder)
             conn.commit()
             logger.info("Airflow - database/loadtoDB.py - insert_email_folders() - Email folders inserted successfully in EMAIL_FOLDERS table")
 
-        except Exception as e:
-            logger.error(f"Airflow - database/loadtoDB.py - insert_email_folders() - Error inserting email contents into the EMAIL_FOLDERS table = {e}")
-            raise e
-        finally:
-            close_connection(conn, cursor)
-
-
-# Function to load email data into EMAILS table
-def insert_email_data(logger, email_data):
-    logger.info("Airflow - database/loadtoDB.py - insert_email_data() - Loading email data into EMAILS table")
-    logger.info("Airflow - database/loadtoDB.py - insert_email_data() - Creating database connection")
-
-    conn = create_connection_to_postgresql()
-
-    if conn:
-        try:
-            cursor = conn.cursor()
-            email_insert_query = f"""
-                    INSERT INTO emails (
-                    id, content_type, body, body_preview, change_key, conversation_id, conversation_index, 
-                    created_datetime, created_datetime_timezone, end_datetime, end_datetime_timezone, 
-                    has_attachments, importance, inference_classification, is_draft, is_read, 
-                    is_all_day, is_out_of_date, meeting_message_type, meeting_request_type, 
-                    odata_etag, odata_value, parent_folder_id, received_datetime, recurrence, 
-                    reply_to, response_type, sent_datetime, start_datetime, start_datetime_timezone, 
-                    subject, type, web_link
-                ) VALUES (
-                    %(id)s, %(content_type)s, %(body)s, %(body_preview)s, %(change_key)s, %(conversation_id)s, %(conversation_index)s,
-                    %(created_datetime)s, %(created_datetime_timezone)s, %(end_datetime)s, %(end_datetime_timezone)s,
-                    %(has_attachments)s, %(importance)s, %(inference_classification)s, %(is_draft)s, %(is_read)s,
-                    %(is_all_day)s, %(is_out_of_date)s, %(meeting_message_type)s, %(meeting_request_type)s,
-                    %(odata_etag)s, %(odata_value)s, %(parent_folder_id)s, %(received_datetime)s, %(recurrence)s,
-                    %(reply_to)s, %(response_type)s, %(sent_datetime)s, %(start_datetime)s, %(start_datetime_timezone)s,
-                    %(subject)s, %(type)s, %(web_link)s
-                )
-                ON CONFLICT (id)
-                DO UPDATE SET
-                    content_type = EXCLUDED.content_type,
-                    body = EXCLUDED.body,
-                    body_preview = EXCLUDED.body_preview,
-                    change_key = EXCLUDED.change_key,
-                    conversation_id = EXCLUDED.conversation_id,
-                    conversation_index = EXCLUDED.conversation_index,
-                    created_datetime = EXCLUDED.created_datetime,
-                    created_datetime_timezone = EXCLUDED.created_datetime_timezone,
-                    end_datetime = EXCLUDED.end_datetime,
-                    end_datetime_timezone = EXCLUDED.end_datetime_timezone,
-                    has_attachments = EXCLUDED.has_attachments,
-                    importance = EXCLUDED.importance,
-                    inference_classification = EXCLUDED.inference_classification,
-                    is_draft = EXCLUDED.is_draft,
-                    is_read = EXCLUDED.is_read,
-                    is_all_day = EXCLUDED.is_all_day,
-                    is_out_of_date = EXCLUDED.is_out_of_date,
-                    meeting_message_type = EXCLUDED.meeting_message_type,
-                    meeting_request_type = EXCLUDED.meeting_request_type,
-                    odata_etag = EXCLUDED.odata_etag,
-                    odata_value = EXCLUDED.odata_value,
-                    parent_folder_id = EXCLUDED.parent_folder_id,
-                    received_datetime = EXCLUDED.received_datetime,
-                    recurrence = EXCLUDED.recurrence,
-                    reply_to = EXCLUDED.reply_to,
-                    response_type = EXCLUDED.response_type,
-                    sent_datetime = EXCLUDED.sent_datetime,
-                    start_datetime = EXCLUDED.start_datetime,
-                    start_datetime_timezone = EXCLUDED.start_datetime_timezone,
-                    subject = EXCLUDED.subject,
-                    type = EXCLUDED.type,
-                    web_link = EXCLUDED.web_link
-                """
-
-            cursor.execute(email_insert_query, email_data)
-            conn.commit()
-            logger.info("Airflow - database/loadtoDB.py - insert_email_data() - Email contents inserted successfully in EMAILS table")
-
-        except Exception as e:
-            logger.error(f"Airflow - database/loadtoDB.py - insert_email_data() - Error inserting email contents into the EMAILS table = {e}")
-            raise e
-        finally:
-            close_connection(conn, cursor)
-
-
-# Function to load sender data
-def insert_sender_data(logger, sender_data):
-    logger.info("Airflow - database/loadtoDB.py - insert_sender_data() - Loading senders data into SENDERS table")
-    logger.info("Airflow - database/loadtoDB.py - insert_sender_data() - Creating database connection")
-
-    conn = create_connection_to_postgresql()
-
-    if conn:
-        try:
-            cursor = conn.cursor()
-            sender_insert_query = f"""
-                    INSERT INTO senders (
-                        id, email_id, email_address, name
-                    ) VALUES (
-                        %(id)s, %(email_id)s, %(email_address)s, %(name)s
-                    )
-                    ON CONFLICT (id) 
-                    DO UPDATE SET
-                        email_id = EXCLUDED.email_id,
-                        email_address = EXCLUDED.email_address,
-                        name = EXCLUDED.name
-                """
-
-            cursor.execute(sender_insert_query, sender_data)
+    except Exception as e:
+        logger.error(f"Airflow - database/loadtoDB.py - insert_email_folders() - Error inserting email contents into the EMAIL_FOLDERS table = {e}")
+        raise e
+
+
+# Row templates for execute_values, one per table
+EMAIL_ROW_TEMPLATE = """(
+    %(id)s, %(content_type)s, %(body)s, %(body_preview)s, %(change_key)s, %(conversation_id)s, %(conversation_index)s,
+    %(created_datetime)s, %(created_datetime_timezone)s, %(end_datetime)s, %(end_datetime_timezone)s,
+    %(has_attachments)s, %(importance)s, %(inference_classification)s, %(is_draft)s, %(is_read)s,
+    %(is_all_day)s, %(is_out_of_date)s, %(meeting_message_type)s, %(meeting_request_type)s,
+    %(odata_etag)s, %(odata_value)s, %(parent_folder_id)s, %(received_datetime)s, %(recurrence)s,
+    %(reply_to)s, %(response_type)s, %(sent_datetime)s, %(start_datetime)s, %(start_datetime_timezone)s,
+    %(subject)s, %(type)s, %(web_link)s, %(owner_email)s
+)"""
+SENDER_ROW_TEMPLATE     = "(%(id)s, %(email_id)s, %(email_address)s, %(name)s)"
+RECIPIENT_ROW_TEMPLATE  = "(%(id)s, %(email_id)s, %(type)s, %(email_address)s, %(name)s)"
+FLAG_ROW_TEMPLATE       = "(%(email_id)s, %(flag_status)s)"
+
+
+# Function to upsert a batch of emails into EMAILS table
+def insert_email_rows(logger, cursor, email_rows):
+    logger.info(f"Airflow - database/loadtoDB.py - insert_email_rows() - Loading {len(email_rows)} rows into EMAILS table")
+
+    # Flag, read and move changes also bump the changeKey: attachments are only queued again when has_attachments
+    # changes, and attachments_attempts is kept so that ATTACHMENT_MAX_ATTEMPTS still caps failing attachments
+    email_insert_query = """
+                INSERT INTO emails (
+                id, content_type, body, body_preview, change_key, conversation_id, conversation_index, 
+                created_datetime, created_datetime_timezone, end_datetime, end_datetime_timezone, 
+                has_attachments, importance, inference_classification, is_draft, is_read, 
+                is_all_day, is_out_of_date, meeting_message_type, meeting_request_type, 
+                odata_etag, odata_value, parent_folder_id, received_datetime, recurrence, 
+                reply_to, response_type, sent_datetime, start_datetime, start_datetime_timezone, 
+                subject, type, web_link, owner_email
+            ) VALUES %s
+            ON CONFLICT (id)
+            DO UPDATE SET
+                content_type = EXCLUDED.content_type,
+                body = EXCLUDED.body,
+                body_preview = EXCLUDED.body_preview,
+                change_key = EXCLUDED.change_key,
+                conversation_id = EXCLUDED.conversation_id,
+                conversation_index = EXCLUDED.conversation_index,
+                created_datetime = EXCLUDED.created_datetime,
+                created_datetime_timezone = EXCLUDED.created_datetime_timezone,
+                end_datetime = EXCLUDED.end_datetime,
+                end_datetime_timezone = EXCLUDED.end_datetime_timezone,
+                has_attachments = EXCLUDED.has_attachments,
+                importance = EXCLUDED.importance,
+                inference_classification = EXCLUDED.inference_classification,
+                is_draft = EXCLUDED.is_draft,
+                is_read = EXCLUDED.is_read,
+                is_all_day = EXCLUDED.is_all_day,
+                is_out_of_date = EXCLUDED.is_out_of_date,
+                meeting_message_type = EXCLUDED.meeting_message_type,
+                meeting_request_type = EXCLUDED.meeting_request_type,
+                odata_etag = EXCLUDED.odata_etag,
+                odata_value = EXCLUDED.odata_value,
+                parent_folder_id = EXCLUDED.parent_folder_id,
+                received_datetime = EXCLUDED.received_datetime,
+                recurrence = EXCLUDED.recurrence,
+                reply_to = EXCLUDED.reply_to,
+                response_type = EXCLUDED.response_type,
+                sent_datetime = EXCLUDED.sent_datetime,
+                start_datetime = EXCLUDED.start_datetime,
+                start_datetime_timezone = EXCLUDED.start_datetime_timezone,
+                subject = EXCLUDED.subject,
+                type = EXCLUDED.type,
+                web_link = EXCLUDED.web_link,
+                owner_email = EXCLUDED.owner_email,
+                vector_indexed = FALSE,
+                attachments_status = CASE
+                    WHEN emails.has_attachments IS DISTINCT FROM EXCLUDED.has_attachments THEN 'pending'
+                    ELSE emails.attachments_status
+                END
+        """
+
+    execute_values(cursor, email_insert_query, email_rows, template=EMAIL_ROW_TEMPLATE, page_size=len(email_rows))
+
+
+# Function to replace the senders of a batch of emails in SENDERS table
+def insert_sender_rows(logger, cursor, email_ids, sender_rows):
+    logger.info(f"Airflow - database/loadtoDB.py - insert_sender_rows() - Loading {len(sender_rows)} rows into SENDERS table")
+
+    # Sender ids are generated on every load, so stale rows of re-synced emails are removed first
+    cursor.execute("DELETE FROM senders WHERE email_id = ANY(%s)", (email_ids,))
+
+    sender_insert_query = """
+        INSERT INTO senders (
+            id, email_id, email_address, name
+        ) VALUES %s
+    """
+
+    if sender_rows:
+        execute_values(cursor, sender_insert_query, sender_rows, template=SENDER_ROW_TEMPLATE, page_size=len(sender_rows))
+
+
+# Function to replace the recipients of a batch of emails in RECIPIENTS table
+def insert_recipient_rows(logger, cursor, email_ids, recipient_rows):
+    logger.info(f"Airflow - database/loadtoDB.py - insert_recipient_rows() - Loading {len(recipient_rows)} rows into RECIPIENTS table")
+
+    # Recipient ids are generated on every load, so stale rows of re-synced emails are removed first
+    cursor.execute("DELETE FROM recipients WHERE email_id = ANY(%s)", (email_ids,))
+
+    recipient_insert_query = """
+        INSERT INTO recipients (
+            id, email_id, type, email_address, name
+        ) VALUES %s
+    """
+
+    if recipient_rows:
+        execute_values(cursor, recipient_insert_query, recipient_rows, template=RECIPIENT_ROW_TEMPLATE, page_size=len(recipient_rows))
+
+
+# Function to upsert the flags of a batch of emails into FLAGS table
+def insert_flag_rows(logger, cursor, flag_rows):
+    logger.info(f"Airflow - database/loadtoDB.py - insert_flag_rows() - Loading {len(flag_rows)} rows into FLAGS table")
+
+    flags_insert_query = """
+        INSERT INTO flags (
+            email_id, flag_status
+        ) VALUES %s
+        ON CONFLICT (email_id) 
+        DO UPDATE SET
+            flag_status = EXCLUDED.flag_status
+    """
+
+    execute_values(cursor, flags_insert_query, flag_rows, template=FLAG_ROW_TEMPLATE, page_size=len(flag_rows))
+
+
+# Function to load a batch of emails with their senders, recipients and flags in a single transaction
+def load_email_batch_to_db(logger, email_rows, sender_rows, recipient_rows, flag_rows):
+    logger.info(f"Airflow - database/loadtoDB.py - load_email_batch_to_db() - Loading a batch of {len(email_rows)} emails into the database")
+
+    if not email_rows:
+        return
+
+    start_time = time.perf_counter()
+    email_ids = [email_row["id"] for email_row in email_rows]
+
+    try:
+        # Anything not committed is rolled back when the connection returns to the pool
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                insert_email_rows(logger, cursor, email_rows)
+                insert_sender_rows(logger, cursor, email_ids, sender_rows)
+                insert_recipient_rows(logger, cursor, email_ids, recipient_rows)
+                insert_flag_rows(logger, cursor, flag_rows)
+
             conn.commit()
-            logger.info("Airflow - database/loadtoDB.py - insert_sender_data() - Senders contents inserted successfully in SENDERS table")
-
-        except Exception as e:
-            logger.error(f"Airflow - database/loadtoDB.py - insert_sender_data() - Error inserting sender contents into the SENDERS table = {e}")
-            raise e
-        finally:
-            close_connection(conn, cursor)
-
-
-# Function to load recipient data
-def insert_recipient_data(logger, recipients_data):
-    logger.info("Airflow - database/loadtoDB.py - insert_recipient_data() - Loading recipients data into RECIPIENTS table")
-    logger.info("Airflow - database/loadtoDB.py - insert_recipient_data() - Creating database connection")
-
-    conn = create_connection_to_postgresql()
-
-    if conn:
-        try:
-            cursor = conn.cursor()
-            recipient_insert_query = f"""
-                    INSERT INTO recipients (
-                        id, email_id, type, email_address, name
-                    ) VALUES (
-                        %(id)s, %(email_id)s, %(type)s, %(email_address)s, %(name)s
-                    )
-                    ON CONFLICT (id) 
-                    DO UPDATE SET
-                        email_id = EXCLUDED.email_id,
-                        type = EXCLUDED.type,
-                        email_address = EXCLUDED.email_address,
-                        name = EXCLUDED.name
-                """
-
-            for recipient in recipients_data:
-                cursor.execute(recipient_insert_query, recipient)
+
+        elapsed = time.perf_counter() - start_time
+        total_rows = len(email_rows) + len(sender_rows) + len(recipient_rows) + len(flag_rows)
+        logger.info(f"Airflow - database/loadtoDB.py - load_email_batch_to_db() - Loaded {total_rows} rows ({len(email_rows)} emails) in {elapsed:.2f}s - {total_rows / max(elapsed, 1e-6):.0f} rows/sec")
+
+    except Exception as e:
+        logger.error(f"Airflow - database/loadtoDB.py - load_email_batch_to_db() - Error loading the batch of emails, transaction rolled back = {e}")
+        raise e
+
+
+# Function to fetch, in one query, the change keys stored for a batch of emails
+def fetch_stored_change_keys(logger, email_ids):
+    logger.info(f"Airflow - database/loadtoDB.py - fetch_stored_change_keys() - Fetching stored change keys of {len(email_ids)} emails")
+
+    change_keys_query = """
+        SELECT id, change_key, odata_etag, vector_indexed
+        FROM emails
+        WHERE id = ANY(%s)
+    """
+
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(change_keys_query, (list(email_ids),))
+
+        return {
+            email_id: {"change_key": change_key, "odata_etag": odata_etag, "vector_indexed": vector_indexed}
+            for email_id, change_key, odata_etag, vector_indexed in cursor.fetchall()
+        }
+
+
+# Function to check whether an email is stored and fully processed in the same version as the fetched one
+def is_email_unchanged(email_data, stored_email):
+    if not stored_email or not stored_email["vector_indexed"]:
+        return False
+
+    # changeKey changes with every modification of the message; the etag carries the same version
+    if email_data["change_key"]:
+        return email_data["change_key"] == stored_email["change_key"]
+
+    return bool(email_data["odata_etag"]) and email_data["odata_etag"] == stored_email["odata_etag"]
+
+
+# Function to flag emails whose embeddings and categories were created
+def mark_emails_indexed(logger, email_ids):
+    logger.info(f"Airflow - database/loadtoDB.py - mark_emails_indexed() - Marking {len(email_ids)} emails as indexed")
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("UPDATE emails SET vector_indexed = TRUE WHERE id = ANY(%s)", (list(email_ids),))
             conn.commit()
-            logger.info("Airflow - database/loadtoDB.py - insert_recipient_data() - RECIPIENTS contents inserted successfully in RECIPIENTS table")
-
-        except Exception as e:
-            logger.error(f"Airflow - database/loadtoDB.py - insert_recipient_data() - Error inserting RECIPIENTS contents into the RECIPIENTS table = {e}")
-            raise e
-        finally:
-            close_connection(conn, cursor)
-
-
-# Function to load flags data
-def insert_flags_data(logger, flags_data):
-    logger.info("Airflow - database/loadtoDB.py - insert_flags_data() - Loading flags data into FLAGS table")
-    logger.info("Airflow - database/loadtoDB.py - insert_flags_data() - Creating database connection")
-
-    conn = create_connection_to_postgresql()
-
-    if conn:
-        try:
-            cursor = conn.cursor()
-            flags_insert_query = f"""
-                    INSERT INTO flags (
-                        email_id, flag_status
-                    ) VALUES (
-                        %(email_id)s, %(flag_status)s
-                    )
-                    ON CONFLICT (email_id) 
-                    DO UPDATE SET
-                        flag_status = EXCLUDED.flag_status
-                """
-
-            cursor.execute(flags_insert_query, flags_data)
+
+    except Exception as e:
+        logger.error(f"Airflow - database/loadtoDB.py - mark_emails_indexed() - Error marking emails as indexed = {e}")
+
+
+# Function to delete emails (and the rows referencing them) removed from the mailbox.
+# When folder_id is given, only the emails still stored under that folder are deleted
+def delete_email_data(logger, email_ids, folder_id=None):
+    logger.info(f"Airflow - database/loadtoDB.py - delete_email_data() - Deleting {len(email_ids)} removed emails from the database")
+
+    # Tables referencing emails(id) must be cleared before the emails themselves
+    delete_queries = [
+        "DELETE FROM categories WHERE email_id = ANY(%s)",
+        "DELETE FROM flags WHERE email_id = ANY(%s)",
+        "DELETE FROM attachment_manifest WHERE email_id = ANY(%s)",
+        "DELETE FROM attachments WHERE email_id = ANY(%s)",
+        "DELETE FROM senders WHERE email_id = ANY(%s)",
+        "DELETE FROM recipients WHERE email_id = ANY(%s)",
+        "DELETE FROM emails WHERE id = ANY(%s)",
+    ]
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            email_ids = sorted(email_ids)
+
+            # A message moved to another folder is reported as removed from its old folder. The rows are
+            # locked so that a concurrent sync of the new folder either sees them deleted or moves them first
+            if folder_id:
+                cursor.execute(
+                    "SELECT id FROM emails WHERE id = ANY(%s) AND parent_folder_id = %s ORDER BY id FOR UPDATE",
+                    (email_ids, folder_id)
+                )
+                email_ids = [row[0] for row in cursor.fetchall()]
+
+            for delete_query in delete_queries:
+                cursor.execute(delete_query, (email_ids,))
+
             conn.commit()
-            logger.info("Airflow - database/loadtoDB.py - insert_flags_data() - FLAGS contents inserted successfully in FLAGS table")
+            logger.info("Airflow - database/loadtoDB.py - delete_email_data() - Removed emails deleted successfully")
 
-        except Exception as e:
-            logger.error(f"Airflow - database/loadtoDB.py - insert_flags_data() - Error inserting FLAGS contents into the FLAGS table = {e}")
-            raise e
-        finally:
-            close_connection(conn, cursor)
+    except Exception as e:
+        logger.error(f"Airflow - database/loadtoDB.py - delete_email_data() - Error deleting removed emails = {e}")
+        raise e
 
 
 # Function to save email categories
 def insert_category_data(logger, email_id, labels):
     logger.info("Airflow - database/loadtoDB.py - insert_category_data() - Loading email categories into the database")
 
-    conn = create_connection_to_postgresql()
+    categories_insert_query = """
+        INSERT INTO categories (
+            id, email_id, category
+        ) VALUES (
+            %s, %s, %s
+        )
+    """
 
-    if conn:
-        categories_insert_query = """
-            INSERT INTO categories (
-                id, email_id, category
-            ) VALUES (
-                %s, %s, %s  
-            )
-        """
-        
-        try:
-            if not labels:
-                raise ValueError("Labels is empty!")
+    try:
+        if not labels:
+            raise ValueError("Labels is empty!")
 
-            with conn.cursor() as cursor:
-                for label in labels:
-                    cursor.execute(categories_insert_query, (str(uuid.uuid4()), str(email_id), str(label),))
-                
-                conn.commit()
-                logger.info("Airflow - database/loadtoDB.py - insert_category_data() - Inserted email category into the database")
+        with db_connection() as conn, conn.cursor() as cursor:
+            # A modified email is labelled again, its new categories replace the previous ones
+            cursor.execute("DELETE FROM categories WHERE email_id = %s", (str(email_id),))
 
-        except Exception as e:
-            logger.error(f"Airflow - database/loadtoDB.py - insert_category_data() - Error inserting CATEGORY contents into the CATEGORY table = {e}")
+            for label in labels:
+                cursor.execute(categories_insert_query, (str(uuid.uuid4()), str(email_id), str(label),))
+
+            conn.commit()
+            logger.info("Airflow - database/loadtoDB.py - insert_category_data() - Inserted email category into the database")
+            return True
 
-        finally:
-            close_connection(conn)
+    except Exception as e:
+        logger.error(f"Airflow - database/loadtoDB.py - insert_category_data() - Error inserting CATEGORY contents into the CATEGORY table = {e}")
+        return False
 
 # Function to load emails info
 def load_email_info_to_db(logger, formatted_mail_responses, user_email):
     logger.info("Airflow - database/loadtoDB.py - load_email_info_to_db() - Loading mail information into the database")
 
+    batch = {}
+
     for email in formatted_mail_responses:
         # Email data
         email_data = {
@@ -368,25 +432,15 @@ def load_email_info_to_db(logger, formatted_mail_responses, user_email):
             "start_datetime_timezone"   : email.get("startDateTime", {}).get("timeZone", None) or None,
             "subject"                   : email.get("subject", None),
             "type"                      : email.get("type", None),
-            "web_link"                  : email.get("webLink", None)
+            "web_link"                  : email.get("webLink", None),
+            "owner_email"               : user_email
         }
 
         # Sender data
-        sender_info = email.get("sender", {}).get("emailAddress", None)
-
         # Sometimes, the emailAddress of the sender might be missing
         # Like for Calendar reminders, the sender address is empty
-        if sender_info:
-            try:
-                sender_dict = ast.literal_eval(sender_info)
-            
-            except Exception as exception:
-                logger.warning("Airflow - database/loadtoDB.py - load_email_info_to_db() - Sender email address seems to be missing. Defaulting to empty string.")
-                sender_dict = {}
-       
-        else:
-            sender_dict = {}
-        
+        sender_dict = (email.get("sender") or {}).get("emailAddress") or {}
+
         sender_data = {
             "id"            : str(uuid.uuid4()),
             "email_id"      : email.get("id", ""),
@@ -397,9 +451,8 @@ def load_email_info_to_db(logger, formatted_mail_responses, user_email):
         # Recipient data
         recipients_data = []
         for recipient_type, recipients_key in [("to", "toRecipients"), ("cc", "ccRecipients"), ("bcc", "bccRecipients")]:
-            for recipient in email.get(recipients_key, []):
-                recipient_info = recipient.get("emailAddress", "")
-                recipient_dict = ast.literal_eval(recipient_info)
+            for recipient in email.get(recipients_key) or []:
+                recipient_dict = recipient.get("emailAddress") or {}
                 recipients_data.append({
                     "id"            : str(uuid.uuid4()),
                     "email_id"      : email.get("id", ""),
@@ -414,27 +467,47 @@ def load_email_info_to_db(logger, formatted_mail_responses, user_email):
             "flag_status"   : email.get("flag", {}).get("flagStatus","")
         }
 
-        # Insert email data into Postgres
-        logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - Loading mail contents to EMAILS table in database")
-        insert_email_data(logger, email_data)
-        logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - Email contents uploaded to EMAILS table in database")
+        # Graph may return the same message twice while it is being modified; the last copy wins
+        batch[email_data["id"]] = (email_data, sender_data, recipients_data, flag_data)
 
-        # Insert sender data into Postgres
-        logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - Loading sender contents to SENDERS table in database")
-        insert_sender_data(logger, sender_data)
-        logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - Sender contents uploaded to SENDERS table in database")
+    # Emails stored in the same version and already indexed need neither a write, nor embeddings, nor labels
+    stored_emails = fetch_stored_change_keys(logger, list(batch))
+    unchanged_ids = [email_id for email_id, (email_data, _, _, _) in batch.items() if is_email_unchanged(email_data, stored_emails.get(email_id))]
 
-        # Insert recipient data into Postgres
-        logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - Loading recipient contents to RECIPIENTS table in database")
-        insert_recipient_data(logger, recipients_data)
-        logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - recipient contents uploaded to RECIPIENTS table in database")
+    for email_id in unchanged_ids:
+        del batch[email_id]
 
-        # Insert flag data into Postgres        
-        logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - Loading flags contents to FLAGS table in database")
-        insert_flags_data(logger, flag_data)
-        logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - flags contents uploaded to FLAGS table in database")
+    logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - {len(unchanged_ids)} unchanged mails skipped, {len(batch)} new or modified mails to load")
 
-        # Finally, index the email contents in Milvus
+    load_counts = {"loaded": len(batch), "skipped": len(unchanged_ids), "indexed": 0}
+    if not batch:
+        return load_counts
+
+    # Insert the whole batch into Postgres in a single transaction. Rows are written in id order,
+    # so that folders synced concurrently lock shared emails in the same order
+    batch = dict(sorted(batch.items()))
+
+    email_rows      = [email_data for email_data, _, _, _ in batch.values()]
+    sender_rows     = [sender_data for _, sender_data, _, _ in batch.values()]
+    recipient_rows  = [recipient for _, _, recipients_data, _ in batch.values() for recipient in recipients_data]
+    flag_rows       = [flag_data for _, _, _, flag_data in batch.values()]
+
+    # Drop the vectors of the earlier versions of indexed emails in one delete, so that an edited email is not indexed
+    # twice. It runs before the rows are written: if it fails, the emails are still flagged indexed for the retry
+    collection_name = get_collection_name(user_email)
+    reindexed_ids = [email_id for email_id in batch if (stored_emails.get(email_id) or {}).get("vector_indexed")]
+
+    if reindexed_ids:
+        logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - Deleting the vectors of {len(reindexed_ids)} modified mails")
+        delete_vectors(collection_name, "id", reindexed_ids)
+
+    load_email_batch_to_db(logger, email_rows, sender_rows, recipient_rows, flag_rows)
+    logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - Mail contents uploaded to the database")
+
+    indexed_ids = []
+    emails_to_index = []
+
+    for email_data, sender_data, _, _ in batch.values():
         data_to_index = {
             "subject"           : email_data["subject"],
             "body"              : email_data["body"],
@@ -454,7 +527,23 @@ def load_email_info_to_db(logger, formatted_mail_responses, user_email):
             "message_type"       : "email"
         }
 
-        create_embeddings_and_index(data_to_index=data_to_index, metadata=metadata)
+        emails_to_index.append((email_data, sender_data, data_to_index, metadata))
+
+    # Embed the chunks of the whole batch together, in as few requests as possible
+    email_chunks = [build_email_chunks(data_to_index) for _, _, data_to_index, _ in emails_to_index]
+    all_chunks = [chunk for chunks in email_chunks for chunk in chunks]
+    embeddings = embed_texts([content for content, _ in all_chunks], token_counts=[tokens for _, tokens in all_chunks])
+
+    first_chunk = 0
+    for (email_data, sender_data, data_to_index, metadata), chunks in zip(emails_to_index, email_chunks):
+        # Finally, index the email contents in Milvus
+        is_indexed = create_embeddings_and_index(
+            data_to_index = data_to_index,
+            metadata      = metadata,
+            chunks        = chunks,
+            embeddings    = embeddings[first_chunk:first_chunk + len(chunks)]
+        )
+        first_chunk += len(chunks)
         
         # Email Categorization
         cat_data = {
@@ -468,94 +557,72 @@ def load_email_info_to_db(logger, formatted_mail_responses, user_email):
 
         # Insert category data into Postgres        
         logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - Loading 'category' contents to CATEGORY table in database")
-        insert_category_data(logger, email_data["id"], categories)
+        is_labelled = insert_category_data(logger, email_data["id"], categories)
         logger.info(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - 'category' contents uploaded to CATEGORY table in database")
 
+        # Emails that failed to be indexed or labelled are processed again on the next sync
+        if is_indexed and is_labelled:
+            indexed_ids.append(email_data["id"])
+
+    # The vectors are written in bulk; the emails only count as indexed once theirs are in Milvus
+    if collection_name in vector_write_buffer.flush([collection_name]):
+        logger.error(f"Airflow - database/loadtoDB.py - load_email_info_to_db() - Vectors of {len(indexed_ids)} mails could not be written, they will be indexed on the next sync")
+        indexed_ids = []
+
+    if indexed_ids:
+        mark_emails_indexed(logger, indexed_ids)
+
+    load_counts["indexed"] = len(indexed_ids)
+    return load_counts
+
+
+# Function to fetch the users due for a sync: pending jobs first, then the ones not synced for a while
+def fetch_due_jobs(logger, max_users, sync_interval_minutes):
+    logger.info(f"Airflow - database/loadtoDB.py - fetch_due_jobs() - Fetching up to {max_users} jobs not processed in the last {sync_interval_minutes} minutes")
+
+    due_jobs = []
+
+    # A user can have several rows in queued_jobs, only the most urgent one is kept
+    due_jobs_query = """
+        SELECT email, refresh_token
+        FROM (
+            SELECT DISTINCT ON (u.email)
+                u.email,
+                u.refresh_token,
+                q.status,
+                q.updated_at
+            FROM queued_jobs q
+            JOIN users u ON u.email = q.email
+            WHERE q.status = 'pending'
+               OR (q.status = 'success' AND q.updated_at < CURRENT_TIMESTAMP - make_interval(mins => %s))
+            ORDER BY u.email, (q.status = 'pending') DESC, q.updated_at ASC
+        ) jobs
+        ORDER BY (status = 'pending') DESC, updated_at ASC
+        LIMIT %s;
+    """
 
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(due_jobs_query, (sync_interval_minutes, max_users))
 
-def fetch_new_job(logger):
-    logger.info("Airflow - database/loadtoDB.py - fetch_new_job() - Fetching job that has not been processed lately")
-
-    conn = create_connection_to_postgresql()
-    refresh_token = None
+            due_jobs = [
+                {"email": email, "refresh_token": refresh_token}
+                for email, refresh_token in cursor.fetchall()
+                if refresh_token
+            ]
+            logger.info(f"Airflow - database/loadtoDB.py - fetch_due_jobs() - Found {len(due_jobs)} jobs due for a sync")
 
-    if not conn:
-        logger.info("Airflow - database/loadtoDB.py - fetch_new_job() - Failed to connect to database")
-        
-        return refresh_token
-        
-    # If there are pending jobs in the table
-    fetching_pending_jobs_query = """
-        SELECT refresh_token 
-        FROM users 
-        WHERE email IN (
-            SELECT email 
-            FROM queued_jobs 
-            WHERE status = 'pending' 
-            ORDER BY updated_at ASC 
-            LIMIT 1
-        );
-    """
+    except Exception as e:
+        logger.error(f"Airflow - database/loadtoDB.py - fetch_due_jobs() - Error occurred while fetching due jobs: {e}")
 
-    # If there are no pending jobs in the table, then fetch the job marked
-    # 'success' that was not updated in a while
-    fetching_fresh_jobs_query = """
-        SELECT refresh_token 
-        FROM users 
-        WHERE email IN (
-            SELECT email 
-            FROM queued_jobs 
-            WHERE status = 'success' 
-            ORDER BY updated_at ASC 
-            LIMIT 1
-        );
-    """
+    return due_jobs
 
-    try:
-        with conn.cursor() as cursor:
-            logger.info("Airflow - database/loadtoDB.py - fetch_new_job() - Attempting to fetch job that is marked as pending")
-            
-            cursor.execute(fetching_pending_jobs_query)
-            result = cursor.fetchone()
-            
-            if result:
-                refresh_token = result[0]
-                logger.info("Airflow - database/loadtoDB.py - fetch_new_job() - Found a job marked as pending")
-            
-            else:
-                logger.info("Airflow - database/loadtoDB.py - fetch_new_job() - Found no jobs marked as pending")
-                logger.info("Airflow - database/loadtoDB.py - fetch_new_job() - Attempting to fetch job that was not updated recently")
-                
-                cursor.execute(fetching_fresh_jobs_query)
-                result = cursor.fetchone()
-                
-                if result:
-                    refresh_token = result[0]
-                    logger.info("Airflow - database/loadtoDB.py - fetch_new_job() - Found a job that was not updated recently")
-                
-                else:
-                    logger.warning("Airflow - database/loadtoDB.py - fetch_new_job() - No pending or fresh jobs found")
-                    refresh_token = None
-    
-    except Exception as e:
-        logger.error(f"Airflow - database/loadtoDB.py - Error occurred while fetching new job: {e}", )
-    
-    finally:
-        close_connection(conn)
-        return refresh_token
-    
 
 def update_job_timestamp(logger, email):
     logger.info("Airflow - database/loadtoDB.py - update_job_timestamp() - Updating job's updated_at timestamp")
 
-    conn = create_connection_to_postgresql()
     update_status = False
 
-    if not conn:
-        logger.info("Airflow - database/loadtoDB.py - update_job_timestamp() - Failed to connect to database")
-        
-        return update_status
-
     try:
         update_query = """
             UPDATE queued_jobs 
@@ -563,7 +630,7 @@ def update_job_timestamp(logger, email):
             WHERE email = %s;
         """
 
-        with conn.cursor() as cursor:
+        with db_connection() as conn, conn.cursor() as cursor:
             cursor.execute(update_query, (email,))
             
             if cursor.rowcount > 0:
@@ -579,7 +646,5 @@ def update_job_timestamp(logger, email):
     except Exception as e:
         logger.error(f"Error occurred while updating job's timestamp: {e}")
         update_status = False
-    
-    finally:
-        close_connection(conn)
-        return update_status
+
+    return update_status
@@ -1,4 +1,4 @@
-from database.connectDB import create_connection_to_postgresql, close_connection
+from database.connectDB import db_connection
 
 # Function to create tables in PostgreSQL database
 def create_tables_in_db(logger):
@@ -11,6 +11,10 @@ def create_tables_in_db(logger):
                 "drop_recipients_table"             : "DROP TABLE IF EXISTS recipients CASCADE;",
                 "drop_senders_table"                : "DROP TABLE IF EXISTS senders CASCADE;",
                 "drop_attachments_table"            : "DROP TABLE IF EXISTS attachments CASCADE;",
+                "drop_attachment_manifest_table"    : "DROP TABLE IF EXISTS attachment_manifest CASCADE;",
+                "drop_attachment_blobs_table"       : "DROP TABLE IF EXISTS attachment_blobs CASCADE;",
+                "drop_image_summaries_table"        : "DROP TABLE IF EXISTS image_summaries CASCADE;",
+                "drop_embedding_cache_table"        : "DROP TABLE IF EXISTS embedding_cache CASCADE;",
                 "drop_flags_table"                  : "DROP TABLE IF EXISTS flags CASCADE;",
                 "drop_categories_table"             : "DROP TABLE IF EXISTS categories CASCADE;",
                 "drop_email_links_table"            : "DROP TABLE IF EXISTS email_links CASCADE;",
@@ -70,8 +74,14 @@ def create_tables_in_db(logger):
                     subject TEXT DEFAULT NULL,
                     type VARCHAR(50) DEFAULT NULL,
                     web_link TEXT DEFAULT NULL,
-                    vector_indexed BOOLEAN DEFAULT FALSE
+                    vector_indexed BOOLEAN DEFAULT FALSE,
+                    owner_email VARCHAR(255) DEFAULT NULL,
+                    attachments_status VARCHAR(50) DEFAULT 'pending',
+                    attachments_attempts INT DEFAULT 0,
+                    attachments_processed_at TIMESTAMPTZ DEFAULT NULL
                 );
+                CREATE INDEX IF NOT EXISTS emails_attachment_work_idx ON emails (owner_email, id)
+                    WHERE has_attachments AND attachments_status <> 'done';
                 """,
                 "create_recipients_table": """
                 CREATE TABLE IF NOT EXISTS recipients (
@@ -90,6 +100,37 @@ def create_tables_in_db(logger):
                     name VARCHAR(255)
                 );
                 """,
+                "create_attachment_blobs_table": """
+                CREATE TABLE IF NOT EXISTS attachment_blobs (
+                    content_hash VARCHAR(64) PRIMARY KEY,
+                    size BIGINT,
+                    content_type TEXT,
+                    bucket_url TEXT,
+                    extraction_status VARCHAR(50) DEFAULT 'pending',
+                    extraction_attempts INT DEFAULT 0,
+                    extracted_text TEXT DEFAULT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                """,
+                "create_image_summaries_table": """
+                CREATE TABLE IF NOT EXISTS image_summaries (
+                    content_hash VARCHAR(64) PRIMARY KEY,
+                    image_hash VARCHAR(64),
+                    summary TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                """,
+                "create_embedding_cache_table": """
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    model VARCHAR(100),
+                    text_hash VARCHAR(64),
+                    embedding REAL[],
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (model, text_hash)
+                );
+                CREATE INDEX IF NOT EXISTS embedding_cache_last_used_at_idx ON embedding_cache (last_used_at);
+                """,
                 "create_attachments_table": """
                 CREATE TABLE IF NOT EXISTS attachments (
                     id VARCHAR(255) PRIMARY KEY,
@@ -97,9 +138,25 @@ def create_tables_in_db(logger):
                     name TEXT,
                     content_type TEXT,
                     size BIGINT,
-                    bucket_url TEXT
+                    bucket_url TEXT,
+                    content_hash VARCHAR(64) REFERENCES attachment_blobs(content_hash)
                 );
                 """,
+                "create_attachment_manifest_table": """
+                CREATE TABLE IF NOT EXISTS attachment_manifest (
+                    attachment_id VARCHAR(255) PRIMARY KEY,
+                    email_id VARCHAR(255) REFERENCES emails(id),
+                    user_email VARCHAR(255),
+                    content_hash VARCHAR(64) DEFAULT NULL,
+                    size BIGINT,
+                    last_modified VARCHAR(50) DEFAULT NULL,
+                    extraction_status VARCHAR(50) DEFAULT 'pending',
+                    embedding_status VARCHAR(50) DEFAULT 'pending',
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE INDEX IF NOT EXISTS attachment_manifest_email_id_idx ON attachment_manifest (email_id);
+                CREATE INDEX IF NOT EXISTS attachment_manifest_user_hash_idx ON attachment_manifest (user_email, content_hash);
+                """,
                 "create_flags_table": """
                 CREATE TABLE IF NOT EXISTS flags (
                     email_id VARCHAR(255) PRIMARY KEY REFERENCES emails(id),
@@ -126,9 +183,11 @@ def create_tables_in_db(logger):
                 "create_email_links_table": """
                     CREATE TABLE IF NOT EXISTS email_links (
                         id VARCHAR(255) PRIMARY KEY,
-                        email VARCHAR(255) UNIQUE,
+                        email VARCHAR(255),
+                        folder_id VARCHAR(255) DEFAULT NULL,
                         current_link TEXT DEFAULT NULL,
                         next_link TEXT DEFAULT NULL,
+                        delta_link TEXT DEFAULT NULL,
                         is_current_link_processed BOOLEAN DEFAULT FALSE,
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
@@ -137,6 +196,7 @@ def create_tables_in_db(logger):
                 "create_email_folders_table": """
                     CREATE TABLE email_folders (
                         id VARCHAR(255) PRIMARY KEY,
+                        user_id VARCHAR(255),
                         display_name VARCHAR(255) NOT NULL,
                         parent_folder_id VARCHAR(255),
                         child_folder_count INT DEFAULT 0,
@@ -151,11 +211,8 @@ def create_tables_in_db(logger):
             },
     }
 
-    conn = create_connection_to_postgresql()
-
-    if conn:
-        try:
-            cursor = conn.cursor()
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
             logger.info("Airflow - POSTGRESQL - database/setupTables.py - create_tables_in_db() - DB Connection & cursor created successfully")
 
             # Execute drop table queries
@@ -185,9 +242,5 @@ def create_tables_in_db(logger):
             conn.commit()
             logger.info(f"Airflow - POSTGRESQL - database/setupTables.py - create_tables_in_db() - All tables dropped and created successfully")
 
-        except Exception as e:
-            logger.error(f"Airflow - POSTGRESQL - database/setupTables.py - create_tables_in_db() - Error executing table queries: {e}")
-
-        finally:
-            close_connection(conn, cursor)
-            logger.info(f"Airflow - POSTGRESQL - database/setupTables.py - create_tables_in_db() - Connection to the DB closed")    
+    except Exception as e:
+        logger.error(f"Airflow - POSTGRESQL - database/setupTables.py - create_tables_in_db() - Error executing table queries: {e}")
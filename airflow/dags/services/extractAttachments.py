@@ -1,60 +1,18 @@
 import os
-import json
-import csv
-import boto3
-
+import io
+import resource
+import multiprocessing
 
+from services.logger import start_logger
 from services.extractFileContents import parse_images, parse_csv_files, parse_word_file, parse_txt_files, parse_excel_files, parse_pdf_files
-from services.processEmails import save_emails_to_json_file
-from services.vectors import embed_email_attachments
-
-# Function to create directories
-def create_local_directory(logger, directory_path):
-    directory_path = normalize_path(directory_path)
-    
-    if not os.path.exists(directory_path):
-        os.makedirs(directory_path)
-        logger.info(f"Created directory: {directory_path}")
-
-
-# Function to normalize file paths
-def normalize_path(file_path):
-    return os.path.normpath(file_path)
-
-# Function to download attachments from S3
-def download_attachments_from_s3(logger, user_email, email_id, s3_bucket_name):
-    logger.info(f"Downloading attachments for email ID: {email_id} from S3.")
-    
-    s3_client = boto3.client("s3")
-    base_download_dir = os.path.join(os.getcwd(), os.getenv("DOWNLOAD_DIRECTORY"), f"{user_email}/{email_id}")
-    logger.info(f"Downloading attachments for email ID: {email_id} from S3. to {base_download_dir}")
-    base_s3_prefix = f"{user_email}/{email_id}/attachments"
-    
-    try:
-        response = s3_client.list_objects_v2(Bucket=s3_bucket_name, Prefix=base_s3_prefix)
-        
-        if "Contents" not in response:
-            logger.info(f"No attachments found in S3 for email ID: {email_id}.")
-            return
-        
-        for obj in response["Contents"]:
-            key = obj["Key"]
-            relative_path = key[len(base_s3_prefix):].lstrip("/")
-            local_file_path = os.path.join(base_download_dir, relative_path)
-            create_local_directory(logger, os.path.dirname(local_file_path))
-            
-            if os.path.exists(local_file_path):
-                logger.info(f"File already exists locally: {local_file_path}. Skipping download.")
-                continue
-            
-            s3_client.download_file(s3_bucket_name, key, local_file_path)
-            logger.info(f"Downloaded {key} to {local_file_path}")
-    
-    except Exception as e:
-        logger.error(f"Failed to download attachments for email ID: {email_id}. Error: {e}")
 
+# Function to check whether an attachment is an image; images are summarised by the OpenAI API rather than parsed
+def is_image_file(file_path):
+    return os.path.splitext(file_path)[-1].lower() in (".png", ".jpg", ".jpeg")
 
-def extract_contents_from_file(logger, file_path):
+# Function to extract the text of an attachment, from its spooled contents (file_obj) or from the file at file_path.
+# file_path also names the file, its extension selects the parser. Returns None when the file cannot be parsed
+def extract_contents_from_file(logger, file_path, file_obj=None):
     file_extension = os.path.splitext(file_path)[-1].lower()  # Get file extension
     content = ""
 
@@ -70,102 +28,92 @@ def extract_contents_from_file(logger, file_path):
     try:
         if file_extension in file_extensions["PDFs"]:
             logger.info("Parsing PDF file")
-            content = parse_pdf_files(logger, file_path)
+            content = parse_pdf_files(logger, file_path, file_obj)
         
         elif file_extension in file_extensions["Images"]:
             logger.info("Parsing Image file")
-            content = parse_images(logger, file_path)
+            content = parse_images(logger, file_path, file_obj)
         
         elif file_extension in file_extensions["Docs"]:
             logger.info("Parsing Document file")
-            content = parse_word_file(logger, file_path)
+            content = parse_word_file(logger, file_path, file_obj)
         
         elif file_extension in file_extensions["TextFiles"]:
             logger.info("Parsing Text file")
-            content = parse_txt_files(logger, file_path)
+            content = parse_txt_files(logger, file_path, file_obj)
         
         elif file_extension in file_extensions["SpreadSheets"]:
             logger.info("Parsing Spreadsheet file")
-            content = parse_excel_files(logger, file_path)
+            content = parse_excel_files(logger, file_path, file_obj)
         
         elif file_extension in file_extensions["CSVFiles"]:
             logger.info("Parsing CSV file")
-            content = parse_csv_files(logger, file_path)
+            content = parse_csv_files(logger, file_path, file_obj)
         
         else:
             logger.warning(f"Unsupported file type: {file_extension}")
-            content = f"Unsupported file type: {file_extension}"
+            content = None
     
+    except MemoryError:
+        # Raised in the extraction process once it reaches its memory limit, reported as a failed extraction
+        raise
+
     except Exception as e:
-        content = f"Error processing file {file_path}: {str(e)}"
+        logger.error(f"Error processing file {file_path}: {e}")
+        content = None
     
     return content
 
 
-def extract_filepaths_with_attachments(logger, download_dir):
-    logger.info(f"Airflow - services/extractAttachments.py - extract_filepaths_with_attachments() - Extracting files with attachments")
-    
-    extracted_data = []
-    # Walk through the base directory
-    email_ids = os.listdir(download_dir)
+# Parsers run in child processes started by a fork server: forking the Airflow worker itself
+# would copy locks held by its other threads (logging, connection pool) into the child
+extraction_context = multiprocessing.get_context("forkserver")
+extraction_context.set_forkserver_preload(["services.extractAttachments"])
 
-    for email_id in email_ids:
-        # downloads/email_id
-        email_dir = os.path.join(download_dir, email_id)
-        
-        if not os.path.isdir(email_dir):
-            continue
-        emails = os.listdir(email_dir)
-
-        for email in emails:
-            # downloads/email_id/mail_id
-            mails_dir = os.path.join(email_dir, email)
-            
-            if not os.path.isdir(mails_dir):
-                continue
-            file_types = os.listdir(mails_dir)
-
-            for file_type in file_types:
-                # downloads/email_id/mail_id/file_type
-                file_types_dir = os.path.join(mails_dir,file_type)
-                
-                if not os.path.isdir(file_types_dir):
-                    continue
-                files = os.listdir(file_types_dir)
-
-                if files:
-                    for file in files:
-                        # downloads/email_id/mail_id/file_type/filename.ext
-                        file_path = os.path.join(file_types_dir, file)
-                        
-                        logger.info(f"Airflow - services/extractAttachments.py - extract_filepaths_with_attachments() - Processing file: {file_path}")
-                        content = extract_contents_from_file(logger, file_path)
-                        logger.info(f"Extracted contents from {file} is {content}")
-
-                        extracted_data.append({
-                            "email_id"  : email_id,
-                            "email"     : email,
-                            "file_type" : file_type,
-                            "file"      : file,
-                            "content"   : content
-                        })
-                else:
-                    continue
-            else:
-                continue
-    return extracted_data
-
-def extract_contents_from_attachments(logger):
-    logger.info(f"Airflow - services/extractAttachments.py - extract_contents_from_attachments() - Extracting contents from email attachments")
-    
-    download_dir = os.path.join(os.getcwd(), os.getenv("DOWNLOAD_DIRECTORY"))
-    
-    # If no attachments were found, the DOWNLOAD_DIRECTORY won't exist
-    if not os.path.isdir(download_dir):
-        logger.warning(f"Airflow - services/extractAttachments.py - extract_contents_from_attachments() - No attachments were found so far")
-        return
+# Function run in the child process: caps its address space, then extracts the contents
+# from source (the attachment bytes, or the path of the file holding them) and sends them back
+def run_extraction_process(result_pipe, file_name, source, memory_limit_mb):
+    if memory_limit_mb > 0:
+        memory_limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
 
-    extracted_data = extract_filepaths_with_attachments(logger, download_dir)
-    
-    save_emails_to_json_file(logger, extracted_data, "extracted_contents.json")
-    embed_email_attachments(filename="extracted_contents.json")
\ No newline at end of file
+    logger = start_logger()
+
+    if isinstance(source, bytes):
+        content = extract_contents_from_file(logger, file_name, io.BytesIO(source))
+    else:
+        with open(source, "rb") as file_obj:
+            content = extract_contents_from_file(logger, file_name, file_obj)
+
+    result_pipe.send(content)
+    result_pipe.close()
+
+# Function to extract the contents of an attachment in a child process, bounded by EXTRACTION_TIMEOUT_SECONDS and
+# EXTRACTION_MEMORY_LIMIT_MB. Returns None when parsing fails, or when the child times out or dies, e.g. on a pathological workbook
+def extract_contents_in_subprocess(logger, file_name, source):
+    timeout = float(os.getenv("EXTRACTION_TIMEOUT_SECONDS", "120"))
+    memory_limit_mb = int(os.getenv("EXTRACTION_MEMORY_LIMIT_MB", "2048"))
+
+    receiver, sender = extraction_context.Pipe(duplex=False)
+    process = extraction_context.Process(target=run_extraction_process, args=(sender, file_name, source, memory_limit_mb))
+    process.start()
+    sender.close()
+
+    try:
+        # poll() also returns when the child exits without sending anything, recv() then raises EOFError
+        if not receiver.poll(timeout):
+            logger.error(f"Airflow - services/extractAttachments.py - extract_contents_in_subprocess() - Extraction of {file_name} timed out after {timeout:.0f}s")
+            return None
+
+        return receiver.recv()
+
+    except EOFError:
+        process.join()
+        logger.error(f"Airflow - services/extractAttachments.py - extract_contents_in_subprocess() - Extraction of {file_name} failed, the process exited with code {process.exitcode}")
+        return None
+
+    finally:
+        receiver.close()
+        if process.is_alive():
+            process.kill()
+        process.join()
@@ -1,8 +1,13 @@
 import os
+import io
 import csv
 import json
+import time
 import base64
+import hashlib
 import openai
+import threading
+from contextlib import closing, contextmanager
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage
@@ -11,16 +16,103 @@ from docx import Document
 import mammoth
 from openpyxl import load_workbook
 import fitz
+from PIL import Image
+
+from database.connectDB import db_connection
 
 # Loading environment variables
 load_dotenv()
 
-# Sub function to convert images to base64
-def encode_image_to_base64(logger, image_path):
+# Function to open the input of a parser in binary mode: the file object when one is given
+# (e.g. an attachment spooled at ingest time), otherwise the file at file_path
+@contextmanager
+def open_binary(file_path, file_obj=None):
+    if file_obj is None:
+        with open(file_path, "rb") as file:
+            yield file
+    else:
+        file_obj.seek(0)
+        yield file_obj
+
+# Function to join the text chunks yielded by a streaming extractor, stopping once EXTRACTION_MAX_CHARS characters
+# are collected. Chunks are gathered in a list and joined once, so the cost stays linear in the size of the output
+def join_text_chunks(chunks, separator="\n"):
+    max_chars = int(os.getenv("EXTRACTION_MAX_CHARS", "1000000"))
+    parts = []
+    total_chars = 0
+
+    for chunk in chunks:
+        if total_chars + len(chunk) > max_chars:
+            parts.append(chunk[:max_chars - total_chars])
+            break
+
+        parts.append(chunk)
+        total_chars += len(chunk) + len(separator)
+
+    return separator.join(parts)
+
+# Spaces the requests of all the threads of this process at a fixed rate
+class RateLimiter:
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self.next_request_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.next_request_at - now)
+            self.next_request_at = max(now, self.next_request_at) + self.interval
+
+        if delay:
+            time.sleep(delay)
+
+image_summary_limiter = RateLimiter(int(os.getenv("IMAGE_SUMMARY_REQUESTS_PER_MINUTE", "60")))
+
+# Chat client shared by every image summary, created on first use
+image_chat = None
+image_chat_lock = threading.Lock()
+
+def get_image_chat():
+    global image_chat
+
+    with image_chat_lock:
+        if image_chat is None:
+            image_chat = ChatOpenAI(
+                model       = "gpt-4o", 
+                max_tokens  = 1024,
+                api_key     = os.getenv("OPENAI_API_KEY")
+            )
+
+        return image_chat
+
+# Function to compute the perceptual (difference) hash of an image: the same logo saved at another size,
+# quality or format gets the same hash, unlike a hash of the file contents. Images sharing a layout (charts
+# of one template, scanned forms) get the same hash too, so it is only recorded, never used as a cache key
+def perceptual_hash(image, hash_size=16):
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+# Sub function to convert images to base64, downscaled to IMAGE_MAX_DIMENSION pixels and re-encoded as JPEG
+def encode_image_to_base64(logger, image):
     logger.info(f"Ariflow - encode_image_to_base64 - Encoding image to base64")
     try:
-        with open(image_path, 'rb') as img_file:
-            img_base64 = base64.b64encode(img_file.read()).decode('utf-8')
+        max_dimension = int(os.getenv("IMAGE_MAX_DIMENSION", "1024"))
+
+        image = image.convert("RGB")
+        image.thumbnail((max_dimension, max_dimension))
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=85)
+        img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
         logger.info(f"Ariflow - encode_image_to_base64 - Image encoded to base64 successfully")
         return img_base64
     except Exception as e:
@@ -31,14 +123,9 @@ def encode_image_to_base64(logger, image_path):
 def image_summarize(logger, img_base64, prompt):
     logger.info(f"Ariflow - image_summarize - Summarizing image with GPT")
     try:
+        image_summary_limiter.wait()
 
-        chat = ChatOpenAI(
-            model       = "gpt-4o", 
-            max_tokens  = 1024,
-            api_key     = os.getenv("OPENAI_API_KEY")
-        )
-
-        msg = chat.invoke(
+        msg = get_image_chat().invoke(
             [
                 HumanMessage(
                     content=[
@@ -61,8 +148,36 @@ def image_summarize(logger, img_base64, prompt):
             logger.error(f"Ariflow - image_summarize - Error generating summary with GPT-4o: {e}")
             return None
 
+# Function to fetch the cached summary of an image, by the SHA-256 of its file contents
+def fetch_image_summary(logger, content_hash):
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT summary FROM image_summaries WHERE content_hash = %s", (content_hash,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    except Exception as e:
+        logger.error(f"Ariflow - fetch_image_summary - Error fetching image summary: {e}")
+        return None
+
+# Function to cache the summary of an image, with its perceptual hash
+def save_image_summary(logger, content_hash, image_hash, summary):
+    insert_query = """
+        INSERT INTO image_summaries (content_hash, image_hash, summary)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (content_hash) DO NOTHING
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(insert_query, (content_hash, image_hash, summary))
+            conn.commit()
+
+    except Exception as e:
+        logger.error(f"Ariflow - save_image_summary - Error saving image summary: {e}")
+
 # Function to parse images and extract contents
-def parse_images(logger, image_path):
+def parse_images(logger, image_path, file_obj=None):
     logger.info(f"Ariflow - parse_images - Generating summaries for images in {image_path}")
     prompt = (
         "You are an assistant tasked with summarizing images for retrieval via RAGs. "
@@ -70,95 +185,169 @@ def parse_images(logger, image_path):
         "Give a concise summary of the image that is well optimized for retrieval via RAGs."
     )
     
-    if os.path.isfile(image_path):
+    if file_obj is not None or os.path.isfile(image_path):
         logger.info(f"Ariflow - parse_images - Processing image")
 
+        try:
+            with open_binary(image_path, file_obj) as img_file:
+                # Same key as attachment_blobs, so that only identical files share a cached summary
+                sha256 = hashlib.sha256()
+                for block in iter(lambda: img_file.read(1024 * 1024), b""):
+                    sha256.update(block)
+                content_hash = sha256.hexdigest()
+
+                img_file.seek(0)
+                image = Image.open(img_file)
+                image.load()
+        except Exception as e:
+            logger.error(f"Ariflow - parse_images - Error opening image {image_path}: {e}")
+            return None
+
+        # Icons, spacers and tracking pixels carry nothing worth summarizing
+        min_dimension = int(os.getenv("IMAGE_MIN_DIMENSION", "64"))
+        if min(image.size) < min_dimension:
+            logger.info(f"Ariflow - parse_images - Skipping image {image_path} of {image.size[0]}x{image.size[1]} pixels")
+            return ""
+
+        cached_summary = fetch_image_summary(logger, content_hash)
+        if cached_summary:
+            logger.info(f"Ariflow - parse_images - Reusing the cached summary of image {image_path}")
+            return cached_summary
+
         # Encode image to base64
-        image_base64 = encode_image_to_base64(logger, image_path)
+        image_base64 = encode_image_to_base64(logger, image)
         if image_base64:
             image_summary = image_summarize(logger, image_base64, prompt)
             logger.info(f"Ariflow - parse_images - Image {image_path} summary: {image_summary}")
         
             if image_summary:
+                save_image_summary(logger, content_hash, perceptual_hash(image), image_summary)
                 return image_summary
             else:
-                return "Failed to summarize image"
+                logger.error(f"Ariflow - parse_images - Failed to summarize image {image_path}")
+                return None
         else:
-            return f"Failed to encode image {image_path}"
+            logger.error(f"Ariflow - parse_images - Failed to encode image {image_path}")
+            return None
+
+# Function to yield the rows of a CSV file as text, one row at a time, up to CSV_MAX_ROWS rows
+def iter_csv_text(csv_file_path, file_obj=None):
+    max_rows = int(os.getenv("CSV_MAX_ROWS", "100000"))
+
+    # Open the CSV file for reading
+    with open_binary(csv_file_path, file_obj) as binary_file:
+        file = io.TextIOWrapper(binary_file, encoding="utf-8", errors="replace", newline="")
+
+        try:
+            csv_reader = csv.reader(file)
+            for row_number, row in enumerate(csv_reader):
+                if row_number >= max_rows:
+                    break
+                yield ", ".join(row)
+        finally:
+            # Leave the binary file open, its owner closes it
+            file.detach()
 
 # Function to parse CSV files and extract contents
-def parse_csv_files(logger, csv_file_path):
+def parse_csv_files(logger, csv_file_path, file_obj=None):
     logger.info(f"Ariflow - parse_csv_files - Extarcting contents from csv file: {csv_file_path}")
 
     extracted_contents = ""
 
     try:
-        # Open the CSV file for reading
-        with open(csv_file_path, 'r') as file:
-            csv_reader = csv.reader(file)
-            for row in csv_reader:
-                # Join the row contents and append to the extracted contents
-                extracted_contents += ", ".join(row) + "\n"
+        with closing(iter_csv_text(csv_file_path, file_obj)) as chunks:
+            extracted_contents = join_text_chunks(chunks)
     except Exception as e:
-        logger.error(f"Airflow - parse_csv_files - Error processing CSV file: {e}")
-        extracted_contents = f"Error processing CSV file {csv_file_path}: {str(e)}"
+        logger.error(f"Airflow - parse_csv_files - Error processing CSV file {csv_file_path}: {e}")
+        extracted_contents = None
 
     return extracted_contents
 
 # Parsing Word Document files
-def parse_word_file(logger, file_path):
+def parse_word_file(logger, file_path, file_obj=None):
     try:
         file_extension = os.path.splitext(file_path)[-1].lower()
 
         if file_extension == ".docx":
             # Use python-docx for .docx files
-            doc = Document(file_path)
+            with open_binary(file_path, file_obj) as docx_file:
+                doc = Document(docx_file)
             content = "\n".join([para.text for para in doc.paragraphs])
         elif file_extension == ".doc":
             # Use mammoth for .doc files
-            with open(file_path, "rb") as doc_file:
+            with open_binary(file_path, file_obj) as doc_file:
                 result = mammoth.extract_raw_text(doc_file)
                 content = result.value  # Extracted text
         else:
-            content = f"Unsupported file type: {file_extension}"
+            logger.error(f"Airflow - parse_word_file - Unsupported file type: {file_extension}")
+            content = None
     except Exception as e:
-        content = f"Error parsing file {file_path}: {str(e)}"
+        logger.error(f"Airflow - parse_word_file - Error parsing file {file_path}: {e}")
+        content = None
 
     return content
 
 # Parsing txt files
-def parse_txt_files(logger, file_path):
+def parse_txt_files(logger, file_path, file_obj=None):
     try:
-        with open(file_path, "r", encoding="utf-8") as txt_file:
-            content = txt_file.read()
+        with open_binary(file_path, file_obj) as txt_file:
+            content = txt_file.read().decode("utf-8")
         return content
     except Exception as e:
-        return f"Error parsing file {file_path}: {str(e)}"
+        logger.error(f"Airflow - parse_txt_files - Error parsing file {file_path}: {e}")
+        return None
     
 
+# Function to yield the rows of a workbook as text, sheet by sheet, up to SPREADSHEET_MAX_ROWS rows per sheet.
+# Read-only mode streams the rows from the archive instead of building every cell of the workbook in memory
+def iter_excel_text(file_path, file_obj=None):
+    max_rows = int(os.getenv("SPREADSHEET_MAX_ROWS", "100000"))
+
+    with open_binary(file_path, file_obj) as excel_file:
+        workbook = load_workbook(excel_file, read_only=True, data_only=True)
+
+        try:
+            for sheet in workbook.worksheets:
+                yield f"Sheet: {sheet.title}"
+                for row in sheet.iter_rows(values_only=True, max_row=max_rows):
+                    yield ", ".join([str(cell) if cell is not None else "" for cell in row])
+        finally:
+            # Read-only workbooks keep the archive open until closed
+            workbook.close()
+
 # Parsing Spreadsheets
-def parse_excel_files(logger, file_path):
+def parse_excel_files(logger, file_path, file_obj=None):
     try:
-        workbook = load_workbook(file_path, data_only=True)
-        content = ""
-        for sheet_name in workbook.sheetnames:
-            sheet = workbook[sheet_name]
-            content += f"Sheet: {sheet_name}\n"
-            for row in sheet.iter_rows(values_only=True):
-                content += ", ".join([str(cell) if cell is not None else "" for cell in row]) + "\n"
-        return content.strip()
+        with closing(iter_excel_text(file_path, file_obj)) as chunks:
+            return join_text_chunks(chunks).strip()
     except Exception as e:
-        return f"Error parsing XLSX file {file_path}: {str(e)}"
+        logger.error(f"Airflow - parse_excel_files - Error parsing XLSX file {file_path}: {e}")
+        return None
 
+# Function to yield the text of a PDF page by page, up to PDF_MAX_PAGES pages
+def iter_pdf_text(file_path, file_obj=None):
+    max_pages = int(os.getenv("PDF_MAX_PAGES", "500"))
 
-def parse_pdf_files(logger, file_path):
-    try:
+    # Files on disk are opened by path, PyMuPDF then loads the pages it reads instead of the whole document
+    if file_obj is not None and isinstance(getattr(file_obj, "name", None), str) and os.path.isfile(file_obj.name):
+        file_path, file_obj = file_obj.name, None
+
+    if file_obj is None:
         pdf_document = fitz.open(file_path)
-        content = ""
-        for page_num in range(len(pdf_document)):
-            page = pdf_document[page_num]
-            content += page.get_text()
+    else:
+        file_obj.seek(0)
+        pdf_document = fitz.open(stream=file_obj.read(), filetype="pdf")
+
+    try:
+        for page_num in range(min(len(pdf_document), max_pages)):
+            yield pdf_document[page_num].get_text()
+    finally:
         pdf_document.close()
-        return content.strip()
+
+def parse_pdf_files(logger, file_path, file_obj=None):
+    try:
+        with closing(iter_pdf_text(file_path, file_obj)) as chunks:
+            return join_text_chunks(chunks, separator="").strip()
     except Exception as e:
-        return f"Error parsing PDF file {file_path}: {str(e)}"
\ No newline at end of file
+        logger.error(f"Airflow - parse_pdf_files - Error parsing PDF file {file_path}: {e}")
+        return None
\ No newline at end of file
@@ -0,0 +1,25 @@
+import time
+import requests
+
+# Status codes for which Microsoft Graph asks the client to back off and retry
+RETRYABLE_STATUS_CODES = {429, 503, 504}
+
+# Function to send a GET request to Microsoft Graph API, honouring throttling responses
+def graph_get(logger, url, headers, timeout=60, max_attempts=5, **kwargs):
+    attempt = 1
+
+    while True:
+        response = requests.get(url, headers=headers, timeout=timeout, **kwargs)
+
+        if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= max_attempts:
+            response.raise_for_status()
+            return response
+
+        # Graph sends Retry-After (in seconds) with throttled responses; fall back to exponential back-off
+        retry_after = response.headers.get("Retry-After")
+        delay = int(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+
+        logger.warning(f"Airflow - services/graphRequests.py - graph_get() - Received status {response.status_code}, retrying in {delay} seconds ({attempt}/{max_attempts})")
+        response.close()
+        time.sleep(delay)
+        attempt += 1
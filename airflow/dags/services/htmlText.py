@@ -0,0 +1,111 @@
+import os
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+    PARSER_ERRORS = (ValueError, etree.ParserError)
+except ImportError:
+    lxml_html = None
+    PARSER_ERRORS = (ValueError,)
+
+# Elements whose text BeautifulSoup leaves out of get_text()
+NON_TEXT_TAGS = {"script", "style", "template", "rt", "rp"}
+
+# Function to resolve the URL of a link, preferring the one Outlook kept before rewriting it (Safe Links)
+def get_link_href(attributes):
+    return attributes.get("originalsrc") or attributes.get("href")
+
+# Function to extract text and inline links with BeautifulSoup's html.parser
+def extract_with_bs4(html_content, max_links):
+    soup = BeautifulSoup(html_content, 'html.parser')
+
+    # Replace <a> tags with their text and link inline (e.g., "Text (URL)")
+    for a_tag in soup.find_all('a', href=True, limit=max_links):
+        link_text = a_tag.get_text(strip=True)
+        a_tag.replace_with(f"{link_text} ({get_link_href(a_tag)})")
+
+    # Extract the cleaned text
+    return soup.get_text(separator='\n', strip=True)
+
+# Function to yield the text nodes of an lxml subtree in document order, the way BeautifulSoup sees them.
+# When on_link is given, each <a href> is replaced by the single string it returns
+def iter_lxml_strings(root, on_link=None):
+    walker = etree.iterwalk(root, events=("start", "end", "comment", "pi"))
+
+    for event, element in walker:
+        if event in ("comment", "pi"):
+            yield element.tail
+            continue
+
+        if event == "end":
+            # The root's tail lies outside of the subtree
+            if element is not root:
+                yield element.tail
+            continue
+
+        if element.tag in NON_TEXT_TAGS:
+            walker.skip_subtree()
+
+        elif on_link and element.tag == "a" and element.get("href") is not None:
+            link = on_link(element)
+
+            if link is None:
+                yield element.text
+            else:
+                yield link
+                walker.skip_subtree()
+
+        else:
+            yield element.text
+
+# Function to extract text and inline links with lxml, walking the tree once without modifying it
+def extract_with_lxml(html_content, max_links):
+    root = lxml_html.document_fromstring(html_content)
+    links_found = 0
+
+    def format_link(anchor):
+        nonlocal links_found
+
+        if links_found >= max_links:
+            return None
+
+        links_found += 1
+        link_text = "".join(text.strip() for text in iter_lxml_strings(anchor) if text)
+        return f"{link_text} ({get_link_href(anchor.attrib)})"
+
+    strings = (text.strip() for text in iter_lxml_strings(root, on_link=format_link) if text)
+    return "\n".join(text for text in strings if text)
+
+EXTRACTORS = {
+    "bs4"  : extract_with_bs4,
+    "lxml" : extract_with_lxml,
+}
+
+# Function to pick the configured extractor, falling back to BeautifulSoup when lxml is not installed
+def get_extractor(backend=None):
+    backend = (backend or os.getenv("HTML_EXTRACTOR_BACKEND", "lxml")).lower()
+
+    if backend == "lxml" and lxml_html is None:
+        backend = "bs4"
+
+    return EXTRACTORS.get(backend, extract_with_bs4)
+
+# Function to convert an HTML email body to text, with links inlined as "Text (URL)"
+def extract_text_and_links(html_content, backend=None):
+    if not html_content or not html_content.strip():
+        return ""
+
+    max_chars = int(os.getenv("HTML_MAX_CHARS", "1000000"))
+    max_links = int(os.getenv("HTML_MAX_LINKS", "500"))
+
+    # Oversized bodies are cut before parsing; links beyond the cap are kept as plain text
+    html_content = html_content[:max_chars]
+    extractor = get_extractor(backend)
+
+    try:
+        return extractor(html_content, max_links)
+
+    except PARSER_ERRORS:
+        # e.g. lxml refuses unicode input carrying an XML encoding declaration
+        return extract_with_bs4(html_content, max_links)
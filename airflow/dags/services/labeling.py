@@ -80,28 +80,23 @@ def label_email(email_dict: dict):
     
     labels = []
     reply_to_addresses = ""
-    reply_to_list = None
     
     email_addresses = []
     email_dict["body"] = replace_urls(email_dict["body"])
 
     try:
+        # reply_to is stored as the JSON list of Graph recipients: [{"emailAddress": {"name": ..., "address": ...}}]
         if email_dict['reply_to']:
-            reply_to_list = json.loads(str(email_dict['reply_to']))[0]
+            reply_to_list = email_dict['reply_to']
 
-            # Loop through the list and parse each emailAddress field
-            if len(reply_to_list) > 1:
-                
-                for item in reply_to_list:
-                    for key, val in item.items():
-                        
-                        contents = json.loads(str(val).replace("'", '"'))
-                        email_addresses.append(contents["address"])
-            else:
-                for key, val in reply_to_list.items():
-                    
-                    contents = json.loads(str(val).replace("'", '"'))
-                    email_addresses.append(contents["address"])
+            if isinstance(reply_to_list, str):
+                reply_to_list = json.loads(reply_to_list)
+
+            for recipient in reply_to_list:
+                address = (recipient.get("emailAddress") or {}).get("address")
+
+                if address:
+                    email_addresses.append(address)
     
     except Exception as exception:
         logger.error(f"Airflow - services/labeling.py - label_email() - An exception occurred when parsing reply_to emails (See exception below)")
@@ -1,99 +1,370 @@
 import os
 import boto3
-import base64
 import requests
 import time
-from database.connectDB import create_connection_to_postgresql, close_connection
-from services.processEmails import save_emails_to_json_file
-from services.extractAttachments import download_attachments_from_s3
+import hashlib
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from boto3.s3.transfer import TransferConfig
+from database.connectDB import db_connection
+from services.graphRequests import graph_get
+from services.extractAttachments import extract_contents_from_file, extract_contents_in_subprocess, is_image_file
+from services.vectors import embed_email_attachments
 
-def fetch_emails_with_attachments(logger):
-    logger.info(f"Airflow - services/processEmailAttachments.py - fetch_emails_with_attachments() - Fetching mails with attachments")
+# Attachment properties listed for each email. contentBytes is left out, the contents are streamed from /$value
+ATTACHMENT_SELECT_FIELDS = "id,name,contentType,size,isInline,lastModifiedDateTime"
 
+# Function to build the multipart settings of S3 uploads; memory held per upload is about chunk size x concurrency
+def get_transfer_config():
+    chunk_size = int(os.getenv("ATTACHMENT_MULTIPART_CHUNK_MB", "8")) * 1024 * 1024
+
+    return TransferConfig(
+        multipart_threshold = chunk_size,
+        multipart_chunksize = chunk_size,
+        max_concurrency     = int(os.getenv("ATTACHMENT_UPLOAD_CONCURRENCY", "4")),
+    )
+
+# Function to list the attachments of an email, without their contents
+def list_attachments(logger, email_id, headers):
+    attachments = []
+    next_link = f"https://graph.microsoft.com/v1.0/me/messages/{email_id}/attachments?$select={ATTACHMENT_SELECT_FIELDS}"
+
+    while next_link:
+        response = graph_get(logger, next_link, headers=headers, timeout=120)
+        attachments_response = response.json()
+
+        attachments.extend(attachments_response.get("value", []))
+        next_link = attachments_response.get("@odata.nextLink")
+
+    return attachments
+
+# Function to create the spool an attachment is downloaded into before it is hashed and stored; it stays in memory
+# up to ATTACHMENT_SPOOL_MAX_MB, larger attachments go to a named temporary file the extraction process can open
+def create_attachment_spool(size=None):
+    max_size = int(os.getenv("ATTACHMENT_SPOOL_MAX_MB", "16")) * 1024 * 1024
+
+    if size and size > max_size:
+        return tempfile.NamedTemporaryFile()
+
+    return tempfile.SpooledTemporaryFile(max_size=max_size)
+
+# Function to extract the contents of a spooled attachment in an extraction process, then release the spool
+def extract_spooled_attachment(logger, file_name, spool):
+    try:
+        # Image summaries wait on the OpenAI API, not the CPU: they run in this thread so that
+        # the summary cache, the shared client and the rate limiter apply across all workers
+        if is_image_file(file_name):
+            spool.seek(0)
+            return extract_contents_from_file(logger, file_name, spool)
+
+        # Named files are opened by path in the child, in-memory spools are sent over as bytes
+        if isinstance(spool.name, str):
+            spool.flush()
+            source = spool.name
+        else:
+            spool.seek(0)
+            source = spool.read()
+
+        return extract_contents_in_subprocess(logger, file_name, source)
+
+    finally:
+        spool.close()
+
+# Function to download the raw contents of an attachment from Graph into spool, returning their SHA-256
+def download_attachment_to_spool(logger, email_id, attachment_id, headers, spool):
+    value_url = f"https://graph.microsoft.com/v1.0/me/messages/{email_id}/attachments/{attachment_id}/$value"
+    digest = hashlib.sha256()
+
+    with graph_get(logger, value_url, headers=headers, timeout=120, stream=True) as response:
+        # iter_content undoes any transfer encoding (gzip)
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            digest.update(chunk)
+            spool.write(chunk)
+
+    return digest.hexdigest()
+
+# Function to build the content-addressed S3 key of an attachment: identical files share one object
+def get_blob_key(content_hash):
+    return f"blobs/{content_hash[:2]}/{content_hash}"
+
+# Function to upload a spooled attachment to its content-addressed key, returning its S3 URL
+def upload_blob_to_s3(logger, s3_client, spool, s3_bucket_name, content_hash, content_type):
+    s3_key = get_blob_key(content_hash)
+    spool.seek(0)
+
+    s3_client.upload_fileobj(
+        spool,
+        s3_bucket_name,
+        s3_key,
+        ExtraArgs = {"ContentType": content_type} if content_type else None,
+        Config    = get_transfer_config(),
+    )
+
+    return f"s3://{s3_bucket_name}/{s3_key}"
+
+# Function to fetch the stored blob of an attachment's contents
+def fetch_attachment_blob(logger, content_hash):
     query = """
-        SELECT DISTINCT 
-            u.email AS user_email,
-            e.id AS email_id,
-            e.has_attachments
-        FROM emails e
-        JOIN senders s ON s.email_id = e.id
-        JOIN recipients r ON r.email_id = e.id
-        JOIN users u ON (u.email = s.email_address OR u.email = r.email_address)
-        WHERE e.has_attachments = TRUE;
+        SELECT bucket_url, extraction_status, extracted_text
+        FROM attachment_blobs
+        WHERE content_hash = %s
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (content_hash,))
+            row = cursor.fetchone()
+
+            if row is None:
+                return None
+
+            bucket_url, extraction_status, extracted_text = row
+            return {"bucket_url": bucket_url, "extraction_status": extraction_status, "extracted_text": extracted_text}
+
+    except Exception as e:
+        logger.error(f"Airflow - services/processEmailAttachments.py - fetch_attachment_blob() - Error fetching blob {content_hash}: {e}")
+        return None
+
+# Function to record an uploaded blob; a blob uploaded concurrently by another worker is kept as is
+def insert_attachment_blob(logger, content_hash, size, content_type, s3_url):
+    insert_query = """
+        INSERT INTO attachment_blobs (content_hash, size, content_type, bucket_url)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (content_hash) DO NOTHING
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(insert_query, (content_hash, size, content_type, s3_url))
+            conn.commit()
+
+    except Exception as e:
+        logger.error(f"Airflow - services/processEmailAttachments.py - insert_attachment_blob() - Error inserting blob {content_hash}: {e}")
+
+# Function to save the extracted contents of a blob, so other attachments with the same contents are not parsed again
+def update_blob_extraction(logger, content_hash, extraction_status, extracted_text):
+    update_query = """
+        UPDATE attachment_blobs
+        SET extraction_status = %s, extracted_text = %s
+        WHERE content_hash = %s
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(update_query, (extraction_status, extracted_text, content_hash))
+            conn.commit()
+
+    except Exception as e:
+        logger.error(f"Airflow - services/processEmailAttachments.py - update_blob_extraction() - Error updating blob {content_hash}: {e}")
+
+# Function to record a failed extraction of a blob. A failure may be transient (a slow or busy worker), so the blob
+# stays 'pending' and is extracted again until it has failed max_attempts times. Returns the blob's new status
+def record_blob_extraction_failure(logger, content_hash, max_attempts):
+    update_query = """
+        UPDATE attachment_blobs
+        SET extraction_attempts = extraction_attempts + 1,
+            extraction_status = CASE WHEN extraction_attempts + 1 >= %s THEN 'failed' ELSE 'pending' END,
+            extracted_text = NULL
+        WHERE content_hash = %s
+        RETURNING extraction_status
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(update_query, (max_attempts, content_hash))
+            row = cursor.fetchone()
+            conn.commit()
+
+            return row[0] if row else "pending"
+
+    except Exception as e:
+        logger.error(f"Airflow - services/processEmailAttachments.py - record_blob_extraction_failure() - Error updating blob {content_hash}: {e}")
+        return "pending"
+
+# Function to check whether the contents of a blob are already embedded in the user's attachments collection
+def is_blob_embedded_for_user(logger, user_email, content_hash):
+    query = """
+        SELECT 1
+        FROM attachment_manifest
+        WHERE user_email = %s
+          AND content_hash = %s
+          AND embedding_status = 'done'
+        LIMIT 1
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (user_email, content_hash))
+            return cursor.fetchone() is not None
+
+    except Exception as e:
+        logger.error(f"Airflow - services/processEmailAttachments.py - is_blob_embedded_for_user() - Error checking blob {content_hash}: {e}")
+        return False
+
+# Function to fetch the next batch of the user's emails whose attachments are not processed yet. Emails are walked
+# in id order from after_id, so that every email is visited at most once per run and the partial index is used
+def fetch_emails_with_attachments(logger, user_email, after_id, batch_size, max_attempts):
+    logger.info(f"Airflow - services/processEmailAttachments.py - fetch_emails_with_attachments() - Fetching mails with attachments for {user_email}")
+
+    query = """
+        SELECT id
+        FROM emails
+        WHERE owner_email = %s
+          AND has_attachments = TRUE
+          AND attachments_status <> 'done'
+          AND attachments_attempts < %s
+          AND id > %s
+        ORDER BY id
+        LIMIT %s;
         """
 
-    conn = create_connection_to_postgresql()
-    if conn:
-        
-        try:
-            cursor = conn.cursor()
-            cursor.execute(query)
-            emails_with_attachments = cursor.fetchall()
-            logger.info(f"Airflow - services/processEmailAttachments.py - fetch_emails_with_attachments() - All the emails with attachments fetched successfully")
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (user_email, max_attempts, after_id, batch_size))
+            emails_with_attachments = [row[0] for row in cursor.fetchall()]
+            logger.info(f"Airflow - services/processEmailAttachments.py - fetch_emails_with_attachments() - {len(emails_with_attachments)} emails with attachments fetched successfully")
             return emails_with_attachments
-        
-        except Exception as e:
-            logger.info(f"Airflow - services/processEmailAttachments.py - fetch_emails_with_attachments() - Error fetching emails with attachments: {e}")
-            return []
-        
-        finally:
-            close_connection(conn, cursor)
-            logger.info(f"Airflow - services/processEmailAttachments.py - fetch_emails_with_attachments() - Connection closed successfully")
-    
-    else:
-        logger.info(f"Airflow - services/processEmailAttachments.py - fetch_emails_with_attachments() - Failed to connect to the database. {e}")
+
+    except Exception as e:
+        logger.info(f"Airflow - services/processEmailAttachments.py - fetch_emails_with_attachments() - Error fetching emails with attachments: {e}")
         return []
-    
 
-def insert_attachment_data(logger, attachment_id, email_id, file_name, content_type, size, s3_url):
-    conn = create_connection_to_postgresql()
+# Function to record the outcome of processing the attachments of an email; failed emails are retried
+# on the next runs until ATTACHMENT_MAX_ATTEMPTS is reached
+def update_email_attachments_status(logger, email_id, status):
+    update_query = """
+        UPDATE emails
+        SET attachments_status = %s,
+            attachments_attempts = attachments_attempts + 1,
+            attachments_processed_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    """
 
-    if conn:
-        insert_query = """
-            INSERT INTO attachments (id, email_id, name, content_type, size, bucket_url)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """
-        cursor = conn.cursor()
-        try:
-            cursor.execute(insert_query, (attachment_id, email_id, file_name, content_type, size, s3_url))
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(update_query, (status, email_id))
+            conn.commit()
+
+    except Exception as e:
+        logger.error(f"Airflow - services/processEmailAttachments.py - update_email_attachments_status() - Error updating mail-id {email_id}: {e}")
+
+
+def insert_attachment_data(logger, attachment_id, email_id, file_name, content_type, size, s3_url, content_hash):
+    insert_query = """
+        INSERT INTO attachments (id, email_id, name, content_type, size, bucket_url, content_hash)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (id) DO UPDATE SET
+            email_id = EXCLUDED.email_id,
+            name = EXCLUDED.name,
+            content_type = EXCLUDED.content_type,
+            size = EXCLUDED.size,
+            bucket_url = EXCLUDED.bucket_url,
+            content_hash = EXCLUDED.content_hash
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(insert_query, (attachment_id, email_id, file_name, content_type, size, s3_url, content_hash))
             conn.commit()
             logger.info(f"Attachment {file_name} inserted into the database.")
-        
-        except Exception as e:
-            logger.error(f"Failed to insert attachment {file_name} into database. Error: {e}")
-            conn.rollback()
-        finally:
-            close_connection(conn, cursor)
-    
-    else:
-        logger.info(f"Airflow - services/processEmailAttachments.py - fetch_emails_with_attachments() - Failed to connect to the database. {e}")
 
-def upload_attachments_to_s3(logger, user_email, email_id, s3_bucket_name, access_token):
-    logger.info(f"Processing attachments for email ID: {email_id}")
+    except Exception as e:
+        logger.error(f"Failed to insert attachment {file_name} into database. Error: {e}")
 
-    # Initialize S3 client
-    s3_client = boto3.client("s3")
+# Function to fetch the manifest entries of attachments
+def fetch_attachment_manifest(logger, attachment_ids):
+    query = """
+        SELECT attachment_id, content_hash, size, last_modified, extraction_status, embedding_status
+        FROM attachment_manifest
+        WHERE attachment_id = ANY(%s)
+    """
 
-    # Fetch attachments using Microsoft Graph API
-    attachment_url = f"https://graph.microsoft.com/v1.0/me/messages/{email_id}/attachments"
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (list(attachment_ids),))
 
-    response = requests.get(
-        attachment_url,
-        headers={"Authorization": f"Bearer {access_token}"},
-        timeout=120,
-    )
+            return {
+                attachment_id: {
+                    "content_hash"      : content_hash,
+                    "size"              : size,
+                    "last_modified"     : last_modified,
+                    "extraction_status" : extraction_status,
+                    "embedding_status"  : embedding_status,
+                }
+                for attachment_id, content_hash, size, last_modified, extraction_status, embedding_status in cursor.fetchall()
+            }
+
+    except Exception as e:
+        logger.error(f"Airflow - services/processEmailAttachments.py - fetch_attachment_manifest() - Error fetching the attachment manifest: {e}")
+        return {}
+
+# Function to record the state of an attachment in the manifest
+def update_attachment_manifest(logger, attachment_id, email_id, user_email, content_hash, size, last_modified, extraction_status, embedding_status):
+    upsert_query = """
+        INSERT INTO attachment_manifest (attachment_id, email_id, user_email, content_hash, size, last_modified, extraction_status, embedding_status, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+        ON CONFLICT (attachment_id) DO UPDATE SET
+            email_id = EXCLUDED.email_id,
+            user_email = EXCLUDED.user_email,
+            content_hash = EXCLUDED.content_hash,
+            size = EXCLUDED.size,
+            last_modified = EXCLUDED.last_modified,
+            extraction_status = EXCLUDED.extraction_status,
+            embedding_status = EXCLUDED.embedding_status,
+            updated_at = CURRENT_TIMESTAMP
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(upsert_query, (attachment_id, email_id, user_email, content_hash, size, last_modified, extraction_status, embedding_status))
+            conn.commit()
+
+    except Exception as e:
+        logger.error(f"Airflow - services/processEmailAttachments.py - update_attachment_manifest() - Error updating the manifest of attachment {attachment_id}: {e}")
+
+# Function to check whether an attachment listed by Graph is already processed, without downloading it.
+# Attachments of a sent or received message do not change, so a matching size and modification time is enough
+def is_attachment_unchanged(attachment, manifest_entry):
+    if not manifest_entry:
+        return False
 
-    if response.status_code != 200:
-        logger.error(f"Failed to fetch attachments for email ID: {email_id}. Response: {response.text}")
-        return
-    
-    save_emails_to_json_file(logger, response.json(), f"{email_id}_attachments")
+    if manifest_entry["size"] != attachment.get("size") or manifest_entry["last_modified"] != attachment.get("lastModifiedDateTime"):
+        return False
+
+    return manifest_entry["embedding_status"] in ("done", "skipped")
+
+# Function to store the attachments of an email in S3, each distinct file once under its content hash. Returns the
+# run counts along with the extractions submitted to extraction_executor, as {future: attachment details}
+def upload_attachments_to_s3(logger, s3_client, user_email, email_id, s3_bucket_name, access_token, extraction_executor):
+    logger.info(f"Processing attachments for email ID: {email_id}")
+
+    headers = {"Authorization": f"Bearer {access_token}"}
+    counts = {
+        "attachments"           : 0,
+        "attachment_bytes"      : 0,
+        "uploaded"              : 0,
+        "deduplicated"          : 0,
+        "deduplicated_bytes"    : 0,
+        "extractions_reused"    : 0,
+        "embeddings_reused"     : 0,
+        "failed"                : 0,
+    }
+    extractions = {}
+
+    # Fetch the list of attachments using Microsoft Graph API
+    try:
+        attachments = list_attachments(logger, email_id, headers)
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Failed to fetch attachments for email ID: {email_id}. Error: {e}")
+        counts["failed"] += 1
+        return counts, extractions
 
-    # save_emails_to_json_file(logger, response.json(), f"{email_id}_with_attachments.json")
-    attachments = response.json().get("value", [])
     if not attachments:
         logger.info(f"No attachments found for email ID: {email_id}.")
-        return
+        return counts, extractions
+
+    manifest = fetch_attachment_manifest(logger, [attachment.get("id") for attachment in attachments])
 
     file_extensions = {
         "PDFs"          : [".pdf"],
@@ -103,83 +374,267 @@ def upload_attachments_to_s3(logger, user_email, email_id, s3_bucket_name, acces
         "SpreadSheets"  : [".xls", ".xlsx"],
         "CSVFiles"      : ['.csv'],
     }
-    
-    # Define base directory structure
-    base_dir = f"{user_email}/{email_id}/attachments"
-
-    # Create subdirectories for categorizing attachment files 
-    subdirectories = {
-        category: os.path.join(base_dir, category) for category in file_extensions.keys()
-    }
-
-    # Create subdirectories in S3 if they don't exist
-    for sub_dir in subdirectories.values():
-        s3_client.put_object(Bucket=s3_bucket_name, Key=f"{sub_dir}/")
 
     # Upload attachments to S3 and insert data into the database
     for attachment in attachments:
         attachment_id = attachment.get("id")
         file_name     = attachment.get("name")
-        content_bytes = attachment.get("contentBytes")
         content_type  = attachment.get("contentType")
-        size          = attachment.get("size")  # Assuming size is in the attachment response
+        size          = attachment.get("size")
+        last_modified = attachment.get("lastModifiedDateTime")
 
-        if not file_name or not content_bytes:
+        if is_attachment_unchanged(attachment, manifest.get(attachment_id)):
+            logger.info(f"Skipping unchanged attachment {file_name} (ID: {attachment_id})")
             continue
 
-        file_contents = base64.b64decode(content_bytes)
-
-        # Save the file locally
-        if not os.path.isdir(os.path.join(os.getcwd(), "tmp")):
-            logger.info(f"creating local directory: {os.path.join(os.getcwd(), 'tmp')}")
-            os.makedirs(os.path.join(os.getcwd(), "tmp"))
+        # Item attachments (attached emails, events) and reference attachments (cloud links) have no file contents
+        if attachment.get("@odata.type", "#microsoft.graph.fileAttachment") != "#microsoft.graph.fileAttachment":
+            logger.info(f"Skipping {attachment.get('@odata.type')} {file_name}")
+            update_attachment_manifest(logger, attachment_id, email_id, user_email, None, size, last_modified, "skipped", "skipped")
+            continue
 
-        local_file_path = os.path.join(os.getcwd(), f"tmp/{file_name}")  # Use /tmp or a preferred directory
-        logger.info(f"Storing attachments contents into local file: {local_file_path}")
-        
-        with open(local_file_path, "wb") as f:
-            f.write(file_contents)
-        logger.info(f"Files uploaded to  {local_file_path}")
+        if not file_name:
+            continue
 
-        # Determine the target directory based on file type
-        target_dir = None
+        # Determine the file category based on file type, before anything is downloaded
+        file_type = None
         for category, extensions in file_extensions.items():
             if any(file_name.lower().endswith(ext) for ext in extensions):
-                target_dir = subdirectories.get(category)
+                file_type = category
                 break
 
-        if not target_dir:
+        if not file_type:
             logger.info(f"Skipping unsupported file type: {file_name}")
+            update_attachment_manifest(logger, attachment_id, email_id, user_email, None, size, last_modified, "skipped", "skipped")
+            continue
+
+        # Inline images are part of the body (signature logos, banners), not files sent to the user
+        if file_type == "Images" and attachment.get("isInline"):
+            logger.info(f"Skipping inline image {file_name}")
+            update_attachment_manifest(logger, attachment_id, email_id, user_email, None, size, last_modified, "skipped", "skipped")
             continue
 
+        spool = create_attachment_spool(size)
+
         try:
-            s3_key = f"{target_dir}/{file_name}"
-            s3_client.upload_file(local_file_path, s3_bucket_name, s3_key)
+            content_hash = download_attachment_to_spool(logger, email_id, attachment_id, headers, spool)
+            blob = fetch_attachment_blob(logger, content_hash)
 
-            # Fetch the S3 URL for the uploaded file
-            s3_url = f"s3://{s3_bucket_name}/{s3_key}"
+            counts["attachments"] += 1
+            counts["attachment_bytes"] += size or 0
+
+            if blob is None:
+                s3_url = upload_blob_to_s3(logger, s3_client, spool, s3_bucket_name, content_hash, content_type)
+                insert_attachment_blob(logger, content_hash, size, content_type, s3_url)
+                counts["uploaded"] += 1
+
+                logger.info(f"[SUCCESS] Uploaded attachment {file_name} (ID: {attachment_id}) to S3 bucket {s3_bucket_name}.")
+
+            else:
+                # Same file already stored for another email or user
+                s3_url = blob["bucket_url"]
+                counts["deduplicated"] += 1
+                counts["deduplicated_bytes"] += size or 0
+
+                logger.info(f"Attachment {file_name} (ID: {attachment_id}) already stored as {s3_url}")
 
-            # Log the upload details
-            logger.info(f"[SUCCESS] Uploaded attachment {file_name} (ID: {attachment_id}) to S3 bucket {s3_bucket_name}.")
             logger.info(f"Attachment Details: ID: {attachment_id}, Name: {file_name}, Content Type: {content_type}, Size: {size} bytes, S3 URL: {s3_url}")
 
             # Insert the attachment details into the database
-            insert_attachment_data(logger, attachment_id, email_id, file_name, content_type, size, s3_url)    
+            insert_attachment_data(logger, attachment_id, email_id, file_name, content_type, size, s3_url, content_hash)
+
+            # Same contents already embedded in this user's collection, for this attachment or another one
+            manifest_entry = manifest.get(attachment_id) or {}
+            if (manifest_entry.get("content_hash") == content_hash and manifest_entry.get("embedding_status") == "done") \
+                    or is_blob_embedded_for_user(logger, user_email, content_hash):
+                update_attachment_manifest(logger, attachment_id, email_id, user_email, content_hash, size, last_modified, "done", "done")
+                counts["embeddings_reused"] += 1
+                continue
+
+            attachment_details = {
+                "attachment_id" : attachment_id,
+                "email_id"      : user_email,
+                "email"         : email_id,
+                "file_type"     : file_type,
+                "file"          : file_name,
+                "content_hash"  : content_hash,
+                "size"          : size,
+                "last_modified" : last_modified,
+                "extracted"     : blob is not None and blob["extraction_status"] == "done",
+            }
+
+            if blob is not None and blob["extraction_status"] == "failed":
+                # Extraction of these contents already failed EXTRACTION_MAX_ATTEMPTS times
+                logger.info(f"Skipping attachment {file_name} (ID: {attachment_id}), its contents could not be extracted")
+                update_attachment_manifest(logger, attachment_id, email_id, user_email, content_hash, size, last_modified, "failed", "skipped")
+                continue
+
+            if attachment_details["extracted"]:
+                # Contents parsed before from another copy of the file
+                future = Future()
+                future.set_result(blob["extracted_text"])
+                counts["extractions_reused"] += 1
+
+            else:
+                # Extract the contents from the spooled copy, S3 is not read back.
+                # The extraction owns the spool from here on and closes it
+                future = extraction_executor.submit(extract_spooled_attachment, logger, file_name, spool)
+                spool = None
+
+            extractions[future] = attachment_details
 
         except Exception as e:
             logger.error(f"[ERROR] Failed to upload {file_name} for email ID: {email_id}. Error: {e}")
+            counts["failed"] += 1
+
+        finally:
+            if spool is not None:
+                spool.close()
+
+    return counts, extractions
+
+
+# Function to mark the embedded attachments as done in the manifest
+def mark_attachments_embedded(logger, attachment_ids):
+    update_query = """
+        UPDATE attachment_manifest
+        SET embedding_status = 'done', updated_at = CURRENT_TIMESTAMP
+        WHERE attachment_id = ANY(%s)
+    """
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(update_query, (list(attachment_ids),))
+            conn.commit()
 
+    except Exception as e:
+        logger.error(f"Airflow - services/processEmailAttachments.py - mark_attachments_embedded() - Error updating the attachment manifest: {e}")
 
-def process_emails_with_attachments(logger, access_token, s3_bucket_name):
+# Function to process the attachments of one email: upload to S3, extracting their contents on the way, then embed them
+def process_email_attachments(logger, s3_client, user_email, email_id, s3_bucket_name, access_token, extraction_executor):
+    logger.info(f"Airflow - services/processEmailAttachments.py - process_email_attachments() - Fetching mails with attachments for email - {user_email}, mail-id - {email_id}")
+
+    max_extraction_attempts = int(os.getenv("EXTRACTION_MAX_ATTEMPTS", "3"))
+
+    counts, extractions = upload_attachments_to_s3(logger, s3_client, user_email, email_id, s3_bucket_name, access_token, extraction_executor)
+
+    # Collect the extracted contents as the extraction processes finish
+    records = []
+    for future in as_completed(extractions):
+        attachment = extractions[future]
+
+        try:
+            content = future.result()
+
+        except Exception as e:
+            # The process could not be started; the attachment has no manifest entry yet and is retried on the next run
+            logger.error(f"Airflow - services/processEmailAttachments.py - process_email_attachments() - Error extracting {attachment['file']}: {e}")
+            counts["failed"] += 1
+            continue
+
+        if content is None:
+            # Parsing failed, timed out or ran out of memory: nothing is stored as the blob's text or embedded.
+            # The email is marked failed and retried, until the blob has failed EXTRACTION_MAX_ATTEMPTS times
+            if record_blob_extraction_failure(logger, attachment["content_hash"], max_extraction_attempts) == "failed":
+                logger.error(f"Airflow - services/processEmailAttachments.py - process_email_attachments() - Giving up on {attachment['file']} after {max_extraction_attempts} failed extractions")
+                update_attachment_manifest(logger, attachment["attachment_id"], email_id, user_email, attachment["content_hash"], attachment["size"], attachment["last_modified"], "failed", "skipped")
+            else:
+                update_attachment_manifest(logger, attachment["attachment_id"], email_id, user_email, attachment["content_hash"], attachment["size"], attachment["last_modified"], "failed", "pending")
+                counts["failed"] += 1
+            continue
+
+        if not attachment["extracted"]:
+            update_blob_extraction(logger, attachment["content_hash"], "done", content)
+
+        update_attachment_manifest(logger, attachment["attachment_id"], email_id, user_email, attachment["content_hash"], attachment["size"], attachment["last_modified"], "done", "pending")
+        records.append({
+            "attachment_id" : attachment["attachment_id"],
+            "email_id"      : attachment["email_id"],
+            "email"         : attachment["email"],
+            "file_type"     : attachment["file_type"],
+            "file"          : attachment["file"],
+            "content"       : content,
+        })
+
+    if records:
+        embedded_ids = embed_email_attachments(records)
+        if embedded_ids:
+            mark_attachments_embedded(logger, embedded_ids)
+
+        counts["failed"] += len(records) - len(embedded_ids)
+
+    update_email_attachments_status(logger, email_id, "failed" if counts["failed"] else "done")
+    return counts
+
+
+def process_emails_with_attachments(logger, access_token, user_email, s3_bucket_name):
     logger.info(f"Airflow - services/processEmailAttachments.py - process_emails_with_attachments() - Processing mails with attachments")
 
-    logger.info(f"Airflow - services/processEmailAttachments.py - process_emails_with_attachments() - Fetching mails with attachments")
-    emails_with_attachments = fetch_emails_with_attachments(logger)
+    # boto3 clients are thread-safe, a single one is shared by all workers
+    s3_client = boto3.client("s3")
+
+    # Emails of this user processed at the same time; Graph throttles per mailbox, so keep this small
+    max_workers = int(os.getenv("ATTACHMENT_WORKERS", "4"))
+
+    # Extraction processes running at the same time, each parsing one attachment on its own core
+    extraction_workers = int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+
+    # Emails fetched per query, and attempts after which an email keeps failing without being retried
+    batch_size = int(os.getenv("ATTACHMENT_BATCH_SIZE", "100"))
+    max_attempts = int(os.getenv("ATTACHMENT_MAX_ATTEMPTS", "3"))
+
+    start_time = time.perf_counter()
+    totals = {}
+    processed_emails = 0
+    failed_emails = 0
+    last_email_id = ""
+
+    # Process each email's attachments, one batch of emails at a time
+    with ThreadPoolExecutor(max_workers=extraction_workers) as extraction_executor, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            logger.info(f"Airflow - services/processEmailAttachments.py - process_emails_with_attachments() - Fetching mails with attachments")
+            # Only the mails of the user owning the access token can be fetched with it
+            emails_with_attachments = fetch_emails_with_attachments(logger, user_email, last_email_id, batch_size, max_attempts)
+
+            if not emails_with_attachments:
+                break
+
+            last_email_id = emails_with_attachments[-1]
 
-    # Process each email's attachments
-    for user_email, email_id, has_attachments in emails_with_attachments:
-        if has_attachments:
-            logger.info(f"Airflow - services/processEmailAttachments.py - process_emails_with_attachments() - Fetching mails with attachments for email - {user_email}, mail-id - {email_id}")
-            
-            upload_attachments_to_s3(logger, user_email, email_id, s3_bucket_name, access_token)
-            download_attachments_from_s3(logger, user_email, email_id, s3_bucket_name)
\ No newline at end of file
+            futures = {
+                executor.submit(process_email_attachments, logger, s3_client, user_email, email_id, s3_bucket_name, access_token, extraction_executor): email_id
+                for email_id in emails_with_attachments
+            }
+
+            for future in as_completed(futures):
+                processed_emails += 1
+
+                try:
+                    counts = future.result()
+                    for key, value in counts.items():
+                        totals[key] = totals.get(key, 0) + value
+
+                    if counts["failed"]:
+                        failed_emails += 1
+
+                except Exception as e:
+                    failed_emails += 1
+                    update_email_attachments_status(logger, futures[future], "failed")
+                    logger.error(f"Airflow - services/processEmailAttachments.py - process_emails_with_attachments() - Error processing attachments of mail-id {futures[future]}: {e}")
+
+    elapsed = max(time.perf_counter() - start_time, 1e-6)
+    total_count = totals.get("attachments", 0)
+    total_mb = totals.get("attachment_bytes", 0) / (1024 * 1024)
+    dedup_ratio = totals.get("deduplicated", 0) / total_count if total_count else 0.0
+
+    logger.info(
+        f"Airflow - services/processEmailAttachments.py - process_emails_with_attachments() - Processed {processed_emails} mails "
+        f"({failed_emails} failed): {total_count} attachments, {total_mb:.2f} MB in {elapsed:.2f}s - "
+        f"{total_count / elapsed:.2f} attachments/sec, {total_mb / elapsed:.2f} MB/sec"
+    )
+    logger.info(
+        f"Airflow - services/processEmailAttachments.py - process_emails_with_attachments() - Deduplication: "
+        f"{totals.get('uploaded', 0)} new files uploaded, {totals.get('deduplicated', 0)} already stored "
+        f"({totals.get('deduplicated_bytes', 0) / (1024 * 1024):.2f} MB not uploaded) - dedup ratio {dedup_ratio:.1%}, "
+        f"{totals.get('extractions_reused', 0)} extractions and {totals.get('embeddings_reused', 0)} embeddings reused"
+    )
@@ -2,9 +2,10 @@ import requests
 import os
 
 from database.loadtoDB import insert_email_folders
+from services.graphRequests import graph_get
 
 # Function to get email folders
-def get_email_folders(logger, access_token):
+def get_email_folders(logger, access_token, user_id):
     logger.info("Airflow - services/processEmailFolders - get_email_folders() - Inside get_email_folders() function")
 
     mailfolder_endpoint = os.getenv("MAILFOLDERS_ENDPOINT")
@@ -15,19 +16,35 @@ def get_email_folders(logger, access_token):
     }
 
     try:
+        emailfolders = []
 
-        response = requests.get(mailfolder_endpoint, headers=headers, timeout=60)
-        response.raise_for_status()
-        logger.info("Airflow - services/processEmailFolders - get_email_folders() - Request successful for fetching email folders")
+        # /mailFolders only lists the top-level folders, subfolders are listed through their parent
+        folder_links = [mailfolder_endpoint]
 
-        emailfolders_response = response.json()
-        emailfolders = emailfolders_response.get("value", [])
+        while folder_links:
+            next_link = folder_links.pop(0)
+
+            # Graph returns mail folders in pages of 10 by default
+            while next_link:
+                response = graph_get(logger, next_link, headers=headers, timeout=60)
+                logger.info("Airflow - services/processEmailFolders - get_email_folders() - Request successful for fetching email folders")
+
+                emailfolders_response = response.json()
+
+                for emailfolder in emailfolders_response.get("value", []):
+                    emailfolders.append(emailfolder)
+
+                    if emailfolder.get("childFolderCount"):
+                        folder_links.append(f"{mailfolder_endpoint}/{emailfolder.get('id')}/childFolders")
+
+                next_link = emailfolders_response.get("@odata.nextLink")
 
         formatted_emaildirs = []
 
         for emailfolder in emailfolders:
             formatted_emaildir = {
                 "id"                        : emailfolder.get("id"),
+                "user_id"                   : user_id,
                 "display_name"              : emailfolder.get("displayName"),
                 "parent_folder_id"          : emailfolder.get("parentFolderId"),
                 "child_folder_count"        : emailfolder.get("childFolderCount"),
@@ -1,24 +1,152 @@
 import os
-import json
 import chardet
 import requests
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
 from unidecode import unidecode
 
-from database.loadtoDB import load_email_info_to_db, insert_or_update_email_links
-from database.connectDB import create_connection_to_postgresql, close_connection
+from database.loadtoDB import load_email_info_to_db, insert_or_update_email_links, delete_email_data
+from database.connectDB import db_connection
+from services.graphRequests import graph_get
+from services.htmlText import extract_text_and_links
 
-# Function to fetch all the emails
+# Message properties stored by load_email_info_to_db. Properties specific to eventMessage
+# (startDateTime, meetingMessageType, ...) can't be selected on the base message type
+EMAIL_SELECT_FIELDS = [
+    "id", "body", "bodyPreview", "changeKey", "conversationId", "conversationIndex",
+    "createdDateTime", "hasAttachments", "importance", "inferenceClassification",
+    "isDraft", "isRead", "parentFolderId", "receivedDateTime", "replyTo", "sentDateTime",
+    "subject", "webLink", "sender", "toRecipients", "ccRecipients", "bccRecipients", "flag",
+]
+
+# Function to add/replace query parameters on a Graph API URL
+def set_query_params(url, **params):
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query, keep_blank_values=True))
+
+    for key, value in params.items():
+        query[f"${key}"] = str(value)
+
+    return urlunsplit(parts._replace(query=urlencode(query, safe="$,", quote_via=quote)))
+
+# Function to read the $skip offset of a Graph API URL (None if the URL pages with a $skiptoken)
+def get_skip_from_link(url):
+    query = dict(parse_qsl(urlsplit(url).query))
+    skip = query.get("$skip")
+
+    return int(skip) if skip is not None and skip.isdigit() else None
+
+# Function to build the base URL for fetching emails
+def build_fetch_emails_url(fetch_emails_url, page_size):
+    query = dict(parse_qsl(urlsplit(fetch_emails_url).query))
+    params = {"top": page_size}
+
+    if "$select" not in query:
+        params["select"] = os.getenv("FETCH_EMAILS_SELECT", ",".join(EMAIL_SELECT_FIELDS))
+
+    if "$orderby" not in query:
+        # A stable order is needed to split the mailbox into $skip windows
+        params["orderby"] = "receivedDateTime desc"
+
+    return set_query_params(fetch_emails_url, **params)
+
+# Function to fetch a single page of emails
+def fetch_email_page(logger, url, headers):
+    logger.info(f"Airflow - services/processEmails.py - fetch_email_page() - Fetching emails from link: {url}")
+
+    response = graph_get(logger, url, headers=headers, timeout=60)
+    email_data = response.json()
+
+    return email_data.get("value", []), email_data.get("@odata.nextLink")
+
+# Function to checkpoint the fetched links into EMAIL_LINKS table
+def checkpoint_email_link(logger, user_id, email_id, current_link, next_link):
+    email_link_data = {
+        "id"                        : user_id,
+        "email"                     : email_id,
+        "current_link"              : current_link,
+        "next_link"                 : next_link,
+        "is_current_link_processed" : True
+    }
+
+    insert_or_update_email_links(logger, email_link_data)
+
+# Function to walk @odata.nextLink one page at a time, used when the link can't be split into $skip windows
+def fetch_emails_sequentially(logger, current_link, headers, page_budget, user_id, email_id):
+    pages_fetched = 0
+
+    try:
+        while current_link and pages_fetched < page_budget:
+            emails, next_link = fetch_email_page(logger, current_link, headers)
+            pages_fetched += 1
+            logger.info(f"Airflow - services/processEmails.py - fetch_emails_sequentially() - Fetched {len(emails)} emails. Next link: {next_link}")
+
+            yield emails
+
+            # The page has been loaded by the consumer, move the cursor past it
+            checkpoint_email_link(logger, user_id, email_id, current_link, next_link)
+            current_link = next_link
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Airflow - services/processEmails.py - fetch_emails_sequentially() - Error while fetching emails: {e}")
+
+# Function to fetch $skip windows of emails concurrently, yielding the pages in mailbox order
+def fetch_emails_concurrently(logger, base_url, start_skip, headers, page_size, page_budget, max_workers, user_id, email_id):
+    in_flight = {}      # page index -> future
+    next_index = 0      # next page index to submit
+
+    def page_url(index):
+        return set_query_params(base_url, skip=start_skip + index * page_size)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def submit_next():
+            nonlocal next_index
+            in_flight[next_index] = executor.submit(fetch_email_page, logger, page_url(next_index), headers)
+            next_index += 1
+
+        while next_index < min(max_workers, page_budget):
+            submit_next()
+
+        index = 0
+        while index in in_flight:
+            try:
+                emails, next_link = in_flight.pop(index).result()
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Airflow - services/processEmails.py - fetch_emails_concurrently() - Error while fetching page {index}: {e}")
+                break
+
+            logger.info(f"Airflow - services/processEmails.py - fetch_emails_concurrently() - Fetched {len(emails)} emails from page {index}")
+
+            # A short page (or one without a nextLink) is the end of the mailbox
+            is_last_page = len(emails) < page_size or not next_link
+
+            # Refill the window before handing the page over, so fetching overlaps with loading.
+            # No new page is requested while the consumer is busy, which bounds the pages held in memory
+            while not is_last_page and len(in_flight) < max_workers and next_index < page_budget:
+                submit_next()
+
+            yield emails
+
+            # The page has been loaded by the consumer, move the cursor past it
+            checkpoint_email_link(logger, user_id, email_id, page_url(index), None if is_last_page else page_url(index + 1))
+
+            if is_last_page:
+                break
+            index += 1
+
+        for future in in_flight.values():
+            future.cancel()
+
+# Function to fetch all the emails, one page at a time
 def fetch_emails(logger, access_token,  email_id, user_id):
     logger.info("Airflow - services/processEmails.py - fetch_emails() - Fetching mails from Microsoft Graph API")
 
-    fetch_emails_url = os.getenv("FETCH_EMAILS_ENDPOINT")
+    page_size   = int(os.getenv("EMAILS_PAGE_SIZE", "100"))
+    page_budget = int(os.getenv("EMAILS_PAGE_BUDGET", "20"))
+    max_workers = int(os.getenv("EMAILS_FETCH_WORKERS", "4"))
 
-    if "$top=" not in fetch_emails_url:
-        if "?" in fetch_emails_url:
-            fetch_emails_url += "&$top=100"
-        else:
-            fetch_emails_url += "?$top=100"
+    fetch_emails_url = build_fetch_emails_url(os.getenv("FETCH_EMAILS_ENDPOINT"), page_size)
             
     headers = {
         "Authorization": f"Bearer {access_token}",
@@ -33,69 +161,209 @@ def fetch_emails(logger, access_token,  email_id, user_id):
                     LIMIT 1
                     """
     
-    conn = create_connection_to_postgresql()
-    cursor = conn.cursor()
-    cursor.execute(curr_link_query, (user_id, email_id))
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(curr_link_query, (user_id, email_id))
+        curr_link = cursor.fetchone()
 
-    curr_link = cursor.fetchone()
     logger.info(f"Airflow - services/processEmails.py - fetch_emails() - Current link from DB - {curr_link}")
-    if curr_link is None:
-        current_link = fetch_emails_url
-        logger.info(f"Airflow - services/processEmails.py - fetch_emails() - Fetch emails URL - {current_link}")
+
+    # Start over from the top once the previous pass reached the end of the mailbox
+    current_link = curr_link[0] if curr_link and curr_link[0] else None
+    start_skip = 0 if current_link is None else get_skip_from_link(current_link)
+
+    if start_skip is None:
+        logger.info(f"Airflow - services/processEmails.py - fetch_emails() - Resuming from link without $skip, fetching sequentially - {current_link}")
+        pages = fetch_emails_sequentially(logger, current_link, headers, page_budget, user_id, email_id)
+    
     else:
-        current_link = curr_link[0]
-        logger.info(f"Airflow - services/processEmails.py - fetch_emails() - Fetch emails URL - {current_link}")
+        logger.info(f"Airflow - services/processEmails.py - fetch_emails() - Fetching up to {page_budget} pages from $skip={start_skip} with {max_workers} workers - {fetch_emails_url}")
+        pages = fetch_emails_concurrently(logger, fetch_emails_url, start_skip, headers, page_size, page_budget, max_workers, user_id, email_id)
+
+    total_emails = 0
+    for emails in pages:
+        total_emails += len(emails)
+        yield emails
+    
+    logger.info(f"Airflow - services/processEmails.py - fetch_emails() - Completed fetching all emails. Total emails: {total_emails}")
 
-    close_connection(conn, cursor)
 
-    all_emails = []  # List to store all emails
-    next_link = None
-    is_current_link_processed = False
-    count = 0
+# Function to fetch the folders of a user from EMAIL_FOLDERS table, in the order they should be synced:
+# the priority folders first, then the smallest folders, so that a huge archive is picked up last
+def fetch_email_folders(logger, user_id):
+    logger.info("Airflow - services/processEmails.py - fetch_email_folders() - Fetching email folders of the user")
 
-    try:
-        while current_link:
-            logger.info(f"Airflow - services/processEmails.py - fetch_emails() - Fetching emails from link: {current_link}")
+    folders_query = """
+                    SELECT id, display_name, total_item_count
+                    FROM email_folders
+                    WHERE user_id = %s
+                    """
 
-            response = requests.get(current_link, headers=headers, timeout=60)
-            response.raise_for_status()
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(folders_query, (user_id,))
+        folders = cursor.fetchall()
 
-            email_data = response.json()
-            emails = email_data.get("value", [])
-            all_emails.extend(emails)  
+    # Display names, e.g. "Inbox,Sent Items" (Outlook localises them with the mailbox language)
+    priority_folders = [name.strip().lower() for name in os.getenv("PRIORITY_FOLDERS", "Inbox,Sent Items").split(",") if name.strip()]
 
-            next_link = email_data.get("@odata.nextLink")
-            is_current_link_processed = True  # Mark the current link as processed
-            count = count + 1
+    def sync_order(folder):
+        _, display_name, total_item_count = folder
+        display_name = (display_name or "").lower()
+        priority = priority_folders.index(display_name) if display_name in priority_folders else len(priority_folders)
 
-            email_link_data = {
-                "id": user_id,
-                "email": email_id,
-                "current_link": current_link,
-                "next_link": next_link,
-                "is_current_link_processed": is_current_link_processed
-            }
+        return priority, total_item_count or 0
 
-            insert_or_update_email_links(logger, email_link_data)
+    folders = [(folder_id, display_name) for folder_id, display_name, _ in sorted(folders, key=sync_order)]
 
-            logger.info(f"Airflow - services/processEmails.py - fetch_emails() - Processed link: {current_link}")
-            logger.info(f"Airflow - services/processEmails.py - fetch_emails() - Fetched {len(emails)} emails. Next link: {next_link}")
+    logger.info(f"Airflow - services/processEmails.py - fetch_email_folders() - Found {len(folders)} email folders")
+    return folders
 
-            # If there is no next link, break the loop
-            if not next_link:
-                break
+# Function to sync a single folder with the delta query, resuming from the links stored in EMAIL_LINKS
+def sync_folder_delta(logger, headers, email_id, user_id, folder_id, page_budget):
+    link_id = f"{user_id}:{folder_id}"
+
+    link_query = """
+                    SELECT next_link, delta_link
+                    FROM email_links
+                    WHERE id = %s
+                    LIMIT 1
+                    """
+
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(link_query, (link_id,))
+        stored_links = cursor.fetchone()
+
+    delta_url = f"{os.getenv('MAILFOLDERS_ENDPOINT')}/{folder_id}/messages/delta"
+    full_round_link = set_query_params(delta_url, select=os.getenv("FETCH_EMAILS_SELECT", ",".join(EMAIL_SELECT_FIELDS)))
+
+    # An unfinished round resumes from its nextLink, a finished one continues from its deltaLink,
+    # and a folder that was never synced starts with a full delta round
+    if stored_links and stored_links[0]:
+        current_link = stored_links[0]
+    elif stored_links and stored_links[1]:
+        current_link = stored_links[1]
+    else:
+        current_link = full_round_link
+
+    changed_count = 0
+    removed_count = 0
+    pages_fetched = 0
+
+    while current_link and pages_fetched < page_budget:
+        try:
+            response = graph_get(logger, current_link, headers=headers, timeout=60)
+
+        except requests.exceptions.HTTPError as e:
+            # Graph answers 410 Gone (syncStateNotFound) once a delta token has expired; the stored
+            # cursor can never be used again, so the folder starts over with a full delta round
+            if e.response is None or e.response.status_code != 410 or current_link == full_round_link:
+                raise
+
+            logger.warning(f"Airflow - services/processEmails.py - sync_folder_delta() - Delta token of folder {folder_id} expired, restarting with a full delta round")
+
+            insert_or_update_email_links(logger, {
+                "id"                        : link_id,
+                "email"                     : email_id,
+                "folder_id"                 : folder_id,
+                "current_link"              : None,
+                "next_link"                 : None,
+                "delta_link"                : None,
+                "is_current_link_processed" : False
+            })
+
+            current_link = full_round_link
+            continue
+
+        delta_data = response.json()
+        pages_fetched += 1
+
+        changed_emails = []
+        removed_ids = []
+
+        for email in delta_data.get("value", []):
+            if "@removed" in email:
+                removed_ids.append(email.get("id"))
             else:
-                current_link = next_link
+                changed_emails.append(email)
 
-            if count == 2:
-                break
+        changed_count += len(changed_emails)
+        removed_count += len(removed_ids)
+        next_link = delta_data.get("@odata.nextLink")
+        delta_link = delta_data.get("@odata.deltaLink")
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Airflow - services/processEmails.py - fetch_emails() - Error while fetching emails: {e}")
-    
-    logger.info(f"Airflow - services/processEmails.py - fetch_emails() - Completed fetching all emails. Total emails: {len(all_emails)}")
-    return all_emails
+        yield changed_emails, removed_ids
+
+        # The page has been applied by the consumer, move the cursor past it
+        insert_or_update_email_links(logger, {
+            "id"                        : link_id,
+            "email"                     : email_id,
+            "folder_id"                 : folder_id,
+            "current_link"              : current_link,
+            "next_link"                 : next_link,
+            "delta_link"                : delta_link,
+            "is_current_link_processed" : True
+        })
+
+        current_link = next_link
+
+    logger.info(f"Airflow - services/processEmails.py - sync_folder_delta() - Folder {folder_id}: {changed_count} created/updated, {removed_count} removed")
+
+# Function to add the counters of a page (or a folder) to running totals
+def add_load_counts(totals, load_counts):
+    for key, value in load_counts.items():
+        totals[key] = totals.get(key, 0) + value
+
+    return totals
+
+# Function to sync a single folder, applying each page to the database before its cursor moves on
+def sync_folder(logger, headers, email_id, user_id, user_email, folder_id, display_name, page_budget):
+    logger.info(f"Airflow - services/processEmails.py - sync_folder() - Syncing folder '{display_name}'")
+
+    folder_counts = {}
+
+    for changed_emails, removed_ids in sync_folder_delta(logger, headers, email_id, user_id, folder_id, page_budget):
+        add_load_counts(folder_counts, apply_email_page(logger, changed_emails, removed_ids, user_email, folder_id))
+
+    return folder_counts
+
+# Function to sync all folders of a user with the delta query, each folder being an independent work unit
+def sync_emails_delta(logger, access_token, email_id, user_id, user_email):
+    logger.info("Airflow - services/processEmails.py - sync_emails_delta() - Syncing mails with Microsoft Graph delta query")
+
+    page_budget = int(os.getenv("EMAILS_PAGE_BUDGET", "20"))
+    max_workers = int(os.getenv("EMAIL_FOLDER_WORKERS", "4"))
+
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Prefer": f'outlook.body-content-type="html", odata.maxpagesize={os.getenv("EMAILS_PAGE_SIZE", "100")}',
+        "Content-Type": "application/json",
+    }
 
+    folders = fetch_email_folders(logger, user_id)
+    failed_folders = []
+    run_counts = {}
+
+    # Folders are queued in sync order, so the priority folders are picked up by the first workers
+    # and each folder is capped by its own page budget
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(sync_folder, logger, headers, email_id, user_id, user_email, folder_id, display_name, page_budget): display_name
+            for folder_id, display_name in folders
+        }
+
+        for future in as_completed(futures):
+            try:
+                add_load_counts(run_counts, future.result())
+
+            except Exception as e:
+                logger.error(f"Airflow - services/processEmails.py - sync_emails_delta() - Error while syncing folder '{futures[future]}': {e}")
+                failed_folders.append(futures[future])
+
+    # The other folders are kept; the failed ones resume from their cursor on the next run
+    if failed_folders:
+        raise RuntimeError(f"Failed to sync {len(failed_folders)} of {len(folders)} folders: {', '.join(map(str, failed_folders))}")
+
+    logger.info(f"Airflow - services/processEmails.py - sync_emails_delta() - Delta sync completed for {len(folders)} folders")
+    return run_counts
 
 
 # Function to process email JSON contents and format them
@@ -105,21 +373,54 @@ def decode_content(content):
 def clean_text(text):
     return text.replace('\n', ' ').replace('\r', '').strip()
 
-def extract_text_and_links(html_content):
-    soup = BeautifulSoup(html_content, 'html.parser')
+# Function to normalise a text value; values of other types (booleans, numbers, None) keep their JSON type
+def normalize_text(value):
+    return clean_text(decode_content(value)) if isinstance(value, str) else value
+
+# Function to normalise any other property, walking nested objects down to their text leaves
+def normalize_value(value):
+    if isinstance(value, dict):
+        return {key: normalize_value(sub_value) for key, sub_value in value.items()}
+
+    if isinstance(value, list):
+        return [normalize_value(item) for item in value]
+
+    return normalize_text(value)
+
+# Function to normalise a recipient (sender, from, toRecipients, ...) into {"emailAddress": {"name", "address"}}
+def normalize_recipient(recipient):
+    email_address = (recipient or {}).get("emailAddress") or {}
+
+    return {
+        "emailAddress": {
+            "name"    : normalize_text(email_address.get("name") or ""),
+            "address" : (email_address.get("address") or "").strip(),
+        }
+    }
+
+def normalize_recipients(recipients):
+    return [normalize_recipient(recipient) for recipient in recipients or []]
 
-    # Replace <a> tags with their text and link inline (e.g., "Text (URL)")
-    for a_tag in soup.find_all('a', href=True):
-        link_text = a_tag.get_text(strip=True)
-        if a_tag.get('originalsrc', None):
-            href = a_tag['originalsrc']
-        else:
-            href = a_tag['href']
-        a_tag.replace_with(f"{link_text} ({href})")
+# Function to convert the HTML body to text, with links inlined
+def normalize_body(body):
+    body = body or {}
+    cleaned_content = extract_text_and_links(body.get("content", ""))
 
-    # Extract the cleaned text
-    return soup.get_text(separator='\n', strip=True)
+    return {
+        "contentType": body.get("contentType", "unknown"),
+        "content": clean_text(decode_content(cleaned_content))
+    }
 
+# Normaliser of each message property with a known shape, the others go through normalize_value
+EMAIL_FIELD_NORMALIZERS = {
+    "body"          : normalize_body,
+    "sender"        : normalize_recipient,
+    "from"          : normalize_recipient,
+    "toRecipients"  : normalize_recipients,
+    "ccRecipients"  : normalize_recipients,
+    "bccRecipients" : normalize_recipients,
+    "replyTo"       : normalize_recipients,
+}
 
 def process_email_response(logger, emails):
     logger.info(f"Airflow - services/processEmails.py - process_email_response() - Processing mail responses")
@@ -128,37 +429,10 @@ def process_email_response(logger, emails):
 
     logger.info(f"Airflow - services/processEmails.py - process_email_response() - Parsing through each mail")
     for email in emails:
-        formatted_email = {}
-
-        for key, value in email.items():
-            if key == "body":
-                body_content = value.get("content", "")
-                cleaned_content = extract_text_and_links(body_content)
-
-                formatted_email[key] = {
-                    "contentType": value.get("contentType", "unknown"),
-                    "content": clean_text(decode_content(cleaned_content))
-                }
-
-            elif isinstance(value, dict):
-                # Process nested dictionaries (e.g., sender, from, toRecipients)
-                formatted_email[key] = {
-                    sub_key: clean_text(decode_content(str(sub_value)))
-                    for sub_key, sub_value in value.items()
-                }
-            elif isinstance(value, list):
-                # Process lists (e.g., recipients)
-                formatted_email[key] = [
-                    {
-                        sub_key: clean_text(decode_content(str(sub_value)))
-                        for sub_key, sub_value in item.items()
-                    }
-                    if isinstance(item, dict) else clean_text(decode_content(str(item)))
-                    for item in value
-                ]
-            else:
-                # Process other key-value pairs
-                formatted_email[key] = clean_text(decode_content(str(value)))
+        formatted_email = {
+            key: EMAIL_FIELD_NORMALIZERS.get(key, normalize_value)(value)
+            for key, value in email.items()
+        }
 
         formatted_email_data.append(formatted_email)
 
@@ -166,26 +440,43 @@ def process_email_response(logger, emails):
     return formatted_email_data
 
 
-# Function to save mails to JSON file
-def save_emails_to_json_file(logger, email_data, file_name):
-    logger.info(f"Airflow - services/processEmails.py - save_emails_to_json_file() - Saving mails to JSON file {file_name}")
-    try:
-        with open(file_name, "w") as json_file:
-            json.dump(email_data, json_file, indent=4)
-        logger.info(f"Airflow - services/processEmails.py - save_emails_to_json_file() - Email data saved to {file_name}")
-    except Exception as e:
-        logger.error(f"Airflow - services/processEmails.py - save_emails_to_json_file() - Error saving email data to JSON file: {e}")
+# Function to apply a page of changes to the database: removed emails are deleted, the others are formatted and loaded
+def apply_email_page(logger, mail_responses, removed_ids, user_email, folder_id=None):
+    if removed_ids:
+        delete_email_data(logger, removed_ids, folder_id)
+
+    if not mail_responses:
+        return {"removed": len(removed_ids)}
+
+    logger.info(f"Airflow - services/processEmails.py - apply_email_page() - Processing mail responses to format contents of emails")
+    formatted_mail_responses = process_email_response(logger, mail_responses)
+
+    logger.info(f"Airflow - services/processEmails.py - apply_email_page() - Loading {len(formatted_mail_responses)} mails into PostgreSQL database")
+    load_counts = load_email_info_to_db(logger, formatted_mail_responses, user_email)
+
+    return {**load_counts, "removed": len(removed_ids)}
 
 
 def process_emails(logger, access_token, user_email, email_id, user_id):
     logger.info(f"Airflow - services/processEmails.py - process_emails() - Processing emails")
 
-    logger.info(f"Airflow - services/processEmails.py - process_emails() - Fetching emails with access token")
-    mail_responses = fetch_emails(logger, access_token, email_id, user_id)
+    sync_mode = os.getenv("EMAIL_SYNC_MODE", "delta").lower()
 
-    logger.info(f"Airflow - services/processEmails.py - process_emails() - Processing mail responses to format contents of emails")
-    formatted_mail_responses = process_email_response(logger, mail_responses)
-    save_emails_to_json_file(logger, formatted_mail_responses, "mail_responses.json")
+    # Pages flow through fetch -> format -> load one at a time, so memory stays flat and
+    # rows reach the database as soon as their page has been fetched
+    if sync_mode == "delta":
+        logger.info(f"Airflow - services/processEmails.py - process_emails() - Syncing emails with delta query")
+        run_counts = sync_emails_delta(logger, access_token, email_id, user_id, user_email)
+
+    else:
+        logger.info(f"Airflow - services/processEmails.py - process_emails() - Fetching emails with access token")
+        run_counts = {}
+
+        for mail_responses in fetch_emails(logger, access_token, email_id, user_id):
+            add_load_counts(run_counts, apply_email_page(logger, mail_responses, [], user_email))
 
-    logger.info(f"Airflow - services/processEmails.py - process_emails() - Loading mail data into PostgreSQL database")
-    load_email_info_to_db(logger, formatted_mail_responses, user_email)
\ No newline at end of file
+    logger.info(
+        f"Airflow - services/processEmails.py - process_emails() - Run summary for {user_email}: "
+        f"{run_counts.get('loaded', 0)} mails loaded, {run_counts.get('skipped', 0)} unchanged mails skipped, "
+        f"{run_counts.get('indexed', 0)} mails indexed, {run_counts.get('removed', 0)} removed mails"
+    )
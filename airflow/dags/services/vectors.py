@@ -1,10 +1,13 @@
 import os
-import re
 import json
+import time
 import tiktoken
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from openai import OpenAI
 from dotenv import load_dotenv
 from services.logger import start_logger
+from database.embeddingCache import hash_text, fetch_cached_embeddings, save_cached_embeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pymilvus import MilvusClient, CollectionSchema, FieldSchema, DataType
 
@@ -19,7 +22,7 @@ def connect_to_Milvus():
 
     logger.info("Airflow - MILVUS - connect_to_Milvus() - Connecting to Milvus database...")
     client = None
-    
+
     try:
 
         temp_client = MilvusClient(
@@ -27,14 +30,18 @@ def connect_to_Milvus():
             user        = os.getenv("MILVUS_USER"),
             password    = os.getenv("MILVUS_PASSWORD"),
         )
-        
-        # List all databases
-        existing_dbs = temp_client.list_databases()
-        
-        # Create database if it doesn't exist
-        if os.getenv("MILVUS_DATABASE") not in existing_dbs:
-            logger.info("Creating database mailboxIndex...")
-            temp_client.create_database("mailboxIndex")
+
+        try:
+            # List all databases
+            existing_dbs = temp_client.list_databases()
+
+            # Create database if it doesn't exist
+            if os.getenv("MILVUS_DATABASE") not in existing_dbs:
+                logger.info(f"Creating database {os.getenv('MILVUS_DATABASE')}...")
+                temp_client.create_database(os.getenv("MILVUS_DATABASE"))
+
+        finally:
+            temp_client.close()
 
         client = MilvusClient(
             uri       = "http://" + os.getenv("MILVUS_HOST") + ':' + os.getenv("MILVUS_PORT"),
@@ -43,186 +50,566 @@ def connect_to_Milvus():
             db_name   = os.getenv("MILVUS_DATABASE"),
             timeout   = None
         )
-    
+
     except Exception as exception:
         logger.error("Airflow - MILVUS - connect_to_Milvus() - Exception occurred when connecting to Milvus database (See exception below)")
         logger.error(f"Airflow - MILVUS - connect_to_Milvus() - {exception}")
 
     finally:
         return client
-    
-def count_tokens(text):
-    '''Counts the tokens in the given text using the specified tokenizer '''
-    
-    tokenizer = tiktoken.get_encoding("cl100k_base")
-    return len(tokenizer.encode(text))
 
-def remove_urls(text):
-    ''' Remove URLs from the text '''
-    
-    return re.sub(r'http\S+|www\S+', '', text)
+# Milvus client shared by the whole process, connected on first use. Collections already checked
+# (or created) by this client are remembered, so that each one is looked up once per connection
+milvus_client = None
+milvus_lock = threading.Lock()
+known_collections = set()
+collection_lock = threading.Lock()
 
-def preprocess_text(text, max_tokens=7000):
-    ''' Remove URLs from email content if token count for text exceeds max tokens '''
+# Size of the vectors produced by EMBEDDING_MODEL
+EMBEDDING_DIMENSION = 3072
 
-    token_count = count_tokens(text)
+def get_milvus_client():
+    ''' Return the shared Milvus client, connecting on first use '''
+    global milvus_client
 
-    if token_count > max_tokens:
-        logger.warning(f"Airflow - MILVUS - Token count ({token_count}) exceeds {max_tokens}, removing URLs...")
-        text = remove_urls(text)
-        
-        token_count = count_tokens(text)
-        logger.warning(f"Airflow - MILVUS - Token count after URL removal: {token_count}")
-    
-    return text
+    with milvus_lock:
+        if milvus_client is None:
+            milvus_client = connect_to_Milvus()
 
-def openai_embeddings(content):
-    ''' Convert text to OpenAI embeddings '''
-    logger.info("Airflow - MILVUS - openai_embeddings() - Connecting to OpenAI...")
+        if milvus_client is None:
+            raise ConnectionError("Connection to Milvus failed")
 
-    embeddings = None
-    client = None
+        return milvus_client
 
-    try:
-        client = OpenAI(
-            api_key      = os.getenv("OPENAI_API_KEY"),
-            project      = os.getenv("PROJECT_ID"),
-            organization = os.getenv("ORGANIZATION_ID")
-        )
+def reset_milvus_client():
+    ''' Drop the shared Milvus client after a failure, the next call connects again '''
+    global milvus_client
 
-        embeddings = client.embeddings.create(
-            input = [content], 
-            model = os.getenv("EMBEDDING_MODEL")
-        ).data[0].embedding
-    
-    except Exception as exception:
-        logger.error("Airflow - MILVUS - openai_embeddings() - Exception occurred when converting content to embeddings (See exception below)")
-        logger.error(f"Airflow - MILVUS - openai_embeddings() - {exception}")
+    with milvus_lock:
+        if milvus_client is not None:
+            try:
+                milvus_client.close()
+            except Exception:
+                pass
 
-    finally:
-        
-        if client:
-            client.close()
-        
-        return embeddings
+        milvus_client = None
+        known_collections.clear()
 
-def create_embeddings_and_index(data_to_index, metadata):
-    ''' Create embeddings using OpenAI embeddings and index the vectors '''
+def run_milvus_operation(operation, attempts=2):
+    ''' Run operation(client) with the shared Milvus client, reconnecting once if it fails '''
 
-    logger.info("Airflow - MILVUS - create_embeddings_and_index() - Creating embeddings for email content")
-    
-    is_indexed = False
-    conn = connect_to_Milvus()
-    
-    if not conn:
-        logger.error("Airflow - MILVUS - create_embeddings_and_index() - Cannot create embeddings because connection to Milvus failed")
-        return is_indexed
-    
-    # Each user will have a separate collection
-    collection_name = str(metadata["user_email"])
+    for attempt in range(1, attempts + 1):
+        try:
+            return operation(get_milvus_client())
+
+        # Invalid requests and schemas fail the same way on a new connection
+        except ValueError:
+            raise
+
+        except Exception as exception:
+            if attempt == attempts:
+                raise
+
+            logger.warning(f"Airflow - MILVUS - run_milvus_operation() - Milvus operation failed, reconnecting - Retrying {attempt}/{attempts - 1}: {exception}")
+            reset_milvus_client()
+
+def delete_vectors(collection_name, metadata_key, values):
+    ''' Delete the vectors of a collection whose metadata[metadata_key] is one of values, including the ones still
+        buffered, with a single Milvus delete '''
+
+    values = [str(value) for value in values]
+    if not values:
+        return
+
+    vector_write_buffer.discard(collection_name, metadata_key, values)
+    run_milvus_operation(lambda conn: conn.delete(collection_name=collection_name, filter=f'metadata["{metadata_key}"] in {json.dumps(values)}'))
+
+def get_collection_name(name):
+    ''' Milvus collection names only allow letters, digits and underscores '''
+
+    collection_name = str(name)
     collection_name = collection_name.replace('@', os.getenv("__AT"))
     collection_name = collection_name.replace('.', os.getenv("__PERIOD"))
 
-    try:
-        # If the collection does not exist, create one
-        if not conn.has_collection(collection_name):
-            logger.warning(f"Airflow - MILVUS - create_embeddings_and_index() - Collection '{collection_name}' does not exist. Creating collection...")
-            
-            fields = [
-                FieldSchema(
-                    name        = "id", 
-                    dtype       = DataType.INT64, 
-                    is_primary  = True, 
-                    auto_id     = True
-                ),
-                FieldSchema(
-                    name    = "embedding", 
-                    dtype   = DataType.FLOAT_VECTOR, 
-                    dim     = 3072
-                ),
-                FieldSchema(
-                    name    = "metadata", 
-                    dtype   = DataType.JSON
-                ),
-                FieldSchema(
-                    name       = "page_content",
-                    dtype      = DataType.VARCHAR,
-                    max_length = 60000 
-                )
-            ]
-            schema = CollectionSchema(fields=fields, description=f"Collection for user {collection_name}")
-            
-            # Create the collection
-            conn.create_collection(collection_name=collection_name, schema=schema)
-            logger.info(f"Airflow - MILVUS - create_embeddings_and_index() - Collection '{collection_name}' created successfully.")
+    return collection_name
+
+def create_collection_schema(description):
+    ''' Schema shared by the email and attachment collections '''
+
+    fields = [
+        FieldSchema(
+            name        = "id",
+            dtype       = DataType.INT64,
+            is_primary  = True,
+            auto_id     = True
+        ),
+        FieldSchema(
+            name    = "embedding",
+            dtype   = DataType.FLOAT_VECTOR,
+            dim     = EMBEDDING_DIMENSION
+        ),
+        FieldSchema(
+            name    = "metadata",
+            dtype   = DataType.JSON
+        ),
+        FieldSchema(
+            name       = "page_content",
+            dtype      = DataType.VARCHAR,
+            max_length = 60000
+        )
+    ]
+
+    return CollectionSchema(fields=fields, description=description)
+
+def check_collection_schema(conn, collection_name):
+    ''' Make sure an existing collection stores vectors of the size produced by the embedding model '''
+
+    fields = conn.describe_collection(collection_name=collection_name).get("fields", [])
+    embedding_field = next((field for field in fields if field.get("name") == "embedding"), None)
+
+    if embedding_field is None:
+        raise ValueError(f"Collection '{collection_name}' has no 'embedding' field")
+
+    dimension = int(embedding_field.get("params", {}).get("dim", 0))
+    if dimension != EMBEDDING_DIMENSION:
+        raise ValueError(f"Collection '{collection_name}' stores vectors of dimension {dimension}, expected {EMBEDDING_DIMENSION}")
+
+def ensure_collection(collection_name, description):
+    ''' Create the collection if it does not exist yet, or check the schema of the existing one.
+        Returns True if the collection was created '''
+
+    if collection_name in known_collections:
+        return False
+
+    def check_or_create(conn):
+        # Held while creating, so that two threads cannot create the same collection
+        with collection_lock:
+            if collection_name in known_collections:
+                return False
+
+            if conn.has_collection(collection_name=collection_name):
+                check_collection_schema(conn, collection_name)
+                known_collections.add(collection_name)
+                return False
+
+            logger.warning(f"Airflow - MILVUS - ensure_collection() - Collection '{collection_name}' does not exist. Creating collection...")
+
+            conn.create_collection(collection_name=collection_name, schema=create_collection_schema(description))
+            logger.info(f"Airflow - MILVUS - ensure_collection() - Collection '{collection_name}' created successfully.")
 
             # Index the embeddings for faster retrieval
             index_params = conn.prepare_index_params()
             index_params.add_index(
                 field_name  = "embedding",
-                index_type  = "IVF_FLAT", 
-                metric_type = "COSINE", 
+                index_type  = "IVF_FLAT",
+                metric_type = "COSINE",
                 params      = {"nlist": 1024}
             )
-            # collection.create_index(field_name="embedding", index_params=index_params)
+
             conn.create_index(collection_name=collection_name, index_params=index_params)
-            logger.info(f"Airflow - MILVUS - create_embeddings_and_index() - Added index to embeddings successfully.")
+            logger.info(f"Airflow - MILVUS - ensure_collection() - Added index to embeddings successfully.")
 
-        else:
-            logger.warning(f"Airflow - MILVUS - create_embeddings_and_index() - Collection '{collection_name}' already exists.")
-    
-    except Exception as exception:
-        logger.error("Airflow - MILVUS - connect_to_milvus() - Exception occurred when connecting to Milvus database (See exception below)")
-        logger.error(f"Airflow - MILVUS - connect_to_milvus() - {exception}")
+            known_collections.add(collection_name)
+            return True
 
-    # Check if token limit is being exceeded
-    data_to_index["body"] = preprocess_text(text=data_to_index["body"], max_tokens=7000)
+    return run_milvus_operation(check_or_create)
 
-    # Content to index
-    content = "; ".join([f"{str(key).upper()}: {value}" for key, value in data_to_index.items()])
+class VectorWriteBuffer:
+    ''' Accumulate vector rows per collection and insert them into Milvus in batches.
+        A collection is flushed once it holds max_rows rows, and every flush_interval seconds from a background thread.
+        Rows of a batch that fails after all attempts are kept for the next flush '''
+
+    def __init__(self, max_rows, flush_interval, attempts):
+        self.max_rows       = max_rows
+        self.flush_interval = flush_interval
+        self.attempts       = attempts
+        self.pending        = {}
+        self.lock           = threading.Lock()
+
+        # Flushes are serialised, so that a flush only returns once the rows buffered before it are written
+        self.flush_lock     = threading.Lock()
+        self.timer          = None
+        self.stats          = {"rows": 0, "batches": 0, "failed_batches": 0, "insert_time": 0.0}
+
+    def add(self, collection_name, rows):
+        ''' Buffer rows for a collection, flushing it when it is full '''
+
+        with self.lock:
+            self.pending.setdefault(collection_name, []).extend(rows)
+            is_full = len(self.pending[collection_name]) >= self.max_rows
+
+            if self.timer is None:
+                self.timer = threading.Thread(target=self.flush_periodically, name="vector-write-buffer", daemon=True)
+                self.timer.start()
+
+        if is_full:
+            self.flush([collection_name])
+
+    def discard(self, collection_name, metadata_key, values):
+        ''' Drop the buffered rows of a collection whose metadata[metadata_key] is one of values, e.g. older versions of emails '''
+
+        values = set(values)
+        with self.lock:
+            if collection_name in self.pending:
+                self.pending[collection_name] = [row for row in self.pending[collection_name] if row["metadata"].get(metadata_key) not in values]
+
+    def flush_periodically(self):
+        ''' Background thread flushing every collection on a timer '''
+
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def insert_batch(self, collection_name, rows):
+        ''' Insert a batch of rows, retrying with a growing delay. Returns True on success '''
+
+        for attempt in range(1, self.attempts + 1):
+            start = time.perf_counter()
+
+            try:
+                run_milvus_operation(lambda conn: conn.insert(collection_name=collection_name, data=rows, timeout=None))
+
+            except Exception as exception:
+                if attempt == self.attempts:
+                    logger.error(f"Airflow - MILVUS - VectorWriteBuffer.insert_batch() - Failed to insert {len(rows)} rows into {collection_name}: {exception}")
+                    return False
+
+                logger.warning(f"Airflow - MILVUS - VectorWriteBuffer.insert_batch() - Insert into {collection_name} failed: {exception} - Retrying {attempt}/{self.attempts - 1}")
+                time.sleep(2 ** attempt)
+                continue
+
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.stats["rows"] += len(rows)
+                self.stats["batches"] += 1
+                self.stats["insert_time"] += elapsed
+
+            logger.info(f"Airflow - MILVUS - VectorWriteBuffer.insert_batch() - Inserted {len(rows)} rows into {collection_name} in {elapsed:.2f}s ({len(rows) / max(elapsed, 1e-6):.0f} rows/s)")
+            return True
+
+    def flush(self, collection_names=None):
+        ''' Write the buffered rows of the given collections (all of them by default).
+            Returns the names of the collections whose rows could not be written '''
+
+        failed = set()
+
+        with self.flush_lock:
+            with self.lock:
+                names = list(self.pending) if collection_names is None else [name for name in collection_names if name in self.pending]
+                batches = {name: self.pending.pop(name) for name in names}
+
+            for collection_name, rows in batches.items():
+                for start in range(0, len(rows), self.max_rows):
+                    if collection_name in failed or not self.insert_batch(collection_name, rows[start:start + self.max_rows]):
+                        failed.add(collection_name)
+
+                        # Keep the rows for the next flush
+                        with self.lock:
+                            self.pending.setdefault(collection_name, [])[:0] = rows[start:start + self.max_rows]
+                            self.stats["failed_batches"] += 1
+
+        return failed
+
+    def log_stats(self):
+        ''' Log the insert throughput since the process started '''
+
+        with self.lock:
+            stats = dict(self.stats)
+            buffered = sum(len(rows) for rows in self.pending.values())
+
+        rows_per_second = stats["rows"] / stats["insert_time"] if stats["insert_time"] else 0
+        logger.info(
+            f"Airflow - MILVUS - VectorWriteBuffer.log_stats() - Inserted {stats['rows']} rows in {stats['batches']} batches "
+            f"({rows_per_second:.0f} rows/s), failed batches: {stats['failed_batches']}, rows still buffered: {buffered}"
+        )
+
+# Vector rows waiting to be inserted, shared by every writer of the process
+vector_write_buffer = VectorWriteBuffer(
+    max_rows        = int(os.getenv("VECTOR_BUFFER_MAX_ROWS", "500")),
+    flush_interval  = float(os.getenv("VECTOR_BUFFER_FLUSH_SECONDS", "10")),
+    attempts        = int(os.getenv("VECTOR_INSERT_ATTEMPTS", "3"))
+)
+
+def flush_vector_writes():
+    ''' Write every buffered vector row, called at the end of each task. Returns True if nothing is left unwritten '''
+
+    failed = vector_write_buffer.flush()
+    vector_write_buffer.log_stats()
+
+    if failed:
+        logger.error(f"Airflow - MILVUS - flush_vector_writes() - Rows could not be written to: {', '.join(sorted(failed))}")
+
+    return not failed
+
+# Tokenizer of the embedding model, loaded on first use
+tokenizer = None
+
+def get_tokenizer():
+    ''' Return the cl100k_base tokenizer, loaded once per process '''
+    global tokenizer
+
+    if tokenizer is None:
+        tokenizer = tiktoken.get_encoding("cl100k_base")
+
+    return tokenizer
+
+def count_tokens(text):
+    '''Counts the tokens in the given text using the specified tokenizer '''
+
+    return len(get_tokenizer().encode(text, disallowed_special=()))
+
+def split_tokens(tokens, max_tokens, overlap_tokens):
+    ''' Split a list of tokens into windows of at most max_tokens, consecutive windows sharing overlap_tokens '''
+
+    step = max(max_tokens - overlap_tokens, 1)
+    return [tokens[start:start + max_tokens] for start in range(0, max(len(tokens) - overlap_tokens, 1), step)]
+
+# OpenAI client shared by every embedding request of the process, created on first use
+openai_client = None
+openai_client_lock = threading.Lock()
+
+def get_openai_client():
+    ''' Return the shared OpenAI client. The client is thread-safe and keeps its HTTP connections alive '''
+    global openai_client
+
+    with openai_client_lock:
+        if openai_client is None:
+            logger.info("Airflow - MILVUS - get_openai_client() - Connecting to OpenAI...")
+
+            openai_client = OpenAI(
+                api_key      = os.getenv("OPENAI_API_KEY"),
+                project      = os.getenv("PROJECT_ID"),
+                organization = os.getenv("ORGANIZATION_ID")
+            )
+
+        return openai_client
+
+def create_embedding_batches(texts, max_inputs, max_tokens, token_counts=None):
+    ''' Group the positions of the texts into batches that fit the per-request input and token limits.
+        The token counts of the texts are computed here unless they are already known '''
+
+    batches = []
+    batch = []
+    batch_tokens = 0
+
+    for index, text in enumerate(texts):
+        # Empty inputs are rejected by the API
+        if not text or not text.strip():
+            continue
+
+        tokens = token_counts[index] if token_counts else count_tokens(text)
+
+        if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+
+        batch.append(index)
+        batch_tokens += tokens
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+def request_embeddings(texts):
+    ''' Embed the texts with a single request, the embeddings are returned in the order of the texts '''
+
+    response = get_openai_client().embeddings.create(
+        input = texts,
+        model = os.getenv("EMBEDDING_MODEL")
+    )
+
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+def embed_batch(texts):
+    ''' Embed a batch of texts. If the request fails, the texts are sent one by one so that
+        a single bad input does not lose the embeddings of the whole batch '''
 
     try:
-        embedding = openai_embeddings(content=content)
+        return request_embeddings(texts)
+
+    except Exception as exception:
+        if len(texts) == 1:
+            logger.error("Airflow - MILVUS - embed_batch() - Exception occurred when converting content to embeddings (See exception below)")
+            logger.error(f"Airflow - MILVUS - embed_batch() - {exception}")
+            return [None]
+
+        logger.warning(f"Airflow - MILVUS - embed_batch() - Batch of {len(texts)} inputs failed, embedding them one by one: {exception}")
+
+    return [embed_batch([text])[0] for text in texts]
+
+def embed_texts(texts, token_counts=None):
+    ''' Convert texts to OpenAI embeddings, packing many texts per request and sending several requests at once.
+        Texts embedded before are read from the embedding cache, and identical texts are embedded once.
+        Returns one embedding per text, in the order of the texts, None for the texts that could not be embedded '''
+
+    model = os.getenv("EMBEDDING_MODEL")
+
+    # Empty inputs are rejected by the API
+    text_hashes = [hash_text(text) if text and text.strip() else None for text in texts]
+    embeddings = fetch_cached_embeddings(model, {text_hash for text_hash in text_hashes if text_hash})
+
+    # One request input per distinct text missing from the cache
+    missing = {}
+    for index, text_hash in enumerate(text_hashes):
+        if text_hash and text_hash not in embeddings:
+            missing.setdefault(text_hash, index)
+
+    missing_hashes = list(missing)
+    missing_texts = [texts[index] for index in missing.values()]
+
+    batches = create_embedding_batches(
+        texts        = missing_texts,
+        max_inputs   = int(os.getenv("EMBEDDING_BATCH_SIZE", "256")),
+        max_tokens   = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "250000")),
+        token_counts = [token_counts[index] for index in missing.values()] if token_counts else None
+    )
+
+    logger.info(f"Airflow - MILVUS - embed_texts() - {len(texts)} inputs: {len(embeddings)} cached, embedding {len(missing_texts)} in {len(batches)} requests")
+
+    if batches:
+        new_embeddings = {}
+        max_workers = min(int(os.getenv("EMBEDDING_CONCURRENCY", "4")), len(batches))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(embed_batch, [missing_texts[index] for index in batch]): batch for batch in batches}
+
+            for future in as_completed(futures):
+                for index, embedding in zip(futures[future], future.result()):
+                    if embedding is not None:
+                        new_embeddings[missing_hashes[index]] = embedding
+
+        save_cached_embeddings(model, new_embeddings)
+        embeddings.update(new_embeddings)
+
+    return [embeddings.get(text_hash) if text_hash else None for text_hash in text_hashes]
+
+def openai_embeddings(content):
+    ''' Convert text to OpenAI embeddings '''
+
+    return embed_texts([content])[0]
+
+def build_email_content(fields, body):
+    ''' Text indexed for an email: every field as "KEY: value", with the given body in place of the body field '''
+
+    return "; ".join([f"{str(key).upper()}: {body if key == 'body' else value}" for key, value in fields.items()])
 
-        vectors = {
-            "embedding"     : embedding,
-            "metadata"      : metadata,
-            "page_content"  : content
+def truncate_email_fields(fields, max_tokens):
+    ''' Truncate the longest fields other than the body, e.g. the reply-to list of a mail sent to a large
+        distribution list, until the content without the body fits max_tokens.
+        Returns the truncated fields and the token count of that content '''
+
+    value_tokens = {key: get_tokenizer().encode(str(value), disallowed_special=()) for key, value in fields.items() if key != "body"}
+    longest = max([len(tokens) for tokens in value_tokens.values()], default=0)
+
+    truncated = dict(fields)
+    fields_tokens = count_tokens(build_email_content(truncated, ""))
+
+    # Cap every field at the same length, lowering the cap by the tokens still in excess; the content
+    # is counted again on each pass, as tokens can merge differently once values are cut
+    cap = longest
+    while fields_tokens > max_tokens and cap > 0:
+        cap = max(cap - (fields_tokens - max_tokens), 0)
+        truncated = {
+            key: get_tokenizer().decode(value_tokens[key][:cap]) if key in value_tokens and len(value_tokens[key]) > cap else value
+            for key, value in fields.items()
         }
+        fields_tokens = count_tokens(build_email_content(truncated, ""))
+
+    return truncated, fields_tokens
+
+def build_email_chunks(data_to_index):
+    ''' Build the texts indexed for an email, as (text, token count) pairs. An email within EMAIL_CHUNK_MAX_TOKENS
+        is indexed as one text; the body of a longer one is split into overlapping token windows, every
+        chunk repeating the other fields of the email, so that each one fits the embedding model's input limit.
+        The other fields are truncated to half of a chunk, so that every chunk keeps room for the body '''
+
+    max_tokens = int(os.getenv("EMAIL_CHUNK_MAX_TOKENS", "7000"))
+    overlap_tokens = int(os.getenv("EMAIL_CHUNK_OVERLAP_TOKENS", "200"))
+
+    # The body is tokenised once; the other fields are counted through the content without the body
+    body_tokens = get_tokenizer().encode(str(data_to_index.get("body") or ""), disallowed_special=())
+    fields_tokens = count_tokens(build_email_content(data_to_index, ""))
+
+    if fields_tokens + len(body_tokens) <= max_tokens:
+        return [(build_email_content(data_to_index, data_to_index.get("body") or ""), fields_tokens + len(body_tokens))]
+
+    fields, fields_tokens = truncate_email_fields(data_to_index, max_tokens // 2)
+
+    # Leave room for the tokens merged across the boundary between the fields and the body
+    body_budget = max(max_tokens - fields_tokens - 8, 1)
+    windows = split_tokens(body_tokens, body_budget, min(overlap_tokens, body_budget // 2))
+
+    logger.info(f"Airflow - MILVUS - build_email_chunks() - Email body of {len(body_tokens)} tokens split into {len(windows)} chunks")
+
+    return [(build_email_content(fields, get_tokenizer().decode(window)), fields_tokens + len(window)) for window in windows]
 
-        conn.insert(collection_name=collection_name, data=vectors)
+def create_embeddings_and_index(data_to_index, metadata, chunks=None, embeddings=None):
+    ''' Create embeddings using OpenAI embeddings and index the vectors, one vector per chunk of the email.
+        The chunks and their embeddings can be computed beforehand with build_email_chunks and embed_texts,
+        so that a batch of emails is embedded in a few requests.
+        The vectors are buffered: callers flush vector_write_buffer before relying on them being stored, and
+        delete the vectors of an earlier version of the email beforehand '''
+
+    logger.info("Airflow - MILVUS - create_embeddings_and_index() - Creating embeddings for email content")
+
+    is_indexed = False
+
+    # Each user will have a separate collection
+    collection_name = get_collection_name(metadata["user_email"])
+
+    try:
+        # If the collection does not exist, create one
+        ensure_collection(collection_name=collection_name, description=f"Collection for user {collection_name}")
+
+    except Exception as exception:
+        logger.error("Airflow - MILVUS - create_embeddings_and_index() - Exception occurred when preparing the Milvus collection (See exception below)")
+        logger.error(f"Airflow - MILVUS - create_embeddings_and_index() - {exception}")
+        return is_indexed
+
+    # Content to index
+    if chunks is None:
+        chunks = build_email_chunks(data_to_index)
+
+    try:
+        if embeddings is None:
+            embeddings = embed_texts([content for content, _ in chunks], token_counts=[tokens for _, tokens in chunks])
+
+        # An email is only indexed with all of its chunks, otherwise it is indexed again on the next sync
+        if any(embedding is None for embedding in embeddings):
+            raise ValueError(f"No embedding was created for {sum(embedding is None for embedding in embeddings)} of the {len(chunks)} chunks of the email")
+
+        vectors = []
+        for idx, ((content, _), embedding) in enumerate(zip(chunks, embeddings)):
+            vectors.append({
+                "embedding"     : embedding,
+                "metadata"      : {**metadata, "chunk_index": idx},
+                "page_content"  : content
+            })
+
+        vector_write_buffer.add(collection_name, vectors)
         is_indexed = True
-        logger.info(f"Airflow - MILVUS - create_embeddings_and_index() - Saved vectors with metadata to {collection_name} successfully.")
-        
+        logger.info(f"Airflow - MILVUS - create_embeddings_and_index() - Buffered {len(vectors)} vectors with metadata for {collection_name}.")
+
     except Exception as exception:
         logger.error("Airflow - MILVUS - create_embeddings_and_index() - Exception occurred when creating and indexing embeddings (See exception below)")
         logger.error(f"Airflow - MILVUS - create_embeddings_and_index() - {exception}")
-    
-    finally:
-        conn.close()
 
-        # If needed in future
-        return is_indexed 
+    # If needed in future
+    return is_indexed
 
-def embed_email_attachments(filename: str):
-    ''' Read the filename for the json file, and create embeddings for email attachments '''
+def embed_email_attachments(data: list):
+    ''' Create embeddings for the contents extracted from email attachments, one record per attachment.
+        Returns the attachment ids whose contents were fully embedded '''
 
     logger.info("Airflow - MILVUS - embed_email_attachments() - Creating embeddings for email attachments...")
-    data = []
 
-    try:
-        logger.info(f"Airflow - MILVUS - embed_email_attachments() - Reading {filename}")
-
-        with open(file=filename, mode='r') as file:
-            data = json.load(file)
+    embedded_ids = []
 
+    try:
         if len(data) == 0:
-            raise ValueError(f"Expected some data in {filename}, but found nothing. Skipping...")
-        
-        conn = connect_to_Milvus()
-        if not conn:
-            logger.error("Airflow - MILVUS - embed_email_attachments() - Cannot create embeddings because connection to Milvus failed")
-            raise ConnectionError()
+            raise ValueError(f"Expected some attachment contents, but found nothing. Skipping...")
         
         # LangChain
         text_splitter = RecursiveCharacterTextSplitter(
@@ -231,90 +618,71 @@ def embed_email_attachments(filename: str):
             length_function = len
         )
 
-        # Attachments Collection
-        fields = [
-            FieldSchema(
-                name        = "id", 
-                dtype       = DataType.INT64, 
-                is_primary  = True, 
-                auto_id     = True
-            ),
-            FieldSchema(
-                name    = "embedding", 
-                dtype   = DataType.FLOAT_VECTOR, 
-                dim     = 3072
-            ),
-            FieldSchema(
-                name    = "metadata", 
-                dtype   = DataType.JSON
-            ),
-            FieldSchema(
-                name       = "page_content",
-                dtype      = DataType.VARCHAR,
-                max_length = 60000 
-            )
-        ]
-        
         logger.info(f"Airflow - MILVUS - embed_email_attachments() - Preparing content for embeddings...")
-        
+
+        # The chunks of all the attachments are embedded together; each record keeps the position of its first chunk
+        prepared_records = []
+        all_chunks = []
+
         for record in data:
 
-            user_id     = record["email_id"]
-            email_id    = record["email"]
-            file_type   = record["file_type"]
-            file_name   = record["file"]
-            content     = record["content"]
-            
-            collection_name = str(user_id) + "_attachments"
-            collection_name = collection_name.replace('@', os.getenv("__AT"))
-            collection_name = collection_name.replace('.', os.getenv("__PERIOD"))
+            attachment_id   = record.get("attachment_id")
+            user_id         = record["email_id"]
 
-            if not conn.has_collection(collection_name=collection_name):
-                logger.warning(f"Airflow - MILVUS - embed_email_attachments() - Collection '{collection_name}' does not exist. Creating collection...")
+            collection_name = get_collection_name(str(user_id) + "_attachments")
 
-                schema = CollectionSchema(fields=fields, description=f"Collection for attachments {collection_name}")
-                conn.create_collection(collection_name=collection_name, schema=schema)
+            ensure_collection(collection_name=collection_name, description=f"Collection for attachments {collection_name}")
 
-                logger.info(f"Airflow - MILVUS - embed_email_attachments() - Collection '{collection_name}' created successfully.")
+            # Drop the vectors of an earlier version of the attachment (or of a run interrupted half-way)
+            if attachment_id:
+                delete_vectors(collection_name, "attachment_id", [attachment_id])
 
-                # Index the embeddings for faster retrieval
-                index_params = conn.prepare_index_params()
-                index_params.add_index(
-                    field_name  = "embedding",
-                    index_type  = "IVF_FLAT", 
-                    metric_type = "COSINE", 
-                    params      = {"nlist": 1024}
-                )
+            # Create chunks
+            chunks = text_splitter.split_text(record["content"])
 
-                conn.create_index(collection_name=collection_name, index_params=index_params)
-                logger.info(f"Airflow - MILVUS - embed_email_attachments() - Added index to embeddings successfully.")
+            prepared_records.append((record, collection_name, len(all_chunks), chunks))
+            all_chunks.extend(chunks)
 
-            # Create chunks and embed them
-            chunks = text_splitter.split_text(content)
+        logger.info(f"Airflow - MILVUS - embed_email_attachments() - Creating embeddings for {len(all_chunks)} chunks of {len(data)} files")
+        embeddings = embed_texts(all_chunks)
 
-            logger.info(f"Airflow - MILVUS - embed_email_attachments() - Creating embeddings for file {file_name}")
+        fully_embedded = []
+
+        for record, collection_name, first_chunk, chunks in prepared_records:
+            attachment_id = record.get("attachment_id")
+            vectors = []
 
             for idx, chunk in enumerate(chunks):
-                embedding = openai_embeddings(content=chunk)
+                embedding = embeddings[first_chunk + idx]
 
                 if embedding:
                     metadata = {
-                        "user_id"     : user_id,
-                        "email_id"    : email_id,
-                        "file_type"   : file_type,
-                        "file_name"   : file_name,
-                        "chunk_index" : idx
+                        "user_id"       : record["email_id"],
+                        "email_id"      : record["email"],
+                        "attachment_id" : attachment_id,
+                        "file_type"     : record["file_type"],
+                        "file_name"     : record["file"],
+                        "chunk_index"   : idx
                     }
 
-                    vectors = {
+                    vectors.append({
                         "embedding"     : embedding,
                         "metadata"      : metadata,
                         "page_content"  : chunk
-                    }
+                    })
+
+            if vectors:
+                vector_write_buffer.add(collection_name, vectors)
 
-                    conn.insert(collection_name=collection_name, data=vectors, timeout=None)
-                    logger.info(f"Airflow - MILVUS - embed_email_attachments() - Saved attachment vectors with metadata to {collection_name} successfully.")
+            if attachment_id and len(vectors) == len(chunks):
+                fully_embedded.append((attachment_id, collection_name))
+
+        # Attachments only count as embedded once their vectors are written
+        failed_collections = vector_write_buffer.flush({collection_name for _, collection_name, _, _ in prepared_records})
+        embedded_ids = [attachment_id for attachment_id, collection_name in fully_embedded if collection_name not in failed_collections]
     
     except Exception as exception:
         logger.error("Airflow - MILVUS - embed_email_attachments() - Exception occurred when embedding email attachments (See exception below)")
         logger.error(f"Airflow - MILVUS - embed_email_attachments() - {exception}")
+
+    return embedded_ids
@@ -0,0 +1,63 @@
+""" Tests of the email chunking in services/vectors.py
+
+Usage (with the packages of airflow/requirements.txt and pytest installed):
+    python -m pytest airflow/tests
+"""
+
+import os
+import sys
+import json
+
+import pytest
+
+for module in ["dotenv", "tiktoken", "openai", "pymilvus", "psycopg2", "langchain_text_splitters"]:
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dags"))
+
+from services.vectors import build_email_chunks, count_tokens
+
+MAX_TOKENS = 500
+
+
+# Function to build the fields indexed for an email, as load_email_info_to_db does
+def email_to_index(body, reply_to=None):
+    return {
+        "subject"           : "Quarterly results",
+        "body"              : body,
+        "sender_name"       : "Finance",
+        "sender_email"      : "finance@example.com",
+        "reply_to"          : reply_to,
+        "created_datetime"  : "2024-01-01T09:00:00Z",
+        "received_datetime" : "2024-01-01T09:00:00Z",
+        "sent_datetime"     : "2024-01-01T09:00:00Z",
+    }
+
+
+@pytest.fixture(autouse=True)
+def chunk_settings(monkeypatch):
+    monkeypatch.setenv("EMAIL_CHUNK_MAX_TOKENS", str(MAX_TOKENS))
+    monkeypatch.setenv("EMAIL_CHUNK_OVERLAP_TOKENS", "20")
+
+
+def test_short_email_is_one_chunk():
+    chunks = build_email_chunks(email_to_index("See the attached report."))
+
+    assert len(chunks) == 1
+    assert "See the attached report." in chunks[0][0]
+
+
+def test_oversized_recipient_list_keeps_chunks_within_limit():
+    reply_to = json.dumps([
+        {"emailAddress": {"name": f"Recipient {idx}", "address": f"recipient{idx}@example.com"}}
+        for idx in range(500)
+    ])
+    body = " ".join(f"Line {idx} of the quarterly report." for idx in range(400))
+
+    chunks = build_email_chunks(email_to_index(body, reply_to))
+
+    assert len(chunks) > 1
+    for content, tokens in chunks:
+        assert tokens <= MAX_TOKENS
+        assert count_tokens(content) <= MAX_TOKENS
+        assert "SUBJECT: Quarterly results" in content
@@ -8,7 +8,9 @@ from langchain_core.runnables import RunnablePassthrough
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from agents.state import AgentState
+from database.embeddings import hash_text, fetch_cached_embeddings, save_cached_embeddings
 
 from utils.logs import start_logger
 
@@ -18,6 +20,35 @@ load_dotenv()
 # Logging
 logger = start_logger()
 
+class CachedEmbeddings(Embeddings):
+    """ Embeddings read from the cache filled by the Airflow pipeline (keyed by model and SHA-256 of the text)
+        before falling back to the underlying embeddings model """
+
+    def __init__(self, embeddings: Embeddings, model: str):
+        self.embeddings = embeddings
+        self.model = model
+        self.lookups = 0
+        self.hits = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        text_hashes = [hash_text(text) for text in texts]
+        cached = fetch_cached_embeddings(self.model, list(set(text_hashes)))
+
+        self.lookups += len(texts)
+        self.hits += sum(1 for text_hash in text_hashes if text_hash in cached)
+        logger.info(f"AGENTS/RAG_AGENT - CachedEmbeddings.embed_documents() - Embedding cache hit rate: {self.hits}/{self.lookups}")
+
+        missing = {text_hash: text for text, text_hash in zip(texts, text_hashes) if text_hash not in cached}
+        if missing:
+            new_embeddings = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            save_cached_embeddings(self.model, new_embeddings)
+            cached.update(new_embeddings)
+
+        return [cached[text_hash] for text_hash in text_hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
 class EmailRAGAgent:
     def __init__(self, user_email: str):
         """ Initialize the RAG agent """
@@ -29,10 +60,13 @@ class EmailRAGAgent:
         self.attachment_collection = f"{self.email_collection}_attachments"
         
         # Match the embeddings model with your existing setup
-        self.embeddings = OpenAIEmbeddings(
-            model       = os.getenv("EMBEDDING_MODEL"),
-            api_key     = os.getenv("OPENAI_API_KEY"),
-            dimensions  = 3072
+        self.embeddings = CachedEmbeddings(
+            embeddings = OpenAIEmbeddings(
+                model       = os.getenv("EMBEDDING_MODEL"),
+                api_key     = os.getenv("OPENAI_API_KEY"),
+                dimensions  = 3072
+            ),
+            model = os.getenv("EMBEDDING_MODEL")
         )
         
         self.llm = ChatOpenAI(
@@ -182,6 +182,7 @@ class ThreadAnalyzer:
                                 WHEN e.has_attachments THEN 
                                     json_agg(
                                         DISTINCT jsonb_build_object(
+                                            'id', a.id,
                                             'name', a.name,
                                             'content_type', a.content_type,
                                             'size', a.size,
@@ -217,6 +218,37 @@ class ThreadAnalyzer:
             close_connection(conn)
             return thread_emails
 
+    def get_extracted_texts(self, attachment_ids: List[str]) -> Dict[str, str]:
+        """Fetch the text extracted from attachments when the pipeline ingested them, keyed by attachment id."""
+
+        extracted_texts = {}
+        if not attachment_ids:
+            return extracted_texts
+
+        logger.info(f"Fetching extracted text of {len(attachment_ids)} attachments")
+        conn = open_connection()
+
+        try:
+            with conn.cursor() as cursor:
+                # Identical files share one blob, and with it the text extracted from them
+                query = """
+                    SELECT a.id, b.extracted_text
+                    FROM attachments a
+                    JOIN attachment_blobs b ON b.content_hash = a.content_hash
+                    WHERE a.id = ANY(%s)
+                      AND b.extraction_status = 'done';
+                """
+                cursor.execute(query, (attachment_ids,))
+                extracted_texts = dict(cursor.fetchall())
+                logger.info(f"Found extracted text for {len(extracted_texts)} attachments")
+
+        except Exception as e:
+            logger.error(f"Error fetching extracted attachment text: {str(e)}")
+
+        finally:
+            close_connection(conn)
+            return extracted_texts
+
     def _format_attachment_info(self, attachment: Dict) -> str:
         """Format attachment information for summary."""
         size_mb = float(attachment['size']) / (1024 * 1024) if attachment.get('size') else 0
@@ -287,11 +319,24 @@ class ThreadAnalyzer:
         try:
             attachment_contents = []
 
+            # Attachments ingested by the pipeline already have their text extracted;
+            # only the others are downloaded from S3 and parsed here
+            attachment_ids = [
+                attachment['id']
+                for email in thread_emails
+                if email['has_attachments'] and email['attachments']
+                for attachment in email['attachments']
+                if attachment.get('id')
+            ]
+            extracted_texts = self.get_extracted_texts(attachment_ids)
+
             # Process attachments
             for email in thread_emails:
                 if email['has_attachments'] and email['attachments']:
                     for attachment in email['attachments']:
-                        content = self.process_attachment_content(attachment)
+                        content = extracted_texts.get(attachment.get('id'))
+                        if content is None:
+                            content = self.process_attachment_content(attachment)
                         if content:
                             attachment_contents.append({
                                 'name': attachment['name'],
@@ -0,0 +1,78 @@
+import hashlib
+from typing import Dict, List
+from psycopg2.extras import execute_values
+from utils.logs import start_logger
+from database.connection import open_connection, close_connection
+
+# Logging
+logger = start_logger()
+
+def hash_text(text: str) -> str:
+    ''' Key of a text in the embedding cache, shared with the Airflow pipeline; the model name is stored next to it '''
+
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def fetch_cached_embeddings(model: str, text_hashes: List[str]) -> Dict[str, List[float]]:
+    ''' Fetch the cached embeddings of the given text hashes, returned as {text_hash: embedding} '''
+
+    cached = {}
+    if not text_hashes:
+        return cached
+
+    conn = open_connection()
+
+    if conn:
+        try:
+            with conn.cursor() as cursor:
+                # Hits are marked as used, so that eviction drops the least recently used embeddings
+                query = """
+                    UPDATE embedding_cache
+                    SET last_used_at = CURRENT_TIMESTAMP
+                    WHERE model = %s AND text_hash = ANY(%s)
+                    RETURNING text_hash, embedding;
+                """
+                cursor.execute(query, (model, list(text_hashes)))
+                cached = dict(cursor.fetchall())
+
+                conn.commit()
+
+        except Exception as exception:
+            logger.error(f"DATABASE/EMBEDDINGS - fetch_cached_embeddings() - Failed to fetch cached embeddings (See exception below)")
+            logger.error(f"DATABASE/EMBEDDINGS - fetch_cached_embeddings() - {exception}")
+
+            cached = {}
+            conn.rollback()
+
+        finally:
+            close_connection(conn=conn)
+
+    return cached
+
+def save_cached_embeddings(model: str, embeddings: Dict[str, List[float]]) -> None:
+    ''' Cache embeddings, given as {text_hash: embedding} '''
+
+    if not embeddings:
+        return
+
+    conn = open_connection()
+
+    if conn:
+        try:
+            with conn.cursor() as cursor:
+                query = """
+                    INSERT INTO embedding_cache (model, text_hash, embedding)
+                    VALUES %s
+                    ON CONFLICT (model, text_hash) DO UPDATE SET last_used_at = CURRENT_TIMESTAMP;
+                """
+                execute_values(cursor, query, [(model, text_hash, embeddings[text_hash]) for text_hash in sorted(embeddings)])
+
+                conn.commit()
+
+        except Exception as exception:
+            logger.error(f"DATABASE/EMBEDDINGS - save_cached_embeddings() - Failed to cache embeddings (See exception below)")
+            logger.error(f"DATABASE/EMBEDDINGS - save_cached_embeddings() - {exception}")
+
+            conn.rollback()
+
+        finally:
+            close_connection(conn=conn)